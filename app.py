@@ -1,13 +1,41 @@
-import requests
-import json
+import gateway
+import http_client
+import metrics
+import payload
+import snapshots
 import datetime
-import math
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, g, render_template, jsonify, request
 import os
+import time
 from dotenv import load_dotenv
+from gbfs import GbfsSnapshot
+from availability import AvailabilityStore, EMPTY_THRESHOLD
+from geo import distance_km
+from fanout import Deadline, gather
+from status_board import StatusBoard, train_status_text, realtime_summary
+from topology import TopologyStore
+from timetable import TimetableCache, TIMETABLE_WINDOW_MIN
+from bus_stops import load_bus_stop_index
+from places import PlaceSearch
+from detour import DetourPlanner, line_penalty
+from response_cache import ResponseCache
+from change_feed import ChangeFeed
+from replay import install_recorder_from_env
 load_dotenv()
 ODPT_API_KEY = os.getenv("ODPT_API_KEY")
 app = Flask(__name__)
+# orjson があれば jsonify をそれで書き出す
+payload.install(app)
+
+# UPSTREAM_RECORD を指定すると上流レスポンスをフィクスチャとして記録する (replay.py)
+install_recorder_from_env()
+
+# シェアサイクルのポート情報はプロセス内で共有する
+gbfs_snapshot = GbfsSnapshot(ODPT_API_KEY)
+# 空き台数の変化を記録し、曜日・時間帯ごとの傾向から少し先の台数を見込む
+availability_store = AvailabilityStore(gbfs_snapshot)
+# 貸出ポートで見込み台数を出す時の「何分後」
+AVAILABILITY_HORIZON_MIN = int(os.getenv("AVAILABILITY_HORIZON_MIN", "10"))
 
 
 # 主要路線定義
@@ -43,101 +71,145 @@ LINES_DB = [
     {"id": "odpt.Railway:Odakyu.Odawara", "name": "小田急電鉄 小田原線"},
 ]
 
+# 全路線の運行情報・混雑度をバックグラウンドでまとめて取得する
+status_board = StatusBoard(ODPT_API_KEY, [line["id"] for line in LINES_DB])
+
+# 駅一覧・駅座標はスナップショットから読み込み、バックグラウンドで更新する
+topology_store = TopologyStore(ODPT_API_KEY, [line["id"] for line in LINES_DB])
+topology_store.load_snapshot()
+
+# 駅時刻表はパース済みのインデックスをキャッシュする
+timetable_cache = TimetableCache(ODPT_API_KEY)
+
+# バス停は GTFS (BUS_GTFS_PATH) から読み込んだローカルインデックスで検索する
+bus_stop_index = load_bus_stop_index()
+
+# 地名検索は駅・POI (PLACE_POI_PATH)・バス停のローカルインデックスで答え、無ければ Nominatim
+place_search = PlaceSearch(topology_store, bus_stop_index)
+
+# 遅延時の迂回経路は駅・ポート・バス停の乗り換えグラフで探す
+detour_planner = DetourPlanner(topology_store, gbfs_snapshot, bus_stop_index, {line["id"]: line["name"] for line in LINES_DB})
+
+# 新しいワーカーが上流に問い合わせる前から応答できるよう、共有スナップショットから温めておく
+# (gunicorn --preload ならインポート時の1回だけで、各ワーカーはそれを fork で引き継ぐ)
+STARTUP_WARM_UP = os.getenv("STARTUP_WARM_UP", "1") != "0"
+snapshot_saver = snapshots.PeriodicSaver()
+snapshot_saver.register(timetable_cache.save_snapshot)
+
+def warm_up():
+    started = time.perf_counter()
+    status_board.load_snapshot()
+    gbfs_snapshot.load_snapshot()
+    timetables = timetable_cache.load_snapshot()
+    place_search.current()
+    if topology_store.current is not None:
+        try:
+            detour_planner.rebuild(refresh=False)
+        except Exception as e:
+            print(f"Warm Up Detour Error: {e}")
+    print(f"Warm up: {len(gbfs_snapshot.info)} ports, {timetables} timetables ({time.perf_counter() - started:.1f}s)")
+
+if STARTUP_WARM_UP:
+    warm_up()
+
+# 読み取り専用 API のレスポンスキャッシュ (RESPONSE_CACHE_DB を指定するとワーカー間で共有)
+response_cache = ResponseCache()
+DAY_SEC = 24 * 60 * 60
+
+def default_calendar():
+    return "SaturdayHoliday" if datetime.datetime.now().weekday() >= 5 else "Weekday"
+
 DEFAULT_LAT = 35.690921
 DEFAULT_LON = 139.700258
 
+# 運行情報テキストにこれらが含まれていれば遅延扱い
+DANGER_WORDS = ["遅れ", "見合わせ", "運休", "事故", "折返し"]
+
+def is_alert_status(status_text):
+    return any(w in status_text for w in DANGER_WORDS)
+
+# check_timeline 1回あたりの上流呼び出しの締め切り (秒)
+CHECK_TIMELINE_DEADLINE_SEC = float(os.getenv("CHECK_TIMELINE_DEADLINE_SEC", "5"))
+
 # ---------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------
 
 def get_train_status(railway_id):
-    """運行情報テキストを取得"""
+    """運行情報テキストを取得 (ステータスボード優先、無ければ都度取得)"""
+    cached = status_board.get_status(railway_id)
+    if cached is not None: return cached
     url = "https://api.odpt.org/api/v4/odpt:TrainInformation"
     params = {"acl:consumerKey": ODPT_API_KEY, "odpt:railway": railway_id}
     try:
-        res = requests.get(url, params=params, timeout=2)
-        data = res.json()
-        if data:
-            return data[0].get("odpt:trainInformationText", {}).get("ja", "平常運転")
-        return "平常運転"
-    except: return "情報なし"
+        res = http_client.get(url, params=params)
+        text = train_status_text(res.json())
+        # 最後に成功した値の使い回しはそのまま返すが、今の値としては覚えない
+        if not gateway.is_stale(res): status_board.put_status(railway_id, text)
+        return text
+    except Exception as e:
+        metrics.fallback("train_status", e)
+        return "情報なし"
 
 def get_line_realtime_details(railway_id):
-    """リアルタイム混雑度(遅延度)を算出"""
+    """リアルタイム混雑度(遅延度)を算出 (ステータスボード優先、無ければ都度取得)"""
+    cached = status_board.get_realtime(railway_id)
+    if cached is not None: return cached
     url = "https://api.odpt.org/api/v4/odpt:Train"
     params = {"acl:consumerKey": ODPT_API_KEY, "odpt:railway": railway_id}
     try:
-        res = requests.get(url, params=params, timeout=3)
-        trains = res.json()
-        if not trains:
-            return {"level": 0, "msg": "稼働なし", "train_count": 0, "max_delay": 0}
-
-        train_count = len(trains)
-        delays = [t.get("odpt:delay", 0) for t in trains]
-        max_delay_min = math.ceil(max(delays) / 60) if delays else 0
-
-        if max_delay_min >= 10:
-            return {"level": 3, "msg": f"🔴 激混み (最大{max_delay_min}分遅れ)", "train_count": train_count, "max_delay": max_delay_min}
-        elif max_delay_min >= 3:
-            return {"level": 2, "msg": f"🟡 混雑 (最大{max_delay_min}分遅れ)", "train_count": train_count, "max_delay": max_delay_min}
-        else:
-            return {"level": 1, "msg": "🟢 スムーズ", "train_count": train_count, "max_delay": 0}
+        res = http_client.get(url, params=params)
+        info = realtime_summary(res.json())
+        if not gateway.is_stale(res): status_board.put_realtime(railway_id, info)
+        return info
     except Exception as e:
         print(f"Train API Error: {e}")
+        metrics.fallback("line_realtime", e)
         return {"level": 0, "msg": "データ取得不可", "train_count": 0, "max_delay": 0}
 
 def get_station_geo(station_id):
     if not station_id: return None
+    geo = topology_store.geo(station_id)
+    if geo: return geo
     url = "https://api.odpt.org/api/v4/odpt:Station"
     params = {"acl:consumerKey": ODPT_API_KEY, "owl:sameAs": station_id}
     try:
-        res = requests.get(url, params=params).json()
+        res = http_client.get(url, params=params).json()
         if res:
             return {"lat": res[0]["geo:lat"], "lon": res[0]["geo:long"]}
-    except: pass
+    except Exception as e:
+        metrics.fallback("station_geo", e)
     return None
 
 def get_bike_ports_by_location(lat, lon):
     """シェアサイクルポート検索 (既存機能)"""
     if not lat or not lon: return []
-    info_url = "https://api-public.odpt.org/api/v4/gbfs/docomo-cycle-tokyo/station_information.json"
-    status_url = "https://api-public.odpt.org/api/v4/gbfs/docomo-cycle-tokyo/station_status.json"
-    params = {"acl:consumerKey": ODPT_API_KEY}
     
     try:
-        info_res = requests.get(info_url, params=params).json()
-        status_res = requests.get(status_url, params=params).json()
-        stations_info = {s["station_id"]: s for s in info_res.get("data", {}).get("stations", [])}
-        stations_status = {s["station_id"]: s for s in status_res.get("data", {}).get("stations", [])}
-        
         results = []
-        for st_id, info in stations_info.items():
-            status = stations_status.get(st_id)
-            if not status: continue
-            
-            p_lat, p_lon = info["lat"], info["lon"]
-            d_lat = p_lat - lat
-            d_lon = p_lon - lon
-            dist_km = math.sqrt(d_lat**2 + d_lon**2) * 111
-            
-            if dist_km > 0.5: continue
-            
+        for info, status, dist_km in gbfs_snapshot.nearby(lat, lon, 0.5, k=10):
+            expected = availability_store.expected_bikes(
+                info["station_id"], status["num_bikes_available"], status["num_docks_available"], AVAILABILITY_HORIZON_MIN)
             results.append({
                 "type": "bike",
-                "name": info["name"], "lat": p_lat, "lon": p_lon,
+                "id": info["station_id"],
+                "name": info["name"], "lat": info["lat"], "lon": info["lon"],
                 "bikes_available": status["num_bikes_available"],
                 "docks_available": status["num_docks_available"], 
+                "expected_bikes": expected,
+                "likely_empty": expected is not None and expected <= EMPTY_THRESHOLD,
                 "dist": round(dist_km * 1000)
             })
-        
-        results.sort(key=lambda x: x['dist'])
-        return results[:10]
-    except: return []
+        return results
+    except Exception as e:
+        metrics.fallback("bike_ports", e)
+        return []
 
 # ★【新規追加】バス停検索関数
 def get_bus_stops_by_location(lat, lon):
-    """現在地周辺のバス停を検索 (OpenStreetMap利用)"""
+    """現在地周辺のバス停を検索 (GTFS インデックス優先、無ければ OpenStreetMap利用)"""
     if not lat or not lon: return []
+    if bus_stop_index: return bus_stop_index.nearest(lat, lon)
     url = "https://nominatim.openstreetmap.org/search"
     params = {
         "q": "bus stop",
@@ -150,7 +222,7 @@ def get_bus_stops_by_location(lat, lon):
     headers = {'User-Agent': 'RailEscapeApp/1.0'}
     
     try:
-        res = requests.get(url, params=params, headers=headers).json()
+        res = http_client.get(url, params=params, headers=headers).json()
         results = []
         # バス路線情報の例（実際のAPIやオープンデータから取得可能）
         bus_line_info = {
@@ -166,9 +238,7 @@ def get_bus_stops_by_location(lat, lon):
         
         for item in res:
             p_lat, p_lon = float(item["lat"]), float(item["lon"])
-            d_lat = p_lat - lat
-            d_lon = p_lon - lon
-            dist_km = math.sqrt(d_lat**2 + d_lon**2) * 111
+            dist_km = distance_km(lat, lon, p_lat, p_lon)
             
             name = item["display_name"].split(",")[0]
             
@@ -197,24 +267,86 @@ def get_bus_stops_by_location(lat, lon):
         return results
     except Exception as e:
         print(f"Bus API Error: {e}")
+        metrics.fallback("bus_stops", e)
         return []
 
 # ---------------------------------------------------------
 # Routes
 # ---------------------------------------------------------
 
+@app.before_request
+def start_background_jobs():
+    # gunicorn のワーカーは fork 後に起動するので、最初のリクエストでスレッドを立てる
+    status_board.ensure_started()
+    topology_store.ensure_started()
+    change_feed.ensure_started()
+    availability_store.ensure_started()
+    detour_planner.ensure_started()
+    snapshot_saver.ensure_started()
+
+@app.before_request
+def begin_trace():
+    g.trace, g.trace_token = metrics.start_trace()
+
+@app.after_request
+def finish_trace(response):
+    trace = g.get("trace")
+    if trace is None: return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # ストリーミング (NDJSON / SSE) は本文の大きさが分からないので数えない
+    size = None if response.is_streamed else response.calculate_content_length()
+    metrics.record_request(route, request.method, response.status_code, trace.elapsed(), size)
+    if metrics.SERVER_TIMING:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+@app.after_request
+def compress_response(response):
+    # finish_trace より先に動くので、計測する大きさは圧縮後 (実際に送る量) になる
+    return payload.compress_response(response, request.headers.get("Accept-Encoding"))
+
+@app.teardown_request
+def end_trace(exc):
+    token = g.pop("trace_token", None)
+    if token is not None: metrics.end_trace(token)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 形式のプロセス内メトリクス"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# 路線一覧は変わらないので、本文と圧縮した版を使い回す
+LINES_BODY = None
+
 @app.route('/api/lines')
 def api_lines():
-    return jsonify(LINES_DB)
+    global LINES_BODY
+    if LINES_BODY is None: LINES_BODY = payload.Precompressed(app.json.dumps(LINES_DB).encode())
+    encoding = payload.negotiate(request.headers.get("Accept-Encoding"), len(LINES_BODY.body))
+    res = Response(LINES_BODY.get(encoding), mimetype="application/json")
+    if encoding: res.headers["Content-Encoding"] = encoding
+    res.vary.add("Accept-Encoding")
+    res.headers["Cache-Control"] = f"public, max-age={DAY_SEC}"
+    return res
+
+def list_response(rows):
+    """一覧の JSON。format=columns なら列形式"""
+    return jsonify(payload.columns(rows) if payload.wants_columns(request.args) else rows)
 
 @app.route('/api/stations_list')
+@response_cache.cached("stations_list", ttl=DAY_SEC, stale_ttl=7 * DAY_SEC)
 def api_stations_list():
+    """路線の駅一覧 (駅順)。format=columns なら {"id": [...], "name": [...], "lat": [...], "lon": [...]}"""
     line_id = request.args.get('line_id')
-    if not line_id: return jsonify([])
+    if not line_id: return list_response([])
+
+    # ローカルのトポロジーに収録済みならネットワークに出ない
+    stations = topology_store.stations_for(line_id)
+    if stations is not None: return list_response(stations)
     
     # 路線情報(順序)と駅情報(座標)を取得
     railway_url = "https://api.odpt.org/api/v4/odpt:Railway"
@@ -224,10 +356,10 @@ def api_stations_list():
     station_params = {"acl:consumerKey": ODPT_API_KEY, "odpt:railway": line_id}
 
     try:
-        railway_res = requests.get(railway_url, params=railway_params).json()
-        station_res = requests.get(station_url, params=station_params).json()
+        railway_res = http_client.get(railway_url, params=railway_params).json()
+        station_res = http_client.get(station_url, params=station_params).json()
         
-        if not railway_res or not station_res: return jsonify([])
+        if not railway_res or not station_res: return list_response([])
 
         station_map = {}
         for s in station_res:
@@ -252,117 +384,159 @@ def api_stations_list():
             if s_id not in used_ids:
                 ordered_stations.append(s_data)
 
-        return jsonify(ordered_stations)
+        return list_response(ordered_stations)
 
     except Exception as e:
         print(f"Station List Error: {e}")
-        return jsonify([])
+        metrics.fallback("stations_list", e)
+        return list_response([])
 
 @app.route('/api/search_place')
+@response_cache.cached("search_place", ttl=DAY_SEC, stale_ttl=7 * DAY_SEC)
 def search_place():
     q = request.args.get('q')
+    hit = place_search.best(q) if q else None
+    metrics.cache_result("place_index", "hit" if hit else "miss")
+    if hit:
+        return jsonify({"name": hit["name"], "lat": hit["lat"], "lon": hit["lon"]})
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": q, "format": "json", "countrycodes": "jp", "limit": 1}
     try:
         headers = {'User-Agent': 'RailEscapeApp/1.0'}
-        res = requests.get(url, params=params, headers=headers).json()
+        res = http_client.get(url, params=params, headers=headers).json()
         if len(res) > 0:
             top = res[0]
-            return jsonify({"name": top['display_name'].split(',')[0], "lat": float(top['lat']), "lon": float(top['lon'])})
-    except: pass
+            place = {"name": top['display_name'].split(',')[0], "lat": float(top['lat']), "lon": float(top['lon'])}
+            place_search.remember(q, place["name"], place["lat"], place["lon"])
+            return jsonify(place)
+    except Exception as e:
+        metrics.fallback("search_place", e)
     return jsonify({"error": "Not found"})
 
+@app.route('/api/place_suggest')
+def place_suggest():
+    """入力途中の地名の候補 (ローカルインデックスのみ、前方一致・あいまい一致)"""
+    q = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 5, type=int), 1), 20)
+    return jsonify(place_search.search(q, limit))
+
 @app.route('/api/station_timetable')
+# calendar 省略時は曜日で変わるのでキーに含める
+@response_cache.cached("station_timetable", ttl=6 * 60 * 60, stale_ttl=DAY_SEC, vary=default_calendar)
 def api_station_timetable():
     req_st_id = request.args.get('station_id') 
     line_id = request.args.get('line_id')
     target_time_str = request.args.get('time', '08:00')
     user_cal = request.args.get('calendar') 
+    window = request.args.get('window', TIMETABLE_WINDOW_MIN, type=int)
     if not req_st_id or not line_id: return jsonify([])
     if not user_cal:
-        user_cal = "SaturdayHoliday" if datetime.datetime.now().weekday() >= 5 else "Weekday"
+        user_cal = default_calendar()
 
-    url = "https://api.odpt.org/api/v4/odpt:StationTimetable"
-    params = {"acl:consumerKey": ODPT_API_KEY, "odpt:station": req_st_id, "odpt:railway": line_id}
-    
     try:
-        res = requests.get(url, params=params).json()
-        if not res:
-            parts = req_st_id.split(':')
-            if len(parts) == 2:
-                body_parts = parts[1].split('.')
-                if len(body_parts) >= 3:
-                    alt_id = f"{parts[0]}:{body_parts[0]}.{body_parts[-1]}"
-                    params["odpt:station"] = alt_id
-                    res = requests.get(url, params=params).json()
-        if not res:
-            params.pop("odpt:railway")
-            res = requests.get(url, params=params).json()
-        if not res: return jsonify([])
-        
-        def to_mins(t_str):
-            h, m = map(int, t_str.split(':'))
-            return h * 60 + m
-        target_mins = to_mins(target_time_str)
-        candidates = []
-
-        for tt in res:
-            data_line = tt.get("odpt:railway", "")
-            if line_id and data_line and data_line != line_id and "JR-East" not in line_id:
-                continue
+        return jsonify(timetable_cache.departures(req_st_id, line_id, user_cal, target_time_str, window))
+    except Exception as e:
+        metrics.fallback("station_timetable", e)
+        return jsonify([])
 
-            cal_id = tt.get("odpt:calendar", "")
-            is_match = False
-            if user_cal == "Weekday":
-                if "Weekday" in cal_id: is_match = True
-            else:
-                if "Saturday" in cal_id or "Holiday" in cal_id: is_match = True
-            
-            if not is_match and len(res) <= 3: is_match = True
-            if not is_match: continue
-
-            for train in tt.get("odpt:stationTimetableObject", []):
-                dep = train.get("odpt:departureTime")
-                if not dep: continue
-                if target_mins - 30 <= to_mins(dep) <= target_mins + 30:
-                    dest = train.get("odpt:destinationStation", [])
-                    d_name = dest[0].split('.')[-1] if dest else "Unknown"
-                    t_type = train.get("odpt:trainType", "").split('.')[-1].replace('JR-East.', '')
-                    candidates.append({"time": dep, "dest": d_name, "type": t_type})
-        
-        seen = set()
-        unique = []
-        for c in candidates:
-            k = f"{c['time']}-{c['dest']}"
-            if k not in seen:
-                seen.add(k)
-                unique.append(c)
-        unique.sort(key=lambda x: x['time'])
-        return jsonify(unique)
-    except: return jsonify([])
+# ---------------------------------------------------------
+# Live status feed
+# ---------------------------------------------------------
 
-# ★【変更点】ここが今回ロジックが変わった場所です
-@app.route('/api/check_timeline', methods=['POST'])
-def check_timeline():
-    route_data = request.json
-    rent_lat = float(request.args.get('lat', DEFAULT_LAT))
-    rent_lon = float(request.args.get('lon', DEFAULT_LON))
-    
-    # ★ ここで「バス」か「自転車」かを受け取る
-    escape_method = request.args.get('method', 'bike') 
+# 1購読あたりの路線数・ポート数の上限
+STREAM_MAX_RAILWAYS = 10
+STREAM_MAX_PORTS = 30
+
+def read_line_feed(railway_id):
+    """路線トピック: 運行情報テキストの変化と混雑度レベルの変化"""
+    status_text = get_train_status(railway_id)
+    realtime_info = get_line_realtime_details(railway_id)
+    return {
+        "line_status": (status_text, {"railway": railway_id, "status": status_text, "alert": is_alert_status(status_text)}),
+        "congestion": (realtime_info["level"], {"railway": railway_id, "congestion": realtime_info}),
+    }
 
-    bike_target = request.json[0].get('bike_target') if route_data else None
+def read_port_feed(port_id):
+    """ポートトピック: 貸出可能台数・返却可能台数の変化"""
+    status = gbfs_snapshot.port_status(port_id)
+    if not status: return {}
+    counts = (status["num_bikes_available"], status["num_docks_available"])
+    return {"bike": (counts, {"port": port_id, "bikes_available": counts[0], "docks_available": counts[1]})}
+
+change_feed = ChangeFeed({"line": read_line_feed, "port": read_port_feed})
+metrics.gauge("railbridge_feed_subscribers", "Open live status subscriptions", lambda: change_feed.count)
+
+def stream_topics(args):
+    railways = [r for r in args.get('railways', '').split(',') if r][:STREAM_MAX_RAILWAYS]
+    ports = [p for p in args.get('ports', '').split(',') if p][:STREAM_MAX_PORTS]
+    return [("line", r) for r in railways] + [("port", p) for p in ports]
+
+@app.route('/api/stream_status')
+def stream_status():
+    """路線・ポートを購読し、変化があった時だけ Server-Sent Events で送る。
+
+    WSGI では接続中ずっとワーカースレッドを1本使うので、購読者数は FEED_MAX_WSGI_SUBSCRIBERS まで。
+    大勢に配信する時は asgi.py (uvicorn) で動かす。
+    """
+    topics = stream_topics(request.args)
+    if not topics: return jsonify({"error": "No topics"}), 400
+
+    sub = change_feed.subscribe(topics, blocking=True)
+    if sub is None: return jsonify({"error": "Too many subscribers"}), 503, {"Retry-After": "60"}
+    return Response(change_feed.stream(sub), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/api/port_forecast')
+def port_forecast():
+    """ポートの現在の台数と minutes 分後の見込み台数 (履歴が足りなければ expected_bikes は null)"""
+    port_id = request.args.get('port_id')
+    minutes = min(max(request.args.get('minutes', AVAILABILITY_HORIZON_MIN, type=int), 1), 120)
+    if not port_id: return jsonify({"error": "No port_id"}), 400
+    try:
+        result = availability_store.forecast(port_id, minutes)
+    except Exception as e:
+        metrics.fallback("port_forecast", e)
+        result = None
+    if result is None: return jsonify({"error": "Unknown port"}), 404
+    return jsonify(result)
+
+# 上流呼び出しがタイムアウト/失敗した場合の既定値
+FANOUT_DEFAULTS = {
+    "status": "情報なし",
+    "realtime": {"level": 0, "msg": "データ取得不可", "train_count": 0, "max_delay": 0},
+    "geo": None,
+    "spots": [],
+}
+
+def route_calls(route_data):
+    """区間ごとの運行情報・混雑度と、使う可能性のある駅座標の上流呼び出し"""
+    calls = {}
+    for segment in route_data:
+        if 'line_id' in segment:
+            calls[("status", segment['line_id'])] = (get_train_status, segment['line_id'])
+            calls[("realtime", segment['line_id'])] = (get_line_realtime_details, segment['line_id'])
+        for key in ('start_st_id', 'end_st_id'):
+            if segment.get(key):
+                calls[("geo", segment[key])] = (get_station_geo, segment[key])
+    return calls
+
+def plan_route(route_data, fetched, rent_lat, rent_lon, escape_method):
+    """取得済みの情報からタイムラインと起点/終点を決める (ネットワーク I/O なし)"""
+    bike_target = route_data[0].get('bike_target') if route_data else None
+
+    def station_geo(station_id):
+        return fetched.get(("geo", station_id)) if station_id else None
     
     timeline_results = []
     has_trouble = False
-    danger_words = ["遅れ", "見合わせ", "運休", "事故", "折返し"]
+    line_penalties = {}
     
     for segment in route_data:
         if 'line_id' not in segment: continue
-        status_text = get_train_status(segment['line_id'])
-        is_alert = any(w in status_text for w in danger_words)
+        status_text = fetched[("status", segment['line_id'])]
+        is_alert = is_alert_status(status_text)
         
-        realtime_info = get_line_realtime_details(segment['line_id'])
+        realtime_info = fetched[("realtime", segment['line_id'])]
         
         if segment.get('force_delay'):
             status_text = "【TEST】運転見合わせ"
@@ -371,8 +545,9 @@ def check_timeline():
         
         if realtime_info['level'] >= 2: is_alert = True
         if is_alert: has_trouble = True
+        line_penalties[segment['line_id']] = line_penalty(status_text, realtime_info, is_alert)
         
-        start_geo = get_station_geo(segment.get('start_st_id'))
+        start_geo = station_geo(segment.get('start_st_id'))
         
         timeline_results.append({
             "line_name": segment.get('line_name'),
@@ -386,8 +561,6 @@ def check_timeline():
         })
     
     # ★ ここで分岐: 遅延時は「運行中の路線の駅」を起点/終点としてバスまたは自転車ポートを検索
-    start_spots = []
-    end_spots = []
 
     # デフォルトの出発/到着ポイント
     start_point = {"lat": rent_lat, "lon": rent_lon}
@@ -400,72 +573,127 @@ def check_timeline():
         # 最終セグメントの降車駅を目的地とする（取れなければ開始駅を代用）
         try:
             last_seg = route_data[-1]
-            last_end_geo = get_station_geo(last_seg.get('end_st_id'))
+            last_end_geo = station_geo(last_seg.get('end_st_id'))
             if last_end_geo:
                 end_point = last_end_geo
             else:
-                end_point = get_station_geo(last_seg.get('start_st_id'))
+                end_point = station_geo(last_seg.get('start_st_id'))
         except Exception:
             end_point = None
 
     # 遅延がある場合、運行中の路線の駅を起点に設定する
+    alert_idx = None
     if has_trouble:
         # timeline_results と route_data のインデックスは対応している
         alert_idxs = [i for i, t in enumerate(timeline_results) if t.get('alert')]
         op_idxs = [i for i, t in enumerate(timeline_results) if not t.get('alert')]
 
         if alert_idxs:
-            first_alert = alert_idxs[0]
+            first_alert = alert_idx = alert_idxs[0]
             # 遅延より前に運行中の路線があればその降車駅を起点にする
             prev_ops = [i for i in op_idxs if i < first_alert]
             if prev_ops:
                 idx = prev_ops[-1]
                 seg = route_data[idx]
-                geo = get_station_geo(seg.get('end_st_id'))
+                geo = station_geo(seg.get('end_st_id'))
                 if geo:
                     start_point = geo
             else:
                 # 遅延より前に運行中の路線がない場合は、遅延路線の乗車駅を起点にする
                 seg = route_data[first_alert]
-                geo = get_station_geo(seg.get('start_st_id'))
+                geo = station_geo(seg.get('start_st_id'))
                 if geo:
                     start_point = geo
 
-    # 指定手段に基づき起点/終点周辺のスポットを検索
-    if escape_method == 'bus':
-        start_spots = get_bus_stops_by_location(start_point.get('lat'), start_point.get('lon'))
-        if end_point:
-            end_spots = get_bus_stops_by_location(end_point.get('lat'), end_point.get('lon'))
-    else:
-        start_spots = get_bike_ports_by_location(start_point.get('lat'), start_point.get('lon'))
-        if end_point:
-            end_spots = get_bike_ports_by_location(end_point.get('lat'), end_point.get('lon'))
+    # バス代替案では遅延している路線の降車駅周辺のバス停を終点側に使う
+    alert_end_geo = None
+    if has_trouble and escape_method == 'bus' and alert_idx is not None:
+        alert_end_geo = station_geo(route_data[alert_idx].get('end_st_id'))
+
+    return {
+        "timeline": timeline_results,
+        "has_trouble": has_trouble,
+        "start_point": start_point,
+        "end_point": end_point,
+        "alert_idx": alert_idx,
+        "spots_end_point": alert_end_geo or end_point,
+        "line_penalties": line_penalties,
+    }
+
+def spot_key(escape_method, point):
+    return ("spots", escape_method, point.get('lat'), point.get('lon'))
+
+def spot_calls(plan, escape_method):
+    """指定手段に基づく起点/終点周辺のスポット検索"""
+    find_spots = get_bus_stops_by_location if escape_method == 'bus' else get_bike_ports_by_location
+    calls = {}
+    for point in (plan["start_point"], plan["spots_end_point"]):
+        if point:
+            calls[spot_key(escape_method, point)] = (find_spots, point.get('lat'), point.get('lon'))
+    return calls
+
+def line_conditions(plan):
+    """迂回経路の探索に使う路線ごとの遅れ。経路の区間の状況を、ステータスボードにある全路線の状況に重ねる"""
+    penalties = {}
+    for line in LINES_DB:
+        status_text = status_board.get_status(line["id"])
+        realtime_info = status_board.get_realtime(line["id"])
+        if status_text is None and realtime_info is None: continue
+        is_alert = is_alert_status(status_text or "") or (realtime_info or {}).get("level", 0) >= 2
+        penalties[line["id"]] = line_penalty(status_text, realtime_info, is_alert)
+    penalties.update(plan["line_penalties"])
+    return penalties
+
+def plan_detour(plan, escape_method, memo=None):
+    """遅延区間を避けて spots_end_point へ向かう最短の経路 (鉄道 + 徒歩 + 指定の手段)。グラフ未構築なら None
+
+    memo を渡すと、起点・終点・手段・路線の状況が同じ経路の探索結果を使い回す (check_timeline_batch 用)。
+    """
+    if not plan["has_trouble"] or plan["alert_idx"] is None: return None
+    dest_name = plan["timeline"][plan["alert_idx"]].get('end_station') if escape_method == 'bus' else None
+    start, end = plan["start_point"], plan["spots_end_point"] or {}
+    try:
+        penalties = line_conditions(plan)
+        key = ("detour", start.get('lat'), start.get('lon'), end.get('lat'), end.get('lon'), escape_method, dest_name,
+               tuple(sorted(penalties.items(), key=lambda item: item[0])))
+        if memo is not None and key in memo: return memo[key]
+        detour = detour_planner.plan(start, plan["spots_end_point"], penalties, escape_method, dest_name=dest_name or "目的地")
+        if memo is not None: memo[key] = detour
+        return detour
+    except Exception as e:
+        metrics.fallback("detour", e)
+        return None
+
+def finish_route(plan, fetched, escape_method, memo=None):
+    """スポット検索結果を合わせて check_timeline のレスポンスを組み立てる (memo は plan_detour へ)"""
+    timeline_results = plan["timeline"]
+    has_trouble = plan["has_trouble"]
+    start_point = plan["start_point"]
+    alert_idx = plan["alert_idx"]
+    start_spots = fetched[spot_key(escape_method, start_point)]
+    end_spots = fetched[spot_key(escape_method, plan["spots_end_point"])] if plan["spots_end_point"] else []
+
+    detour = plan_detour(plan, escape_method, memo)
+    bus_legs = [leg for leg in (detour or {}).get("legs", []) if leg["mode"] == "bus"]
 
     # ★ バス代替案情報の生成
     bus_alternative_info = None
     if has_trouble and escape_method == 'bus':
-        alert_idx = next((i for i, t in enumerate(timeline_results) if t.get('alert')), None)
         if alert_idx is not None:
-            # 遅延している路線の降車駅周辺のバス停を検索
-            alert_seg = route_data[alert_idx]
-            alert_end_geo = get_station_geo(alert_seg.get('end_st_id'))
-            
-            if alert_end_geo:
-                end_spots = get_bus_stops_by_location(alert_end_geo.get('lat'), alert_end_geo.get('lon'))
-            
             if start_spots and end_spots:
                 start_bus = start_spots[0]
                 end_bus = end_spots[0]
                 
-                # バス移動時間を推定（起点と終点間の距離から）
-                import math
+                # バス移動時間を推定（迂回経路にバスが含まれていればその所要時間、無ければ起点と終点間の距離から）
                 lat1, lon1 = start_point.get('lat'), start_point.get('lon')
                 lat2, lon2 = end_bus.get('lat'), end_bus.get('lon')
-                if lat1 and lon1 and lat2 and lon2:
+                if bus_legs:
+                    travel_time_min = detour["minutes"]
+                    start_bus = {"name": bus_legs[0]["from"], "line": bus_legs[0]["line"]}
+                    end_bus = {"name": bus_legs[-1]["to"], "line": bus_legs[-1]["line"]}
+                elif lat1 and lon1 and lat2 and lon2:
                     # 2点間の直線距離（km）
-                    d_lat = lat2 - lat1
-                    d_lon = lon2 - lon1
-                    dist_km = math.sqrt(d_lat**2 + d_lon**2) * 111
+                    dist_km = distance_km(lat1, lon1, lat2, lon2)
                     # バスの移動時間を推定（時速20km、信号待ちで約1分/km）
                     travel_time_min = max(int(dist_km * 3), 10)
                 else:
@@ -493,15 +721,126 @@ def check_timeline():
                     "travel_time": travel_time_min
                 }
 
-    return jsonify({
+    return {
         "timeline": timeline_results,
         "has_trouble": has_trouble,
         "rent_ports": start_spots,
         "return_ports": end_spots,
         "start_point": start_point,
-        "end_point": end_point,
-        "bus_alternative": bus_alternative_info
-    })
+        "end_point": plan["end_point"],
+        "bus_alternative": bus_alternative_info,
+        "detour": detour
+    }
+
+def shape_result(result, args):
+    """format=columns なら rent_ports / return_ports を列形式にする (ポートごとのキーの繰り返しを省く)"""
+    if payload.wants_columns(args):
+        for key in ("rent_ports", "return_ports"):
+            result[key] = payload.columns(result[key])
+    return result
+
+# ★【変更点】ここが今回ロジックが変わった場所です
+@app.route('/api/check_timeline', methods=['POST'])
+def check_timeline():
+    route_data = request.json
+    rent_lat = float(request.args.get('lat', DEFAULT_LAT))
+    rent_lon = float(request.args.get('lon', DEFAULT_LON))
+    
+    # ★ ここで「バス」か「自転車」かを受け取る
+    escape_method = request.args.get('method', 'bike') 
+    deadline = Deadline(CHECK_TIMELINE_DEADLINE_SEC)
+    
+    # ★ 運行情報・混雑度・駅座標をまとめて並列取得し、続けて起点/終点のスポットを並列検索
+    with metrics.span("fetch"):
+        fetched, missing = gather(route_calls(route_data), deadline, FANOUT_DEFAULTS)
+    with metrics.span("plan"):
+        plan = plan_route(route_data, fetched, rent_lat, rent_lon, escape_method)
+    with metrics.span("spots"):
+        spots, spots_missing = gather(spot_calls(plan, escape_method), deadline, FANOUT_DEFAULTS)
+    fetched.update(spots)
+
+    with metrics.span("finish"):
+        result = finish_route(plan, fetched, escape_method)
+    # 締め切りまでに揃わなかった情報がある場合 True (既定値で埋めている)
+    result["partial"] = bool(missing or spots_missing)
+    return jsonify(shape_result(result, request.args))
+
+# 一括評価で1度に並列取得する経路数
+BATCH_CHUNK_SIZE = 200
+
+def evaluate_routes(routes, default_lat=DEFAULT_LAT, default_lon=DEFAULT_LON, default_method='bike'):
+    """多数の経路をまとめて評価し、経路ごとの結果を順に返す。
+
+    路線の運行情報・駅座標・スポット検索は全経路を通して同じキーにつき1回だけ行う。
+    routes: [{"id", "segments": [...check_timeline と同じ区間...], "lat", "lon", "method"}]
+    """
+    memo = {}
+    detours = {}  # 迂回経路は入力が同じなら全チャンクを通して1回だけ探す
+    for chunk_start in range(0, len(routes), BATCH_CHUNK_SIZE):
+        chunk = routes[chunk_start:chunk_start + BATCH_CHUNK_SIZE]
+        deadline = Deadline(CHECK_TIMELINE_DEADLINE_SEC)
+
+        def fetch(calls):
+            needed = {k: c for k, c in calls.items() if k not in memo}
+            results, missing = gather(needed, deadline, FANOUT_DEFAULTS)
+            memo.update(results)
+            return set(missing)
+
+        calls = {}
+        plans = []
+        for item in chunk:
+            segments = item.get('segments') if isinstance(item, dict) else None
+            if not isinstance(segments, list) or not all(isinstance(seg, dict) for seg in segments):
+                plans.append((item, None, None, None, "segments must be a list of objects"))
+                continue
+            calls.update(route_calls(segments))
+            plans.append((item, None, segments, None, None))
+        failed = fetch(calls)
+
+        calls = {}
+        for n, (item, _, segments, _, error) in enumerate(plans):
+            if error is not None: continue
+            method = item.get('method', default_method)
+            try:
+                lat = float(item.get('lat', default_lat))
+                lon = float(item.get('lon', default_lon))
+                plan = plan_route(segments, memo, lat, lon, method)
+                calls.update(spot_calls(plan, method))
+                plans[n] = (item, method, segments, plan, None)
+            except Exception as e:
+                plans[n] = (item, method, segments, None, str(e))
+        failed |= fetch(calls)
+
+        for item, method, segments, plan, error in plans:
+            item_id = item.get('id') if isinstance(item, dict) else None
+            if error is not None:
+                yield {"id": item_id, "error": error}
+                continue
+            result = finish_route(plan, memo, method, detours)
+            used = set(route_calls(segments)) | set(spot_calls(plan, method))
+            result["partial"] = bool(used & failed)
+            yield {"id": item_id, "result": result}
+
+        # 失敗したものは次のチャンクで取り直す
+        for key in failed:
+            memo.pop(key, None)
+
+@app.route('/api/check_timeline_batch', methods=['POST'])
+def check_timeline_batch():
+    """{"routes": [...]} を受け取り、経路ごとに1行の NDJSON でストリーミングして返す"""
+    body = request.json or {}
+    routes = body.get('routes', []) if isinstance(body, dict) else body
+    default_lat = float(request.args.get('lat', DEFAULT_LAT))
+    default_lon = float(request.args.get('lon', DEFAULT_LON))
+    default_method = request.args.get('method', 'bike')
+    # ジェネレーターはリクエストの外で動くので先に取り出しておく
+    args = request.args.to_dict()
+
+    def generate():
+        for line in evaluate_routes(routes, default_lat, default_lon, default_method):
+            if "result" in line: shape_result(line["result"], args)
+            yield app.json.dumps(line) + "\n"
+    return Response(generate(), mimetype="application/x-ndjson")
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
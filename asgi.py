@@ -0,0 +1,294 @@
+"""非同期サーバー用の ASGI エントリポイント
+
+uvicorn asgi:app --workers 2 --port 5000
+
+check_timeline と stream_status はイベントループ上で動かし、上流の応答を待つ間も
+スレッドを占有しない (1プロセスで数百件の同時リクエストを受けられる)。
+それ以外のルートは既存の Flask アプリをスレッドプール経由でそのまま呼ぶので、
+URL・JSON の形は WSGI 版 (gunicorn app:app) と変わらない。
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+import async_http
+import gateway
+import metrics
+import payload
+import app as wsgi
+from fanout import Deadline, gather_async
+from status_board import train_status_text, realtime_summary
+
+# check_timeline の同時処理数の上限 (超えたら 503)。メモリ使用量の上限になる
+ASGI_MAX_INFLIGHT = int(os.getenv("ASGI_MAX_INFLIGHT", "500"))
+# Flask に回すルート・ブロックする処理を動かすスレッド数
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "32"))
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="asgi-wsgi")
+_inflight = 0
+
+
+async def _blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+# ---------------------------------------------------------
+# 上流呼び出し (app.py の get_* の非同期版)
+# ---------------------------------------------------------
+
+def _odpt_params(**params):
+    return {"acl:consumerKey": wsgi.ODPT_API_KEY, **params}
+
+
+async def train_status(railway_id):
+    cached = wsgi.status_board.get_status(railway_id)
+    if cached is not None: return cached
+    try:
+        res = await async_http.get("https://api.odpt.org/api/v4/odpt:TrainInformation", params=_odpt_params(**{"odpt:railway": railway_id}))
+        text = train_status_text(res.json())
+        if not gateway.is_stale(res): wsgi.status_board.put_status(railway_id, text)
+        return text
+    except Exception as e:
+        metrics.fallback("train_status", e)
+        return "情報なし"
+
+
+async def line_realtime_details(railway_id):
+    cached = wsgi.status_board.get_realtime(railway_id)
+    if cached is not None: return cached
+    try:
+        res = await async_http.get("https://api.odpt.org/api/v4/odpt:Train", params=_odpt_params(**{"odpt:railway": railway_id}))
+        info = realtime_summary(res.json())
+        if not gateway.is_stale(res): wsgi.status_board.put_realtime(railway_id, info)
+        return info
+    except Exception as e:
+        print(f"Train API Error: {e}")
+        metrics.fallback("line_realtime", e)
+        return wsgi.FANOUT_DEFAULTS["realtime"]
+
+
+async def station_geo(station_id):
+    if not station_id: return None
+    geo = wsgi.topology_store.geo(station_id)
+    if geo: return geo
+    try:
+        res = (await async_http.get("https://api.odpt.org/api/v4/odpt:Station", params=_odpt_params(**{"owl:sameAs": station_id}))).json()
+        if res:
+            return {"lat": res[0]["geo:lat"], "lon": res[0]["geo:long"]}
+    except Exception as e:
+        metrics.fallback("station_geo", e)
+    return None
+
+
+async def bike_ports(lat, lon):
+    # ほぼ常にメモリ上のスナップショットだが、初回や期限切れの取り直しはブロックする
+    return await _blocking(wsgi.get_bike_ports_by_location, lat, lon)
+
+
+async def bus_stops(lat, lon):
+    if wsgi.bus_stop_index and lat and lon: return wsgi.bus_stop_index.nearest(lat, lon)
+    # Nominatim は 1 req/s の制限があり呼ぶ頻度が低いので、同期版をスレッドで動かす
+    return await _blocking(wsgi.get_bus_stops_by_location, lat, lon)
+
+
+ASYNC_FETCHERS = {
+    wsgi.get_train_status: train_status,
+    wsgi.get_line_realtime_details: line_realtime_details,
+    wsgi.get_station_geo: station_geo,
+    wsgi.get_bike_ports_by_location: bike_ports,
+    wsgi.get_bus_stops_by_location: bus_stops,
+}
+
+
+def to_async(calls):
+    """route_calls / spot_calls の {key: (同期関数, *args)} を非同期版に差し替える"""
+    return {key: (ASYNC_FETCHERS[fn], *args) for key, (fn, *args) in calls.items()}
+
+
+# ---------------------------------------------------------
+# ASGI の入出力
+# ---------------------------------------------------------
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect": break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"): break
+    return b"".join(chunks)
+
+
+async def send_response(send, status, body, content_type="application/json", headers=()):
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def header(scope, name):
+    """リクエストヘッダーの値 (同名が複数あればカンマでつなぐ)。無ければ None"""
+    values = [v.decode("latin-1") for k, v in scope["headers"] if k == name]
+    return ",".join(values) if values else None
+
+
+def json_body(data):
+    # Flask の jsonify と同じ書式で書き出す
+    return wsgi.app.json.response(data).get_data()
+
+
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0], "SERVER_PORT": str(server[1]),
+        "REMOTE_ADDR": client[0],
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0), "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body), "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True, "wsgi.multiprocess": True, "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name, value = name.decode("latin-1").upper().replace("-", "_"), value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"): name = "HTTP_" + name
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+async def call_wsgi(scope, receive, send):
+    """Flask アプリをスレッドプールで呼ぶ。本文は1チャンクずつ取り出して送る (NDJSON などのストリーミング対応)"""
+    environ = wsgi_environ(scope, await read_body(receive))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"], started["headers"] = int(status.split(" ", 1)[0]), headers
+
+    iterable = await _blocking(wsgi.app, environ, start_response)
+    try:
+        iterator = iter(iterable)
+        first = await _blocking(next, iterator, None)
+        await send({"type": "http.response.start", "status": started["status"], "headers": [
+            (k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in started["headers"]]})
+        chunk = first
+        while chunk is not None:
+            if chunk: await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await _blocking(next, iterator, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(iterable, "close"): await _blocking(iterable.close)
+
+
+# ---------------------------------------------------------
+# Routes
+# ---------------------------------------------------------
+
+async def check_timeline(scope, receive, send):
+    global _inflight
+    if _inflight >= ASGI_MAX_INFLIGHT:
+        return await send_response(send, 503, json_body({"error": "Too many requests in flight"}))
+    _inflight += 1
+    trace, token = metrics.start_trace()
+    status = 200
+    try:
+        try:
+            route_data = wsgi.app.json.loads(await read_body(receive))
+            args = dict(parse_qsl(scope["query_string"].decode()))
+            rent_lat = float(args.get('lat', wsgi.DEFAULT_LAT))
+            rent_lon = float(args.get('lon', wsgi.DEFAULT_LON))
+        except ValueError:
+            status = 400
+            return await send_response(send, status, json_body({"error": "Bad request"}))
+        escape_method = args.get('method', 'bike')
+        deadline = Deadline(wsgi.CHECK_TIMELINE_DEADLINE_SEC)
+
+        with metrics.span("fetch"):
+            fetched, missing = await gather_async(to_async(wsgi.route_calls(route_data)), deadline, wsgi.FANOUT_DEFAULTS)
+        with metrics.span("plan"):
+            plan = wsgi.plan_route(route_data, fetched, rent_lat, rent_lon, escape_method)
+        with metrics.span("spots"):
+            spots, spots_missing = await gather_async(to_async(wsgi.spot_calls(plan, escape_method)), deadline, wsgi.FANOUT_DEFAULTS)
+        fetched.update(spots)
+
+        with metrics.span("finish"):
+            # 迂回経路の探索 (A*) は数 ms かかるのでイベントループの外で行う
+            result = await _blocking(wsgi.finish_route, plan, fetched, escape_method)
+        result["partial"] = bool(missing or spots_missing)
+        body = json_body(wsgi.shape_result(result, args))
+        headers = [(b"server-timing", trace.server_timing().encode())] if metrics.SERVER_TIMING else []
+        encoding = payload.negotiate(header(scope, b"accept-encoding"), len(body))
+        headers.append((b"vary", b"Accept-Encoding"))
+        if encoding:
+            body = payload.compress(body, encoding)
+            headers.append((b"content-encoding", encoding.encode()))
+        await send_response(send, status, body, headers=headers)
+        metrics.record_request("/api/check_timeline", "POST", status, trace.elapsed(), len(body))
+    except Exception:
+        status = 500
+        raise
+    finally:
+        if status != 200: metrics.record_request("/api/check_timeline", "POST", status, trace.elapsed())
+        metrics.end_trace(token)
+        _inflight -= 1
+
+
+async def stream_status(scope, receive, send):
+    topics = wsgi.stream_topics(dict(parse_qsl(scope["query_string"].decode())))
+    if not topics: return await send_response(send, 400, json_body({"error": "No topics"}))
+    # 未取得のトピックはその場で読むのでスレッドで
+    sub = await _blocking(wsgi.change_feed.subscribe, topics, False, asyncio.get_running_loop())
+    if sub is None: return await send_response(send, 503, json_body({"error": "Too many subscribers"}))
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+
+    async def pump():
+        async for chunk in wsgi.change_feed.stream_async(sub):
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+
+    async def wait_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(wait_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        wsgi.change_feed.unsubscribe(sub)
+
+
+ROUTES = {
+    ("POST", "/api/check_timeline"): check_timeline,
+    ("GET", "/api/stream_status"): stream_status,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            wsgi.start_background_jobs()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for client in list(async_http._clients.values()):
+                await client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        return await call_wsgi(scope, receive, send)
+    wsgi.start_background_jobs()
+    await handler(scope, receive, send)
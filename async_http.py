@@ -0,0 +1,122 @@
+"""http_client の asyncio 版 (asgi.py 用)。タイムアウト・リトライ・計測は同期版に揃える"""
+import asyncio
+import time
+from urllib.parse import urlsplit
+import httpx
+import gateway
+import http_client
+import metrics
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_TOTAL = 2
+RETRY_BACKOFF_SEC = 0.3
+
+_clients = {}     # イベントループ -> httpx.AsyncClient
+_host_limits = {} # (イベントループ, ホスト) -> asyncio.Semaphore
+_inflight = {}    # (イベントループ, リクエストキー) -> Task (同じリクエストの相乗り)
+
+
+def _client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        # プール全体の上限は同期版のホストごとの上限の合計にしておく
+        limit = sum(http_client.HOST_POOL_MAXSIZE.values())
+        client = _clients[loop] = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+            transport=httpx.AsyncHTTPTransport(retries=RETRY_TOTAL))
+    return client
+
+
+def _host_limit(url):
+    """ホストごとの同時接続数を同期版の HOST_POOL_MAXSIZE に合わせる"""
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    key = (asyncio.get_running_loop(), origin)
+    sem = _host_limits.get(key)
+    if sem is None:
+        sem = _host_limits[key] = asyncio.Semaphore(http_client.HOST_POOL_MAXSIZE.get(origin, http_client.DEFAULT_POOL_MAXSIZE))
+    return sem
+
+
+def _retry_after(res, attempt):
+    value = res.headers.get("Retry-After", "")
+    if value.isdigit(): return min(float(value), http_client.MAX_RETRY_AFTER_SEC)
+    return RETRY_BACKOFF_SEC * (2 ** attempt)
+
+
+async def get(url, params=None, headers=None, timeout=None):
+    """http_client.get と同じ引数・同じ計測・同じ gateway の扱いで、待っている間スレッドを占有しない"""
+    key = gateway.request_key(url, params)
+    host = urlsplit(url).netloc
+    loop = asyncio.get_running_loop()
+    task = _inflight.get((loop, key))
+    if task is not None:
+        metrics.gateway_result(host, "coalesced")
+    else:
+        # 取得は呼び出し元とは別のタスクで行う。ある呼び出し元が締め切りでキャンセルされても、
+        # 相乗りしている他のリクエストの分まで止めない
+        task = _inflight[(loop, key)] = loop.create_task(_guarded_get(key, host, url, params, headers, timeout))
+        task.add_done_callback(lambda t: _done(loop, key, t))
+    return await asyncio.shield(task)
+
+
+def _done(loop, key, task):
+    if _inflight.get((loop, key)) is task: del _inflight[(loop, key)]
+    # 待っていた呼び出し元が全員キャンセルされていても「未回収の例外」の警告を出さない
+    if not task.cancelled(): task.exception()
+
+
+async def _guarded_get(key, host, url, params, headers, timeout):
+    breaker = gateway.breaker(host)
+    if breaker.rejecting():
+        return gateway.fallback(key, host, gateway.CircuitOpen(host))
+    bucket = gateway.bucket(host)
+    if bucket and not await bucket.acquire_async(gateway.priority_of(http_client.endpoint_name(url))):
+        return gateway.fallback(key, host, gateway.RateLimited(host))
+    if not breaker.allow():
+        return gateway.fallback(key, host, gateway.CircuitOpen(host))
+    try:
+        res = await _send(url, params, headers, timeout)
+    except httpx.HTTPError as e:
+        breaker.failure()
+        return gateway.fallback(key, host, e)
+    except BaseException:
+        breaker.release_probe()
+        raise
+    if gateway.is_failure(res):
+        breaker.failure()
+        last = gateway.stale(key, host)
+        return res if last is None else last
+    breaker.success()
+    if res.status_code < 400: gateway.last_good.put(key, res)
+    return res
+
+
+async def _send(url, params, headers, timeout):
+    endpoint = http_client.endpoint_name(url)
+    connect, read = timeout or http_client.ENDPOINT_TIMEOUTS.get(endpoint, http_client.DEFAULT_TIMEOUT)
+    started = time.perf_counter()
+    res, outcome, retries = None, "error", 0
+    try:
+        async with _host_limit(url):
+            for attempt in range(RETRY_TOTAL + 1):
+                res = await _client().get(http_client.upstream_url(url), params=params, headers=headers,
+                                          timeout=httpx.Timeout(read, connect=connect))
+                if res.status_code not in RETRY_STATUS or attempt == RETRY_TOTAL: break
+                retries += 1
+                await asyncio.sleep(_retry_after(res, attempt))
+        outcome = "ok" if res.status_code < 400 else "http_error"
+        for hook in http_client.response_hooks:
+            hook(url, params, res)
+        return res
+    except httpx.TimeoutException:
+        outcome = "timeout"
+        raise
+    finally:
+        request_time = time.perf_counter() - started
+        http_client._record(endpoint, 0.0, 0, request_time, outcome)
+        metrics.record_upstream(endpoint, request_time, outcome,
+                                size=len(res.content) if res is not None else None, retries=retries)
+        if request_time >= http_client.SLOW_REQUEST_SEC:
+            print(f"Slow upstream {endpoint}: total={request_time * 1000:.0f}ms (async)")
@@ -0,0 +1,296 @@
+"""シェアサイクルの空き台数の履歴 (変化分だけの追記ログ) と、時間帯別の集計からの予測
+
+data/availability/
+  ports.json              ポートID の並び (列の番号 = ポート番号。追加のみ)
+  polls.u32               取得した時刻 (epoch 分)
+  t.u32 port.u16 bikes.u16 docks.u16
+                          前回の取得から変わったポートだけを1行ずつ追記する列ファイル
+  sum.f32 count.u32       (ポート番号, 週内の時間帯) ごとの台数の合計と件数 (memmap)
+
+書き込むのは1プロセスだけ (ファイルロックを取れたプロセス)。集計は memmap なので
+他のワーカーからもそのまま読める。
+"""
+import datetime
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+from background import BackgroundJob
+
+try:
+    import fcntl
+except ImportError:  # Windows では単一プロセス前提でロックしない
+    fcntl = None
+
+AVAILABILITY_DIR = os.getenv("AVAILABILITY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "availability"))
+# 取得間隔 (秒)。0 なら記録しない
+AVAILABILITY_POLL_SEC = float(os.getenv("AVAILABILITY_POLL_SEC", "60"))
+# 集計の時間帯の幅 (分)。週 7 日分を持つ
+BUCKET_MIN = 15
+BUCKETS = 7 * 24 * 60 // BUCKET_MIN
+# 集計を持てるポート数の上限 (ファイルはこの大きさで確保する)
+MAX_PORTS = int(os.getenv("AVAILABILITY_MAX_PORTS", "4096"))
+# 書き込み役になれなかったワーカーがロックを取り直す間隔 (秒)。書き込み役のプロセスが終わったら引き継ぐ
+WRITER_RETRY_SEC = 5 * 60
+# 時間帯の平均を信用する最低件数
+MIN_SAMPLES = 3
+# この台数以下になりそうなら「空になりそう」とみなす
+EMPTY_THRESHOLD = 0
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+CHANGE_COLUMNS = (("t", "t.u32", np.uint32), ("port", "port.u16", np.uint16), ("bikes", "bikes.u16", np.uint16), ("docks", "docks.u16", np.uint16))
+
+
+def bucket_of(epoch_min):
+    """epoch 分 -> 週内の時間帯番号 (月曜 0:00 JST 起点)。小数部は時間帯内の位置"""
+    local = datetime.datetime.fromtimestamp(epoch_min * 60, JST)
+    minute_of_week = local.weekday() * 24 * 60 + local.hour * 60 + local.minute
+    return minute_of_week / BUCKET_MIN
+
+
+class AvailabilityStore(BackgroundJob):
+    thread_name = "availability"
+
+    def __init__(self, snapshot, directory=AVAILABILITY_DIR, interval=AVAILABILITY_POLL_SEC):
+        self.snapshot = snapshot
+        self.dir = directory
+        self.interval = interval
+        self.port_ids = []
+        self.port_index = {}
+        self.last = None         # 直前に記録した (bikes, docks) 配列
+        self.last_status = None  # 直前に記録した snapshot.status (同じ取得結果を2回数えない)
+        self.writer = False
+        self._sum = None
+        self._count = None
+        self._ports_mtime = None
+        self._lock = threading.Lock()
+
+    # ---------------------------------------------------------
+    # ファイル
+    # ---------------------------------------------------------
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _open_aggregates(self, reopen=False):
+        """集計の memmap を開く。書き込み役なら r+、それ以外は r。
+        reopen=True なら開き直す (読み取り専用で開いた後に書き込み役になった時)"""
+        if self._sum is not None and not reopen: return True
+        os.makedirs(self.dir, exist_ok=True)
+        try:
+            for name, dtype in (("sum.f32", np.float32), ("count.u32", np.uint32)):
+                path = self._path(name)
+                size = MAX_PORTS * BUCKETS * np.dtype(dtype).itemsize
+                if not os.path.exists(path) or os.path.getsize(path) != size:
+                    if not self.writer: return False
+                    with open(path, "wb") as f:
+                        f.truncate(size)
+            mode = "r+" if self.writer else "r"
+            # 読み出し中のリクエストがあるので、両方開けてから差し替える
+            total = np.memmap(self._path("sum.f32"), dtype=np.float32, mode=mode, shape=(MAX_PORTS, BUCKETS))
+            count = np.memmap(self._path("count.u32"), dtype=np.uint32, mode=mode, shape=(MAX_PORTS, BUCKETS))
+            self._sum, self._count = total, count
+            return True
+        except (OSError, ValueError) as e:
+            print(f"Availability Store Error: {e}")
+            self._sum = self._count = None
+            return False
+
+    def _load_ports(self):
+        path = self._path("ports.json")
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime == self._ports_mtime: return
+            with open(path, encoding="utf-8") as f:
+                ids = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.port_ids, self.port_index, self._ports_mtime = ids, {p: i for i, p in enumerate(ids)}, mtime
+
+    def _save_ports(self):
+        tmp = self._path("ports.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.port_ids, f, ensure_ascii=False)
+        os.replace(tmp, self._path("ports.json"))
+        self._ports_mtime = os.path.getmtime(self._path("ports.json"))
+
+    def _append(self, name, values):
+        with open(self._path(name), "ab") as f:
+            f.write(np.ascontiguousarray(values).tobytes())
+
+    def changes(self):
+        """追記ログを列ごとの memmap で返す {t, port, bikes, docks}"""
+        columns = {}
+        for name, filename, dtype in CHANGE_COLUMNS:
+            path = self._path(filename)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            columns[name] = np.memmap(path, dtype=dtype, mode="r") if size else np.zeros(0, dtype=dtype)
+        n = min(len(c) for c in columns.values())  # 書き込み途中の行は見ない
+        return {name: c[:n] for name, c in columns.items()}
+
+    # ---------------------------------------------------------
+    # 書き込み
+    # ---------------------------------------------------------
+
+    def _acquire_writer(self):
+        os.makedirs(self.dir, exist_ok=True)
+        if fcntl is None: return True
+        self._lock_file = open(self._path("writer.lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self._lock_file.close()
+            return False
+
+    def enabled(self):
+        return self.interval > 0
+
+    def _run(self):
+        # 書き込み役は1プロセスだけ。他は時々ロックを取り直し、書き込み役が終わったら引き継ぐ
+        while not self.writer:
+            try:
+                self.writer = self._acquire_writer()
+            except OSError as e:
+                print(f"Availability Store Error: {e}")
+            if not self.writer: time.sleep(WRITER_RETRY_SEC)
+        # 先にリクエストが読み取り専用で開いていても書けるように開き直す
+        self._open_aggregates(reopen=True)
+        self._load_ports()
+        while True:
+            started = time.monotonic()
+            try:
+                self.snapshot.refresh()
+                self.record(self.snapshot.status)
+            except Exception as e:
+                print(f"Availability Record Error: {e}")
+            time.sleep(max(self.interval - (time.monotonic() - started), 1))
+
+    def record(self, status, now=None):
+        """station_status の1回分を記録する。前回と同じ取得結果なら何もしない"""
+        if not status or status is self.last_status or not self._open_aggregates(): return 0
+        epoch_min = int((now or time.time()) // 60)
+
+        new_ports = [p for p in status if p not in self.port_index]
+        if new_ports:
+            for p in new_ports:
+                if len(self.port_ids) >= MAX_PORTS: break
+                self.port_index[p] = len(self.port_ids)
+                self.port_ids.append(p)
+            self._save_ports()
+
+        n = len(self.port_ids)
+        bikes = np.zeros(n, dtype=np.uint16)
+        docks = np.zeros(n, dtype=np.uint16)
+        seen = np.zeros(n, dtype=bool)
+        for p, st in status.items():
+            i = self.port_index.get(p)
+            if i is None: continue
+            bikes[i] = st.get("num_bikes_available", 0)
+            docks[i] = st.get("num_docks_available", 0)
+            seen[i] = True
+
+        # 変化したポートだけを追記する (起動直後は全ポート)
+        if self.last is None or len(self.last[0]) != n:
+            changed = np.flatnonzero(seen)
+        else:
+            changed = np.flatnonzero(seen & ((bikes != self.last[0]) | (docks != self.last[1])))
+        if len(changed):
+            self._append("t.u32", np.full(len(changed), epoch_min, dtype=np.uint32))
+            self._append("port.u16", changed.astype(np.uint16))
+            self._append("bikes.u16", bikes[changed])
+            self._append("docks.u16", docks[changed])
+        self._append("polls.u32", np.array([epoch_min], dtype=np.uint32))
+
+        b = int(bucket_of(epoch_min))
+        ports = np.flatnonzero(seen)
+        self._sum[ports, b] += bikes[ports]
+        self._count[ports, b] += 1
+        self.last, self.last_status = (bikes, docks), status
+        return len(changed)
+
+    def rebuild(self):
+        """追記ログから集計を作り直す (時間帯の幅を変えた時など)"""
+        if not self._open_aggregates(): return
+        log = self.changes()
+        polls = np.fromfile(self._path("polls.u32"), dtype=np.uint32) if os.path.exists(self._path("polls.u32")) else np.zeros(0, np.uint32)
+        self._sum[:] = 0
+        self._count[:] = 0
+        bikes = np.zeros(MAX_PORTS, dtype=np.uint16)
+        seen = np.zeros(MAX_PORTS, dtype=bool)
+        # 変化の行は時刻順に並んでいるので、取得時刻ごとにそこまでの変化を反映してから数える
+        ends = np.searchsorted(log["t"], polls, side="right")
+        start = 0
+        for epoch_min, end in zip(polls.tolist(), ends.tolist()):
+            ports = log["port"][start:end]
+            bikes[ports] = log["bikes"][start:end]
+            seen[ports] = True
+            start = end
+            b = int(bucket_of(epoch_min))
+            self._sum[seen, b] += bikes[seen]
+            self._count[seen, b] += 1
+        self._sum.flush()
+        self._count.flush()
+
+    # ---------------------------------------------------------
+    # 読み出し
+    # ---------------------------------------------------------
+
+    def profile_mean(self, port, bucket):
+        """時間帯の平均台数 (前後の時間帯と線形補間)。件数不足なら None
+
+        各時間帯の平均はその15分間の平均なので、時間帯の始まりではなく真ん中 (bucket + 0.5) の値として補間する。
+        """
+        position = bucket - 0.5
+        base = math.floor(position)
+        lo = base % BUCKETS
+        hi = (lo + 1) % BUCKETS
+        frac = position - base
+        counts = self._count[port, [lo, hi]]
+        if counts.min() < MIN_SAMPLES: return None
+        means = self._sum[port, [lo, hi]] / counts
+        return float(means[0] * (1 - frac) + means[1] * frac)
+
+    def expected_bikes(self, port_id, bikes_now, docks_now=None, minutes=10, now=None):
+        """今の台数に、過去の同じ曜日・時間帯での増減を足した minutes 分後の見込み台数。分からなければ None"""
+        if self._sum is None and not self._open_aggregates(): return None
+        i = self.port_index.get(port_id)
+        if i is None:
+            self._load_ports()
+            i = self.port_index.get(port_id)
+            if i is None: return None
+        epoch_min = (now or time.time()) / 60
+        start = bucket_of(epoch_min)
+        mean_now = self.profile_mean(i, start)
+        mean_later = self.profile_mean(i, (start + minutes / BUCKET_MIN) % BUCKETS)
+        if mean_now is None or mean_later is None: return None
+        expected = bikes_now + (mean_later - mean_now)
+        capacity = bikes_now + docks_now if docks_now is not None else None
+        return round(min(max(expected, 0), capacity if capacity is not None else expected), 1)
+
+    def forecast(self, port_id, minutes=10):
+        """API 用: 現在の status と見込み台数"""
+        st = self.snapshot.port_status(port_id)
+        if st is None: return None
+        bikes, docks = st["num_bikes_available"], st["num_docks_available"]
+        expected = self.expected_bikes(port_id, bikes, docks, minutes)
+        return {"port": port_id, "minutes": minutes, "bikes_available": bikes, "docks_available": docks,
+                "expected_bikes": expected, "likely_empty": expected is not None and expected <= EMPTY_THRESHOLD}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="空き台数履歴の集計を追記ログから作り直す")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--dir", default=AVAILABILITY_DIR)
+    args = parser.parse_args()
+    store = AvailabilityStore(None, args.dir)
+    store.writer = True
+    store.rebuild()
+    print(f"Rebuilt aggregates in {args.dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""ワーカープロセスごとに1本だけ動かすバックグラウンドスレッド
+
+gunicorn --preload では import 時 (fork 前) に作ったオブジェクトを各ワーカーが引き継ぐが、スレッドは
+引き継がれない。起動したプロセスの pid を覚えておき、fork 後のプロセスでは改めて起動する。
+"""
+import os
+import threading
+
+_start_lock = threading.Lock()
+
+
+def _reset_start_lock():
+    # fork の瞬間に他のスレッドが持っていたロックを子プロセスに持ち込まない
+    global _start_lock
+    _start_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_start_lock)
+
+
+class BackgroundJob:
+    """ensure_started() で self._run を今のプロセスに1本だけ起動する mixin。
+
+    thread_name はスレッド名、enabled() が False なら起動しない (間隔 0 で止める設定など)。
+    """
+
+    thread_name = "background"
+    _job_pid = None
+
+    def enabled(self):
+        return True
+
+    def ensure_started(self):
+        if self._job_pid == os.getpid() or not self.enabled(): return
+        with _start_lock:
+            if self._job_pid == os.getpid(): return
+            self._job_pid = os.getpid()
+            threading.Thread(target=self._run, name=self.thread_name, daemon=True).start()
+
+    def _run(self):
+        raise NotImplementedError
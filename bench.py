@@ -0,0 +1,227 @@
+"""オフラインのレイテンシベンチマーク (上流は replay.py のスタブサーバーで再生)
+
+python bench.py                                   # 合成データ・アプリはプロセス内で起動
+python bench.py --fixtures fixtures/upstream.jsonl --scenarios scenarios.json
+python bench.py --latency "lognormal:80:400,nominatim.openstreetmap.org=fixed:300" -c 32 -n 500
+python bench.py --json bench_output.json --baseline previous.json   # p95 が悪化したら終了コード 1
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from replay import FixtureStore, LatencyProfile, make_server
+
+ODPT = "api.odpt.org"
+GBFS_HOST = "api-public.odpt.org"
+GBFS_PATH = "/api/v4/gbfs/docomo-cycle-tokyo"
+
+# 合成データの路線 (事業者, 路線ID, 駅数, 起点座標)
+SYNTHETIC_LINES = [
+    ("odpt.Operator:JR-East", "odpt.Railway:JR-East.Yamanote", 30, (35.690, 139.700)),
+    ("odpt.Operator:TokyoMetro", "odpt.Railway:TokyoMetro.Ginza", 19, (35.670, 139.702)),
+    ("odpt.Operator:Toei", "odpt.Railway:Toei.Oedo", 38, (35.691, 139.690)),
+]
+
+
+def synthetic_fixtures(ports=1700):
+    """LINES_DB の一部について、アプリが問い合わせる形のレスポンスを合成する"""
+    fixtures = []
+
+    def add(host, path, query, body):
+        fixtures.append({"host": host, "path": path, "query": query, "body": body})
+
+    by_operator = {}
+    for operator, railway, n, (lat0, lon0) in SYNTHETIC_LINES:
+        prefix = railway.split(":", 1)[1]
+        stations = [{
+            "owl:sameAs": f"odpt.Station:{prefix}.S{i:02d}",
+            "odpt:railway": railway,
+            "odpt:stationTitle": {"ja": f"{prefix.split('.')[-1]}{i}駅", "en": f"S{i:02d}"},
+            "geo:lat": lat0 + 0.004 * i, "geo:long": lon0 + 0.003 * (i % 7),
+        } for i in range(n)]
+        rail = {"owl:sameAs": railway, "odpt:operator": operator,
+                "odpt:stationOrder": [{"odpt:index": i + 1, "odpt:station": s["owl:sameAs"]} for i, s in enumerate(stations)]}
+        info = [{"odpt:railway": railway, "odpt:trainInformationText": {"ja": "平常運転"}}]
+        trains = [{"odpt:railway": railway, "odpt:delay": 60 * (i % 4)} for i in range(12)]
+        add(ODPT, "/api/v4/odpt:Railway", {"owl:sameAs": railway}, [rail])
+        add(ODPT, "/api/v4/odpt:Station", {"odpt:railway": railway}, stations)
+        add(ODPT, "/api/v4/odpt:TrainInformation", {"odpt:railway": railway}, info)
+        add(ODPT, "/api/v4/odpt:Train", {"odpt:railway": railway}, trains)
+        op = by_operator.setdefault(operator, {"rail": [], "stations": [], "info": [], "trains": []})
+        op["rail"].append(rail); op["stations"] += stations; op["info"] += info; op["trains"] += trains
+
+        for s in stations:
+            add(ODPT, "/api/v4/odpt:Station", {"owl:sameAs": s["owl:sameAs"]}, [s])
+            timetable = [{
+                "odpt:station": s["owl:sameAs"], "odpt:railway": railway, "odpt:calendar": f"odpt.Calendar:{cal}",
+                "odpt:stationTimetableObject": [{
+                    "odpt:departureTime": f"{(m // 60) % 24:02d}:{m % 60:02d}",
+                    "odpt:destinationStation": [stations[-1]["owl:sameAs"]],
+                    "odpt:trainType": "odpt.TrainType:Local",
+                } for m in range(5 * 60, 25 * 60, 4)],
+            } for cal in ("Weekday", "SaturdayHoliday")]
+            add(ODPT, "/api/v4/odpt:StationTimetable", {"odpt:station": s["owl:sameAs"], "odpt:railway": railway}, timetable)
+
+    for operator, op in by_operator.items():
+        add(ODPT, "/api/v4/odpt:Railway", {"odpt:operator": operator}, op["rail"])
+        add(ODPT, "/api/v4/odpt:Station", {"odpt:operator": operator}, op["stations"])
+        add(ODPT, "/api/v4/odpt:TrainInformation", {"odpt:operator": operator}, op["info"])
+        add(ODPT, "/api/v4/odpt:Train", {"odpt:operator": operator}, op["trains"])
+
+    cols = 50
+    port_info = [{"station_id": f"P{i:05d}", "name": f"ポート{i}",
+                  "lat": 35.60 + 0.003 * (i // cols), "lon": 139.62 + 0.004 * (i % cols)} for i in range(ports)]
+    port_status = [{"station_id": p["station_id"], "num_bikes_available": i % 9, "num_docks_available": 9 - i % 9}
+                   for i, p in enumerate(port_info)]
+    add(GBFS_HOST, f"{GBFS_PATH}/station_information.json", {}, {"ttl": 60, "data": {"stations": port_info}})
+    add(GBFS_HOST, f"{GBFS_PATH}/station_status.json", {}, {"ttl": 60, "data": {"stations": port_status}})
+    return fixtures
+
+
+def default_scenarios():
+    _, yamanote, _, _ = SYNTHETIC_LINES[0]
+    _, ginza, _, _ = SYNTHETIC_LINES[1]
+    route = [
+        {"line_id": yamanote, "line_name": "JR 山手線", "start_st_id": "odpt.Station:JR-East.Yamanote.S02",
+         "end_st_id": "odpt.Station:JR-East.Yamanote.S08", "time": "08:00", "calendar": "Weekday"},
+        {"line_id": ginza, "line_name": "東京メトロ 銀座線", "start_st_id": "odpt.Station:TokyoMetro.Ginza.S03",
+         "end_st_id": "odpt.Station:TokyoMetro.Ginza.S10", "time": "08:20", "calendar": "Weekday"},
+    ]
+    return [
+        {"name": "check_timeline", "method": "POST", "path": "/api/check_timeline?lat=35.69&lon=139.70&method=bike", "body": route},
+        {"name": "stations_list", "method": "GET", "path": f"/api/stations_list?line_id={yamanote}"},
+        {"name": "station_timetable", "method": "GET",
+         "path": f"/api/station_timetable?station_id=odpt.Station:JR-East.Yamanote.S05&line_id={yamanote}&time=08:00&calendar=Weekday"},
+    ]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values: return 0.0
+    k = max(min(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, len(sorted_values) - 1), 0)
+    return sorted_values[k]
+
+
+def run_scenario(base_url, scenario, concurrency, total):
+    local = threading.local()
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def one(_):
+        session = getattr(local, "session", None)
+        if session is None: session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            res = session.request(scenario["method"], base_url + scenario["path"], json=scenario.get("body"), timeout=30)
+            failed = res.status_code >= 500
+        except requests.RequestException:
+            failed = True
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if failed: errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total, "errors": errors[0], "rps": round(total / wall, 1),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+    }
+
+
+def start_app():
+    """アプリをプロセス内のスレッドサーバーで起動する (上流の向き先は環境変数で決まる)"""
+    from werkzeug.serving import WSGIRequestHandler, make_server as make_wsgi_server
+    import app as app_module
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_wsgi_server("127.0.0.1", 0, app_module.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def compare(results, baseline, tolerance):
+    """p95 が baseline より tolerance を超えて悪化したシナリオ名"""
+    regressed = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base and r["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RailBridge のオフライン負荷試験")
+    parser.add_argument("--fixtures", help="replay.py の記録 (省略時は合成データ)")
+    parser.add_argument("--scenarios", help="[{name, method, path, body}] の JSON (省略時は合成データ用)")
+    parser.add_argument("--latency", default="fixed:50", help="上流の遅延プロファイル (replay.LatencyProfile)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-n", "--requests", type=int, default=200, help="シナリオごとのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=5, help="計測前に流すリクエスト数")
+    parser.add_argument("--target", help="起動済みのアプリの URL (スタブは --stub-port で待ち受ける)")
+    parser.add_argument("--stub-port", type=int, default=0)
+    parser.add_argument("--json", help="結果を書き出すファイル")
+    parser.add_argument("--baseline", help="比較する以前の結果 (--json の出力)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="許容する p95 の悪化率")
+    args = parser.parse_args()
+
+    store = FixtureStore.load(args.fixtures) if args.fixtures else FixtureStore(synthetic_fixtures())
+    stub = make_server(store, LatencyProfile(args.latency), port=args.stub_port)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{stub.server_port}"
+
+    if args.target:
+        base_url = args.target.rstrip("/")
+        print(f"Stub upstream: {stub_url} (start the app with UPSTREAM_BASE_URL={stub_url})")
+    else:
+        # http_client / app を読み込む前に上流の向き先を差し替える
+        os.environ["UPSTREAM_BASE_URL"] = stub_url
+        # スタブの合成データをチェックアウトの data/ に書かない (後から起動したワーカーがそれで温まってしまう)
+        scratch = tempfile.mkdtemp()
+        os.environ.setdefault("TOPOLOGY_SNAPSHOT_PATH", os.path.join(scratch, "topology.json"))
+        os.environ.setdefault("SNAPSHOT_DIR", os.path.join(scratch, "snapshots"))
+        os.environ.setdefault("AVAILABILITY_DIR", os.path.join(scratch, "availability"))
+        base_url = start_app()
+
+    scenarios = default_scenarios()
+    if args.scenarios:
+        with open(args.scenarios, encoding="utf-8") as f:
+            scenarios = json.load(f)
+
+    results = {}
+    print(f"{'scenario':<20}{'reqs':>6}{'errs':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}  (ms, concurrency={args.concurrency}, latency={args.latency})")
+    for scenario in scenarios:
+        if args.warmup:
+            run_scenario(base_url, scenario, 1, args.warmup)
+        r = results[scenario["name"]] = run_scenario(base_url, scenario, args.concurrency, args.requests)
+        print(f"{scenario['name']:<20}{r['requests']:>6}{r['errors']:>6}{r['rps']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}")
+    if store.misses:
+        print(f"({store.misses} upstream requests had no fixture and got an empty response)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"concurrency": args.concurrency, "latency": args.latency, "results": results}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressed = compare(results, json.load(f)["results"], args.tolerance)
+        if regressed:
+            print(f"p95 regression (> {args.tolerance:.0%}): {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
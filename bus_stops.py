@@ -0,0 +1,142 @@
+"""GTFS から読み込むバス停インデックス (停留所 + 経由する路線・行き先)"""
+import csv
+import io
+import os
+import zipfile
+from geo import PointSet
+
+# GTFS (zip またはディレクトリ)。複数事業者分は os.pathsep 区切りで指定
+BUS_GTFS_PATH = os.getenv("BUS_GTFS_PATH", "")
+# 1停留所あたり返す路線数の上限
+MAX_ROUTES_PER_STOP = 5
+
+
+def gtfs_minutes(value):
+    """"HH:MM:SS" (24時を超えてもよい) -> 分。空なら None"""
+    if not value: return None
+    h, m, sec = value.strip().split(":")
+    return int(h) * 60 + int(m) + int(sec) / 60
+
+
+class _Feed:
+    """GTFS のファイルを zip / ディレクトリのどちらからでも行単位で読む"""
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+
+    def rows(self, name):
+        if self.zip:
+            if name not in self.zip.namelist(): return
+            with self.zip.open(name) as raw:
+                yield from csv.DictReader(io.TextIOWrapper(raw, encoding="utf-8-sig"))
+        else:
+            file_path = os.path.join(self.path, name)
+            if not os.path.exists(file_path): return
+            with open(file_path, encoding="utf-8-sig", newline="") as f:
+                yield from csv.DictReader(f)
+
+
+class BusStopIndex:
+    """バス停をグリッドに載せ、近傍検索に答える"""
+
+    def __init__(self):
+        self.stops = []   # (name, lat, lon, [(路線名, 行き先), ...])
+        self.points = PointSet([], [])
+        # 隣り合う停留所の区間 (停留所番号, 停留所番号) -> (最短の所要分, 路線名)。迂回経路の探索 (detour.py) 用
+        self.segments = {}
+
+    def __len__(self):
+        return len(self.stops)
+
+    def load_gtfs(self, path):
+        feed = _Feed(path)
+        agencies = {a.get("agency_id", ""): a.get("agency_name", "") for a in feed.rows("agency.txt")}
+
+        routes = {}
+        for r in feed.rows("routes.txt"):
+            agency = agencies.get(r.get("agency_id", ""), "") or next(iter(agencies.values()), "")
+            label = r.get("route_short_name") or r.get("route_long_name") or r["route_id"]
+            routes[r["route_id"]] = f"{agency} {label}".strip()
+
+        stops = {}
+        for s in feed.rows("stops.txt"):
+            if s.get("location_type") not in (None, "", "0"): continue
+            stops[s["stop_id"]] = (s["stop_name"], float(s["stop_lat"]), float(s["stop_lon"]))
+
+        trips = {}
+        for t in feed.rows("trips.txt"):
+            trips[t["trip_id"]] = (routes.get(t["route_id"], t["route_id"]), t.get("trip_headsign", ""))
+
+        # 行き先表示が無い便は終点の停留所名を行き先にする
+        if any(not headsign for _, headsign in trips.values()):
+            last_stop = {}
+            for st in feed.rows("stop_times.txt"):
+                seq = int(st["stop_sequence"])
+                if seq >= last_stop.get(st["trip_id"], (-1, None))[0]:
+                    last_stop[st["trip_id"]] = (seq, st["stop_id"])
+            for trip_id, (route, headsign) in trips.items():
+                if not headsign and trip_id in last_stop:
+                    end = stops.get(last_stop[trip_id][1])
+                    trips[trip_id] = (route, end[0] if end else "")
+
+        # 同じ (路線, 行き先) のタプルは共有してメモリを抑える
+        patterns = {}
+        stop_routes = {}
+        offset = len(self.stops)
+        stop_index = {stop_id: offset + i for i, stop_id in enumerate(stops)}
+        # stop_times.txt は便ごとに停車順で並んでいる前提で、直前の行と同じ便なら区間にする
+        prev = (None, -1, None, None)  # (trip_id, stop_sequence, 停留所番号, 発車分)
+        for st in feed.rows("stop_times.txt"):
+            trip = trips.get(st["trip_id"])
+            if not trip: continue
+            trip = patterns.setdefault(trip, trip)
+            stop_routes.setdefault(st["stop_id"], {})[trip] = None
+
+            seq, i = int(st["stop_sequence"]), stop_index.get(st["stop_id"])
+            arrival = gtfs_minutes(st.get("arrival_time"))
+            if prev[0] == st["trip_id"] and seq > prev[1] and None not in (i, prev[2], prev[3], arrival):
+                minutes = max(arrival - prev[3], 0.5)
+                key = (prev[2], i)
+                if key not in self.segments or minutes < self.segments[key][0]:
+                    self.segments[key] = (minutes, trip[0])
+            prev = (st["trip_id"], seq, i, gtfs_minutes(st.get("departure_time")) or arrival)
+
+        for stop_id, (name, lat, lon) in stops.items():
+            served = list(stop_routes.get(stop_id, {}))[:MAX_ROUTES_PER_STOP]
+            self.stops.append((name, lat, lon, served))
+        self.points = PointSet([s[1] for s in self.stops], [s[2] for s in self.stops])
+
+    def nearest(self, lat, lon, radius_km=0.5, k=10):
+        """半径内のバス停を近い順に最大 k 件"""
+        idx, dists = self.points.within(lat, lon, radius_km, k=k)
+        results = []
+        for i, dist_km in zip(idx.tolist(), dists.tolist()):
+            name, p_lat, p_lon, served = self.stops[i]
+            line, dest = served[0] if served else ("バス路線", "目的地")
+            results.append({
+                "type": "bus",
+                "name": name,
+                "lat": p_lat,
+                "lon": p_lon,
+                "line": line,
+                "destination": dest,
+                "routes": [{"line": l, "destination": d} for l, d in served],
+                "bikes_available": 99, # ダミー値
+                "docks_available": 99,
+                "dist": round(dist_km * 1000)
+            })
+        return results
+
+
+def load_bus_stop_index(paths=BUS_GTFS_PATH):
+    """GTFS が指定されていなければ None (Nominatim 検索にフォールバック)"""
+    paths = [p for p in paths.split(os.pathsep) if p]
+    if not paths: return None
+    index = BusStopIndex()
+    for path in paths:
+        try:
+            index.load_gtfs(path)
+        except Exception as e:
+            print(f"Bus GTFS Load Error ({path}): {e}")
+    return index if len(index) else None
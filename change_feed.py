@@ -0,0 +1,184 @@
+"""購読中のトピック (路線・ポート) の変化だけを配信する共有チェンジフィード"""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from background import BackgroundJob
+
+# 変化を確認する間隔 (秒)
+FEED_INTERVAL_SEC = float(os.getenv("FEED_INTERVAL_SEC", "15"))
+# 1プロセスあたりの購読者数の上限
+FEED_MAX_SUBSCRIBERS = int(os.getenv("FEED_MAX_SUBSCRIBERS", "2000"))
+# WSGI (gunicorn gthread) では購読者1人が接続中ずっとスレッドを1本占有する。
+# --threads 64 を使い切らないよう小さく抑える (大勢に配信するなら asgi.py で動かす)
+FEED_MAX_WSGI_SUBSCRIBERS = int(os.getenv("FEED_MAX_WSGI_SUBSCRIBERS", "8"))
+# 何も無い時に接続維持のコメントを送る間隔 (秒)
+HEARTBEAT_SEC = 20
+# 読み出されずに溜まったイベントがこれを超えた購読者は切断する
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class Subscriber:
+    """loop を渡すと asyncio.Queue で受け取る (更新スレッドからは call_soon_threadsafe で入れる)"""
+
+    __slots__ = ("topics", "queue", "closed", "blocking", "loop")
+
+    def __init__(self, topics, blocking=False, loop=None):
+        self.topics = topics
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE) if loop else queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.closed = False
+        self.blocking = blocking  # スレッドを占有して配信する (WSGI)
+
+
+class ChangeFeed(BackgroundJob):
+    """トピックごとに値を読んで前回と比較し、変わったものだけを購読者に送る。
+
+    readers = {種別: 関数(キー) -> {イベント名: (比較する値, ペイロード)}}。
+    比較する値が前回と変わった時だけペイロードを送る。
+    値の取得はトピック単位なので、購読者が何人いても上流への問い合わせは増えない。
+    """
+
+    thread_name = "change-feed"
+
+    def __init__(self, readers, interval=FEED_INTERVAL_SEC):
+        self.readers = readers
+        self.interval = interval
+        self.last = {}          # (種別, キー, イベント名) -> (比較する値, ペイロード)
+        self.subscribers = {}   # (種別, キー) -> set(Subscriber)
+        self.count = 0
+        self.blocking_count = 0
+        self._lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"Change Feed Error: {e}")
+            time.sleep(max(self.interval - (time.monotonic() - started), 1))
+
+    def poll_once(self):
+        with self._lock:
+            topics = [t for t, subs in self.subscribers.items() if subs]
+        for topic in topics:
+            self._refresh_topic(topic)
+
+    def _refresh_topic(self, topic):
+        kind, key = topic
+        try:
+            values = self.readers[kind](key)
+        except Exception as e:
+            print(f"Change Feed Read Error ({kind} {key}): {e}")
+            return
+        for event, (diff_value, payload) in values.items():
+            last_key = (kind, key, event)
+            last = self.last.get(last_key)
+            if last and last[0] == diff_value: continue
+            self.last[last_key] = (diff_value, payload)
+            self._publish(topic, event, payload)
+
+    def _publish(self, topic, event, payload):
+        with self._lock:
+            subs = list(self.subscribers.get(topic, ()))
+        for sub in subs:
+            self._deliver(sub, (event, payload))
+
+    def _deliver(self, sub, item):
+        if sub.loop is None:
+            try:
+                sub.queue.put_nowait(item)
+            except queue.Full:
+                # 読まない購読者は切る (接続側で再接続してもらう)
+                self.unsubscribe(sub)
+            return
+        try:
+            sub.loop.call_soon_threadsafe(self._deliver_async, sub, item)
+        except RuntimeError:  # イベントループが終わっている
+            self.unsubscribe(sub)
+
+    def _deliver_async(self, sub, item):
+        """イベントループ上で呼ばれる"""
+        if sub.closed: return
+        try:
+            sub.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.unsubscribe(sub)
+            # 溜まった分を捨てて終わりの印を入れ、待っている stream_async をすぐ起こす
+            while not sub.queue.empty():
+                sub.queue.get_nowait()
+            sub.queue.put_nowait(None)
+
+    def subscribe(self, topics, blocking=False, loop=None):
+        """上限を超えていれば None。blocking=True (stream で配信) は FEED_MAX_WSGI_SUBSCRIBERS も見る。
+        stream_async で配信するなら、そのイベントループを loop に渡す"""
+        sub = Subscriber(set(topics), blocking, loop)
+        with self._lock:
+            if self.count >= FEED_MAX_SUBSCRIBERS: return None
+            if blocking and self.blocking_count >= FEED_MAX_WSGI_SUBSCRIBERS: return None
+            self.count += 1
+            if blocking: self.blocking_count += 1
+            for topic in sub.topics:
+                self.subscribers.setdefault(topic, set()).add(sub)
+        # 既に分かっている値を最初に送り、まだ読んでいないトピックはその場で読む
+        known = set()
+        for (kind, key, event), (_, payload) in list(self.last.items()):
+            if (kind, key) in sub.topics:
+                known.add((kind, key))
+                self._deliver(sub, (event, payload))
+        for topic in sub.topics - known:
+            self._refresh_topic(topic)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub.closed: return
+            sub.closed = True
+            self.count -= 1
+            if sub.blocking: self.blocking_count -= 1
+            for topic in sub.topics:
+                subs = self.subscribers.get(topic)
+                if subs is None: continue
+                subs.discard(sub)
+                if not subs:
+                    del self.subscribers[topic]
+                    for event_key in [k for k in list(self.last) if k[:2] == topic]:
+                        self.last.pop(event_key, None)
+
+    def stream(self, sub):
+        """Server-Sent Events の本文を生成する"""
+        try:
+            yield "retry: 5000\n\n"
+            while not sub.closed:
+                try:
+                    event, payload = sub.queue.get(timeout=HEARTBEAT_SEC)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield sse_event(event, payload)
+        finally:
+            self.unsubscribe(sub)
+
+    async def stream_async(self, sub):
+        """stream の asyncio 版 (asgi.py 用)。sub は loop を渡して購読したもの。
+        イベントが届くまで待つだけなので、何も起きない購読者はイベントループを起こさない (心拍を除く)"""
+        try:
+            yield "retry: 5000\n\n"
+            while not sub.closed:
+                try:
+                    item = await asyncio.wait_for(sub.queue.get(), HEARTBEAT_SEC)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if item is None: break
+                event, payload = item
+                yield sse_event(event, payload)
+        finally:
+            self.unsubscribe(sub)
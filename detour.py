@@ -0,0 +1,361 @@
+"""駅・シェアサイクルポート・バス停をつないだ乗り換えグラフと、運行状況を反映した迂回経路の探索 (A*)
+
+ノードは「歩いて居る場所」(walk) と「乗っている状態」(ride) の2層に分ける。
+  walk <-> walk   徒歩 (近いノード同士)
+  walk -> ride    乗車 (駅・バス停は平均の待ち時間、ポートは貸出の手間。貸出できないポートは通れない)
+  ride -> ride    鉄道 (路線の隣駅)・バス (GTFS の隣の停留所)・自転車 (近いポート同士)
+  ride -> walk    降車 (ポートは返却できる時だけ)
+グラフはトポロジーとポート一覧が変わった時だけ作り直し、辺の重みは運行状況・空き台数が変わった時だけ計算し直す。
+"""
+import heapq
+import math
+import time
+import numpy as np
+from background import BackgroundJob
+from geo import PointSet, haversine_km
+
+WALK_KMH = 4.8
+BIKE_KMH = 15.0
+# 駅間は直線距離をこの速度 (停車時間込みの表定速度) で走るとみなす
+RAIL_KMH = 40.0
+# 道なりの距離 / 直線距離
+ROAD_FACTOR = 1.3
+# 乗り換えの徒歩でつなぐ範囲と本数
+WALK_LINK_KM = 0.4
+WALK_LINK_K = 8
+# 出発地・目的地から歩いて行けるノードの範囲
+ACCESS_KM = 0.8
+# 自転車で1辺としてつなぐポートの範囲と本数 (遠くへは途中のポートを経由して進む)
+BIKE_LINK_KM = 1.5
+BIKE_LINK_K = 10
+# 乗車・貸出・返却にかかる分
+RAIL_WAIT_MIN = 3.0
+BUS_WAIT_MIN = 6.0
+BIKE_RENT_MIN = 2.0
+BIKE_RETURN_MIN = 1.0
+# 遅延扱いの路線に足す分の下限 (遅れの分数が分からない時)
+ALERT_DELAY_MIN = 10.0
+# 運行情報テキストにこれらが含まれる路線は通れないものとする
+CLOSED_WORDS = ("見合わせ", "運休")
+# トポロジー・ポート一覧の変化を確認する間隔 (秒)
+DETOUR_REBUILD_CHECK_SEC = 60
+
+INF = math.inf
+STATION, PORT, BUS_STOP = 0, 1, 2
+WALK, BOARD, ALIGHT, RAIL, BUS, BIKE = range(6)
+MODE_NAMES = {WALK: "walk", RAIL: "rail", BUS: "bus", BIKE: "bike"}
+
+
+def line_penalty(status_text, realtime_info, alert):
+    """運行状況 -> その路線に乗る時に足す分。止まっている路線は None"""
+    if status_text and any(w in status_text for w in CLOSED_WORDS): return None
+    delay = float((realtime_info or {}).get("max_delay") or 0)
+    return max(delay, ALERT_DELAY_MIN) if alert else delay
+
+
+class TransferGraph:
+    """CSR 形式の有向グラフ。構築後は読み取り専用"""
+
+    def __init__(self, topology, ports, port_info, bus_stop_index):
+        self.names, lats, lons, self.kinds, self.refs = [], [], [], [], []
+        src, dst, minutes, modes, lines = [], [], [], [], []
+
+        def node(name, lat, lon, kind, ref):
+            self.names.append(name)
+            lats.append(lat)
+            lons.append(lon)
+            self.kinds.append(kind)
+            self.refs.append(ref)
+            return len(self.names) - 1
+
+        def edge(a, b, m, mode, line=-1):
+            src.append(a)
+            dst.append(b)
+            minutes.append(m)
+            modes.append(mode)
+            lines.append(line)
+
+        walk_nodes = []
+        # 駅 (座標の無い駅は使わない)。駅 ID は路線ごとなので、乗車の辺にその路線を持たせて遅れを足す
+        self.railways = sorted(topology.railways) if topology else []
+        station_ride = {}
+        if topology:
+            station_line = {}
+            for line, railway_id in enumerate(self.railways):
+                for i in topology.railways[railway_id]:
+                    station_line.setdefault(i, line)
+            for i, name in enumerate(topology.names):
+                lat, lon = topology.lat[i], topology.lon[i]
+                if math.isnan(lat) or math.isnan(lon): continue
+                w = node(name, lat, lon, STATION, topology.ids[i])
+                r = node(name, lat, lon, STATION, topology.ids[i])
+                edge(w, r, RAIL_WAIT_MIN, BOARD, station_line.get(i, -1))
+                edge(r, w, 0.0, ALIGHT)
+                walk_nodes.append(w)
+                station_ride[i] = r
+            for line, railway_id in enumerate(self.railways):
+                idxs = [i for i in topology.railways[railway_id] if i in station_ride]
+                for a, b in zip(idxs, idxs[1:]):
+                    m = self._ride_minutes(lats, lons, station_ride[a], station_ride[b], RAIL_KMH)
+                    edge(station_ride[a], station_ride[b], m, RAIL, line)
+                    edge(station_ride[b], station_ride[a], m, RAIL, line)
+
+        # ポート (ref は station_id。貸出・返却できるかは重みの計算時に見る)
+        ids, points, _ = ports
+        port_ride = []
+        for n, port_id in enumerate(ids):
+            lat, lon = float(points.lats[n]), float(points.lons[n])
+            name = (port_info.get(port_id) or {}).get("name", port_id)
+            w = node(name, lat, lon, PORT, port_id)
+            r = node(name, lat, lon, PORT, port_id)
+            edge(w, r, BIKE_RENT_MIN, BOARD)
+            edge(r, w, BIKE_RETURN_MIN, ALIGHT)
+            walk_nodes.append(w)
+            port_ride.append(r)
+        for n, r in enumerate(port_ride):
+            idx, dists = points.within(points.lats[n], points.lons[n], BIKE_LINK_KM, k=BIKE_LINK_K + 1)
+            for m, dist_km in zip(idx.tolist(), dists.tolist()):
+                if m != n: edge(r, port_ride[m], dist_km * ROAD_FACTOR / BIKE_KMH * 60, BIKE)
+
+        # バス停 (GTFS の区間がある時だけ)
+        self.bus_lines = []
+        if bus_stop_index is not None and getattr(bus_stop_index, "segments", None):
+            stop_ride = {}
+            for i, (name, lat, lon, _) in enumerate(bus_stop_index.stops):
+                w = node(name, lat, lon, BUS_STOP, i)
+                r = node(name, lat, lon, BUS_STOP, i)
+                edge(w, r, BUS_WAIT_MIN, BOARD)
+                edge(r, w, 0.0, ALIGHT)
+                walk_nodes.append(w)
+                stop_ride[i] = r
+            line_index = {}
+            for (a, b), (m, line_name) in bus_stop_index.segments.items():
+                line = line_index.setdefault(line_name, len(line_index))
+                # 直線距離を RAIL_KMH より速く進む区間は A* の見積もりを壊すので切り上げる
+                m = max(m, self._ride_minutes(lats, lons, stop_ride[a], stop_ride[b], RAIL_KMH))
+                edge(stop_ride[a], stop_ride[b], m, BUS, line)
+            self.bus_lines = list(line_index)
+
+        self.lats = np.array(lats, dtype=np.float64)
+        self.lons = np.array(lons, dtype=np.float64)
+
+        # 徒歩 (近い walk ノード同士。乗り換えもこれで表す)
+        walk_nodes = np.array(walk_nodes, dtype=np.int64)
+        walk_points = PointSet(self.lats[walk_nodes], self.lons[walk_nodes])
+        self.walk_nodes, self.walk_points = walk_nodes, walk_points
+        linked = set()
+        for n in range(len(walk_nodes)):
+            idx, dists = walk_points.within(walk_points.lats[n], walk_points.lons[n], WALK_LINK_KM, k=WALK_LINK_K + 1)
+            for m, dist_km in zip(idx.tolist(), dists.tolist()):
+                if m == n: continue
+                a, b = int(walk_nodes[n]), int(walk_nodes[m])
+                if (a, b) in linked: continue
+                linked.add((a, b))
+                linked.add((b, a))
+                edge(a, b, self.walk_minutes(dist_km), WALK)
+                edge(b, a, self.walk_minutes(dist_km), WALK)
+
+        # CSR に並べ替える
+        src = np.array(src, dtype=np.int64)
+        order = np.argsort(src, kind="stable")
+        self.indptr = np.searchsorted(src[order], np.arange(len(self.names) + 1)).tolist()
+        self.dst = np.array(dst, dtype=np.int64)[order]
+        self.src = src[order]
+        self.minutes = np.array(minutes, dtype=np.float64)[order]
+        self.modes = np.array(modes, dtype=np.int8)[order]
+        self.lines = np.array(lines, dtype=np.int64)[order]
+        self.dst_list = self.dst.tolist()
+        self.src_list = self.src.tolist()
+        self.kinds = np.array(self.kinds, dtype=np.int8)
+
+    @staticmethod
+    def walk_minutes(dist_km):
+        return dist_km * ROAD_FACTOR / WALK_KMH * 60
+
+    @staticmethod
+    def _ride_minutes(lats, lons, a, b, kmh):
+        return float(haversine_km(lats[a], lons[a], lats[b], lons[b])) / kmh * 60
+
+    def __len__(self):
+        return len(self.names)
+
+    def weights(self, line_penalties, port_status, modes):
+        """運行状況・空き台数・使う手段を反映した辺の重み (list)。通れない辺は INF"""
+        w = self.minutes.copy()
+        # 鉄道: 止まっている路線は通れない、遅れている路線は乗る時に遅れの分を足す
+        penalties = [line_penalties.get(rid, 0.0) for rid in self.railways]
+        closed = np.array([p is None for p in penalties] + [False], dtype=bool)
+        delay = np.array([p or 0.0 for p in penalties] + [0.0], dtype=np.float64)
+        # 路線番号 -1 (路線の分からない駅) は末尾の「路線なし」を指す
+        rail = np.flatnonzero(self.modes == RAIL)
+        w[rail[closed[self.lines[rail]]]] = INF
+        board = np.flatnonzero((self.modes == BOARD) & (self.kinds[self.src] == STATION))
+        w[board] += delay[self.lines[board]]
+
+        # ポート: 貸出できない所では乗れない、返却できない所では降りられない
+        kind_src, kind_dst = self.kinds[self.src], self.kinds[self.dst]
+        port_board = (self.modes == BOARD) & (kind_src == PORT)
+        port_alight = (self.modes == ALIGHT) & (kind_src == PORT)
+        for mask, field in ((port_board, "num_bikes_available"), (port_alight, "num_docks_available")):
+            edges = np.flatnonzero(mask)
+            ok = np.fromiter(((port_status.get(self.refs[i]) or {}).get(field, 0) > 0 for i in self.src[edges].tolist()),
+                             dtype=bool, count=len(edges))
+            w[edges[~ok]] = INF
+
+        # 使わない手段の層には入らない
+        for kind, mode in ((PORT, BIKE), (BUS_STOP, BUS)):
+            if mode not in modes:
+                w[(kind_src == kind) | (kind_dst == kind)] = INF
+        return w.tolist()
+
+    def search(self, weights, origin, dest, max_minutes=180):
+        """origin/dest = (lat, lon)。最短の (分, [辺番号], 最初のノード, 最後のノード)。見つからなければ None"""
+        sources = self._access(origin)
+        targets = dict(self._access(dest))
+        if not sources or not targets: return None
+        # 見積もり: 目的地までの直線距離を一番速い手段で進む分 (どの辺もこれより速くはない)
+        h = (haversine_km(dest[0], dest[1], self.lats, self.lons) / RAIL_KMH * 60).tolist()
+
+        goal = len(self.names)
+        dist = [INF] * (goal + 1)
+        prev = [-1] * (goal + 1)  # ノード -> 来た辺の番号 (goal だけは最後のノード)
+        heap = []
+        for n, m in sources:
+            if m < dist[n]:
+                dist[n] = m
+                heapq.heappush(heap, (m + h[n], m, n))
+        indptr, dst_list = self.indptr, self.dst_list
+        while heap:
+            _, g, n = heapq.heappop(heap)
+            if n == goal:
+                edges, node = [], prev[goal]
+                while prev[node] >= 0:
+                    edges.append(prev[node])
+                    node = self.src_list[prev[node]]
+                edges.reverse()
+                return g, edges, node, prev[goal]
+            if g > dist[n] or g > max_minutes: continue
+            egress = targets.get(n)
+            if egress is not None and g + egress < dist[goal]:
+                dist[goal] = g + egress
+                prev[goal] = n
+                heapq.heappush(heap, (g + egress, g + egress, goal))
+            for e in range(indptr[n], indptr[n + 1]):
+                w = weights[e]
+                if w == INF: continue
+                m, nd = dst_list[e], g + w
+                if nd < dist[m]:
+                    dist[m] = nd
+                    prev[m] = e
+                    heapq.heappush(heap, (nd + h[m], nd, m))
+        return None
+
+    def _access(self, point):
+        """地点から歩いて行ける walk ノードと徒歩の分"""
+        idx, dists = self.walk_points.within(point[0], point[1], ACCESS_KM)
+        return [(int(self.walk_nodes[i]), self.walk_minutes(d)) for i, d in zip(idx.tolist(), dists.tolist())]
+
+    def legs(self, found, weights, origin, origin_name, dest_name, line_names):
+        """search の結果を手段ごとの区間にまとめる"""
+        minutes, edges, first, last = found
+        name = self.names
+
+        def line_name(e):
+            if self.modes[e] == RAIL: return line_names.get(self.railways[self.lines[e]], self.railways[self.lines[e]])
+            if self.modes[e] == BUS: return self.bus_lines[self.lines[e]]
+            return None
+
+        legs = []
+        # 出発地からの徒歩・目的地までの徒歩は端の区間として足す
+        start = self.walk_minutes(float(haversine_km(origin[0], origin[1], self.lats[first], self.lons[first])))
+        legs.append({"mode": "walk", "line": None, "from": origin_name, "to": name[first], "minutes": start})
+        pending = 0.0  # 乗車待ち・貸出の分は次の乗車区間に含める
+        for e in edges:
+            mode = int(self.modes[e])
+            a, b = int(self.src[e]), int(self.dst[e])
+            if mode == BOARD:
+                pending += weights[e]
+                continue
+            if mode == ALIGHT:
+                legs[-1]["minutes"] += weights[e]
+                continue
+            line = line_name(e)
+            last_leg = legs[-1]
+            cost = weights[e] + pending
+            pending = 0.0
+            if last_leg["mode"] == MODE_NAMES[mode] and last_leg["line"] == line:
+                last_leg["to"] = name[b]
+                last_leg["minutes"] += cost
+            else:
+                legs.append({"mode": MODE_NAMES[mode], "line": line, "from": name[a], "to": name[b], "minutes": cost})
+        end = minutes - sum(leg["minutes"] for leg in legs)
+        if legs[-1]["mode"] == "walk": legs[-1].update(to=dest_name, minutes=legs[-1]["minutes"] + end)
+        else: legs.append({"mode": "walk", "line": None, "from": name[last], "to": dest_name, "minutes": end})
+        for leg in legs:
+            leg["minutes"] = round(leg["minutes"], 1)
+        return [leg for leg in legs if leg["mode"] != "walk" or leg["minutes"] > 0]
+
+
+class DetourPlanner(BackgroundJob):
+    """トポロジー・ポート一覧が変わったらグラフを作り直し、運行状況ごとの重みをキャッシュする"""
+
+    thread_name = "detour-graph"
+
+    def __init__(self, topology_store, gbfs_snapshot, bus_stop_index=None, line_names=None, interval=DETOUR_REBUILD_CHECK_SEC):
+        self.topology_store = topology_store
+        self.gbfs_snapshot = gbfs_snapshot
+        self.bus_stop_index = bus_stop_index
+        self.line_names = line_names or {}
+        self.interval = interval
+        self.graph = None
+        self.version = None
+        self._weights = None  # (キー, 重み)
+
+    def _run(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception as e:
+                print(f"Detour Graph Error: {e}")
+            time.sleep(self.interval)
+
+    def rebuild(self, refresh=True):
+        """トポロジーかポート一覧が変わっていれば作り直す。refresh=False なら手元のポート一覧だけで作る (起動時)"""
+        if refresh:
+            try:
+                self.gbfs_snapshot.refresh()
+            except Exception as e:
+                print(f"Detour Graph GBFS Error: {e}")
+        topology = self.topology_store.current
+        ports = self.gbfs_snapshot.ports
+        # ポート一覧は station_information を読み直した時だけ変わる (id() は使い回されるので取得時刻で見る)
+        version = (topology.version if topology else None, self.gbfs_snapshot.info_at)
+        if self.graph is not None and version == self.version: return False
+        started = time.perf_counter()
+        graph = TransferGraph(topology, ports, self.gbfs_snapshot.info, self.bus_stop_index)
+        self.graph, self.version, self._weights = graph, version, None
+        print(f"Detour graph: {len(graph)} nodes, {len(graph.dst_list)} edges ({time.perf_counter() - started:.1f}s)")
+        return True
+
+    def weights(self, graph, line_penalties, modes):
+        # 取得時刻を先に読む (間で status が新しくなっても、次の呼び出しで作り直すだけで済む)
+        status_at = self.gbfs_snapshot.status_at
+        status = self.gbfs_snapshot.status
+        key = (tuple(sorted(line_penalties.items(), key=lambda item: item[0])), status_at, tuple(sorted(modes)))
+        cached = self._weights
+        if cached is not None and cached[0] is graph and cached[1] == key: return cached[2]
+        weights = graph.weights(line_penalties, status, modes)
+        self._weights = (graph, key, weights)
+        return weights
+
+    def plan(self, origin, dest, line_penalties, method="bike", origin_name="出発地", dest_name="目的地"):
+        """origin/dest = {"lat", "lon"}。{"minutes", "legs": [{mode, line, from, to, minutes}]} か None"""
+        if not origin or not dest or None in (origin.get("lat"), origin.get("lon"), dest.get("lat"), dest.get("lon")): return None
+        graph = self.graph
+        if graph is None or not len(graph): return None
+        modes = {WALK, RAIL, BUS if method == "bus" else BIKE}
+        weights = self.weights(graph, line_penalties, modes)
+        o, d = (float(origin["lat"]), float(origin["lon"])), (float(dest["lat"]), float(dest["lon"]))
+        found = graph.search(weights, o, d)
+        if found is None: return None
+        return {"minutes": round(found[0]), "legs": graph.legs(found, weights, o, origin_name, dest_name, self.line_names)}
@@ -0,0 +1,71 @@
+"""1リクエスト内の独立した上流呼び出しを共有スレッドプール (または asyncio) で並列実行する"""
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import metrics
+
+FANOUT_MAX_WORKERS = int(os.getenv("FANOUT_MAX_WORKERS", "32"))
+
+_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix="fanout")
+
+
+class Deadline:
+    """リクエスト単位の締め切り"""
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0)
+
+
+def gather(calls, deadline, defaults=None):
+    """calls = {key: (func, *args)} をまとめて実行し {key: 結果} を返す。
+
+    締め切りまでに終わらなかった/失敗した呼び出しは defaults[key[0]] で埋め、
+    そのキーを2つ目の戻り値で返す (部分結果)。
+    """
+    defaults = defaults or {}
+    # 呼び出し元のリクエストの計測 (metrics.Trace) を引き継ぐ
+    futures = {key: _executor.submit(contextvars.copy_context().run, fn, *args) for key, (fn, *args) in calls.items()}
+    done, pending = wait(futures.values(), timeout=deadline.remaining())
+    # まだ始まっていない呼び出しは取り消す (返した後のリクエストの分でプールが詰まらないように)
+    for fut in pending:
+        fut.cancel()
+
+    results = {}
+    missing = []
+    for key, fut in futures.items():
+        if fut in done and fut.exception() is None:
+            results[key] = fut.result()
+        else:
+            if fut in done: print(f"Fanout Error {key}: {fut.exception()}")
+            metrics.fanout_missing(key[0], "error" if fut in done else "timeout")
+            results[key] = defaults.get(key[0])
+            missing.append(key)
+    return results, missing
+
+
+async def gather_async(calls, deadline, defaults=None):
+    """gather のコルーチン版。calls = {key: (async 関数, *args)}"""
+    defaults = defaults or {}
+    tasks = {key: asyncio.ensure_future(fn(*args)) for key, (fn, *args) in calls.items()}
+    if tasks:
+        _, pending = await asyncio.wait(tasks.values(), timeout=deadline.remaining())
+        for task in pending:
+            task.cancel()
+
+    results = {}
+    missing = []
+    for key, task in tasks.items():
+        if task.done() and not task.cancelled() and task.exception() is None:
+            results[key] = task.result()
+        else:
+            failed = task.done() and not task.cancelled()
+            if failed: print(f"Fanout Error {key}: {task.exception()}")
+            metrics.fanout_missing(key[0], "error" if failed else "timeout")
+            results[key] = defaults.get(key[0])
+            missing.append(key)
+    return results, missing
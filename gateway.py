@@ -0,0 +1,280 @@
+"""上流ホストごとの流量制御 (トークンバケット + 優先度)、同一リクエストの相乗り、サーキットブレーカー
+
+http_client / async_http の手前で使う。ODPT のキー単位の上限や Nominatim の 1 req/s を超えないように
+待たせ、待ちきれない・上流が落ちている時は最後に成功したレスポンスを返す。
+"""
+import asyncio
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+import requests
+import metrics
+
+# ホストごとの "毎秒の本数:バースト"。UPSTREAM_RATE_LIMITS="api.odpt.org=20:40,..." で上書き
+DEFAULT_RATE_LIMITS = {
+    "api.odpt.org": (20.0, 40),
+    "api-public.odpt.org": (10.0, 20),
+    "nominatim.openstreetmap.org": (1.0, 1),
+}
+
+# 優先度 (小さいほど先)。運行情報・空き台数 > 駅・時刻表などの参照データ > ジオコーディング
+PRIORITY_LIVE, PRIORITY_REFERENCE, PRIORITY_GEOCODE = 0, 1, 2
+ENDPOINT_PRIORITY = {
+    "odpt:TrainInformation": PRIORITY_LIVE,
+    "odpt:Train": PRIORITY_LIVE,
+    "station_status.json": PRIORITY_LIVE,
+    "search": PRIORITY_GEOCODE,
+}
+# 優先度ごとに順番待ちする上限 (秒)。超えたら RateLimited
+MAX_QUEUE_WAIT_SEC = {PRIORITY_LIVE: 2.0, PRIORITY_REFERENCE: 5.0, PRIORITY_GEOCODE: 10.0}
+
+# 連続してこの回数失敗したホストは CIRCUIT_COOLDOWN_SEC の間呼ばない
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))
+CIRCUIT_COOLDOWN_SEC = float(os.getenv("CIRCUIT_COOLDOWN_SEC", "30"))
+# 最後に成功したレスポンスを覚えておく件数 (リクエスト単位)
+LAST_GOOD_SIZE = int(os.getenv("UPSTREAM_LAST_GOOD_SIZE", "512"))
+# 相乗りしたリクエストが先行の完了を待つ上限 (秒)
+COALESCE_WAIT_SEC = 30
+
+
+class RateLimited(requests.RequestException):
+    """順番待ちの上限を超えた"""
+
+
+class CircuitOpen(requests.RequestException):
+    """ホストが連続して失敗しているので呼ばなかった"""
+
+
+class StaleResponse(requests.RequestException):
+    """上流から取れず、最後に成功したレスポンスしか無かった (取得時刻を進めてはいけない)"""
+
+
+def _parse_rate_limits(spec):
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        host, value = part.split("=", 1)
+        rate, _, burst = value.partition(":")
+        limits[host] = (float(rate), int(burst or max(float(rate), 1)))
+    return limits
+
+
+RATE_LIMITS = _parse_rate_limits(os.getenv("UPSTREAM_RATE_LIMITS", ""))
+
+
+def priority_of(endpoint):
+    return ENDPOINT_PRIORITY.get(endpoint, PRIORITY_REFERENCE)
+
+
+def request_key(url, params):
+    """同じ URL + クエリなら同じキー (相乗りと最終成功値の単位)"""
+    return url + "?" + "&".join(f"{k}={v}" for k, v in sorted((params or {}).items()))
+
+
+class TokenBucket:
+    """優先度つきのトークンバケット。
+
+    上位の優先度が待っている間は下位にトークンを渡さない。同じ優先度の中の順番は決めない。
+    待ち方 (time.sleep / asyncio.sleep) は呼び出し側に任せ、ここは take() で「今取れたか、
+    あと何秒待てばよいか」だけを返す。
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waiting = [0] * len(MAX_QUEUE_WAIT_SEC)
+        self._lock = threading.Lock()
+
+    def take(self, priority):
+        """取れたら 0、取れなければ次に試すまでの秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1 and not any(self.waiting[:priority]):
+                self.tokens -= 1
+                return 0.0
+            return max((1 - self.tokens) / self.rate, 0.001)
+
+    def enqueue(self, priority):
+        with self._lock:
+            self.waiting[priority] += 1
+
+    def dequeue(self, priority):
+        with self._lock:
+            self.waiting[priority] -= 1
+
+    def acquire(self, priority):
+        """取れるまで待つ。MAX_QUEUE_WAIT_SEC を超えそうなら False"""
+        wait = self.take(priority)
+        if wait == 0: return True
+        give_up = time.monotonic() + MAX_QUEUE_WAIT_SEC[priority]
+        self.enqueue(priority)
+        try:
+            while wait:
+                if time.monotonic() + wait > give_up: return False
+                time.sleep(wait)
+                wait = self.take(priority)
+            return True
+        finally:
+            self.dequeue(priority)
+
+    async def acquire_async(self, priority):
+        """acquire の asyncio 版"""
+        wait = self.take(priority)
+        if wait == 0: return True
+        give_up = time.monotonic() + MAX_QUEUE_WAIT_SEC[priority]
+        self.enqueue(priority)
+        try:
+            while wait:
+                if time.monotonic() + wait > give_up: return False
+                await asyncio.sleep(wait)
+                wait = self.take(priority)
+            return True
+        finally:
+            self.dequeue(priority)
+
+
+class CircuitBreaker:
+    """closed -> (連続失敗) -> open -> (cooldown 経過) -> 1本だけ試す -> 成功で closed"""
+
+    def __init__(self, host, failures=CIRCUIT_FAILURES, cooldown=CIRCUIT_COOLDOWN_SEC):
+        self.host = host
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def rejecting(self):
+        """allow() が False を返す状態か。試す枠は取らないので、流量制限の順番待ちの前に見る"""
+        with self._lock:
+            return self.opened_at is not None and (self.probing or time.monotonic() - self.opened_at < self.cooldown)
+
+    def allow(self):
+        """呼んでよいか。open 中に True を返した1本 (試行) は success / failure / release_probe のどれかで終える"""
+        with self._lock:
+            if self.opened_at is None: return True
+            if self.probing or time.monotonic() - self.opened_at < self.cooldown: return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None: print(f"Circuit closed: {self.host}")
+            self.consecutive, self.opened_at, self.probing = 0, None, False
+
+    def release_probe(self):
+        """試行が成否の分からないまま終わった (キャンセル・想定外の例外)。次の呼び出しでまた試す"""
+        with self._lock:
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.probing or (self.opened_at is None and self.consecutive >= self.failures):
+                if self.opened_at is None: print(f"Circuit open: {self.host} ({self.consecutive} failures)")
+                self.opened_at, self.probing = time.monotonic(), False
+
+
+class LastGood:
+    """リクエスト単位で最後に成功したレスポンス (LRU)"""
+
+    def __init__(self, maxsize=LAST_GOOD_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            res = self._entries.get(key)
+            if res is not None: self._entries.move_to_end(key)
+            return res
+
+    def put(self, key, res):
+        with self._lock:
+            self._entries[key] = res
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class SingleFlight:
+    """同じキーの呼び出しが進行中なら、その結果 (または例外) を待って使う"""
+
+    def __init__(self):
+        self._inflight = {}  # key -> [Event, 結果, 例外]
+        self._lock = threading.Lock()
+
+    def do(self, key, host, fn):
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader: call = self._inflight[key] = [threading.Event(), None, None]
+        if not leader:
+            if call[0].wait(COALESCE_WAIT_SEC):
+                metrics.gateway_result(host, "coalesced")
+                if call[2] is not None: raise call[2]
+                return call[1]
+            return fn()
+        try:
+            call[1] = fn()
+            return call[1]
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            call[0].set()
+
+
+_buckets = {host: TokenBucket(rate, burst) for host, (rate, burst) in RATE_LIMITS.items()}
+_breakers = {}
+_breakers_lock = threading.Lock()
+last_good = LastGood()
+single_flight = SingleFlight()
+
+
+def bucket(host):
+    """流量制限の無いホストは None"""
+    return _buckets.get(host)
+
+
+def breaker(host):
+    with _breakers_lock:
+        cb = _breakers.get(host)
+        if cb is None: cb = _breakers[host] = CircuitBreaker(host)
+        return cb
+
+
+def is_failure(res):
+    return res.status_code >= 500 or res.status_code == 429
+
+
+def stale(key, host):
+    """最後に成功したレスポンスのコピー (無ければ None)。from_last_good = True の印をつける"""
+    res = last_good.get(key)
+    if res is None: return None
+    metrics.gateway_result(host, "stale")
+    res = copy.copy(res)
+    res.from_last_good = True
+    return res
+
+
+def is_stale(res):
+    """stale() / fallback() が返した使い回しのレスポンスか。取得時刻として扱ってはいけない"""
+    return getattr(res, "from_last_good", False)
+
+
+def fallback(key, host, error):
+    """最後に成功したレスポンスがあればそれを返し、無ければ error を投げる"""
+    res = stale(key, host)
+    if res is None:
+        metrics.gateway_result(host, type(error).__name__)
+        raise error
+    return res
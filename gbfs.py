@@ -0,0 +1,135 @@
+"""docomo-cycle-tokyo GBFS のプロセス共有スナップショット"""
+import threading
+import time
+import numpy as np
+import gateway
+import http_client
+import snapshots
+from geo import PointSet
+
+GBFS_BASE_URL = "https://api-public.odpt.org/api/v4/gbfs/docomo-cycle-tokyo"
+
+# station_information はほぼ変わらないので長めに保持する
+INFO_TTL_SEC = 6 * 60 * 60
+# station_status の ttl がレスポンスに無い場合の既定値
+DEFAULT_STATUS_TTL_SEC = 60
+# 取得失敗時に次の再取得まで待つ秒数 (古いデータは返し続ける)
+RETRY_AFTER_SEC = 15
+# スナップショットの status をこれより古くても起動直後の応答に使う上限 (秒)。裏で取り直すまでのつなぎ
+STATUS_SNAPSHOT_MAX_STALE_SEC = 10 * 60
+# ワーカー間で共有するスナップショット (info と status は更新頻度が違うので分ける)
+INFO_SNAPSHOT, STATUS_SNAPSHOT = "gbfs_information", "gbfs_status"
+GBFS_SNAPSHOT_SCHEMA = 1
+
+
+class GbfsSnapshot:
+    """ポート情報を空間インデックス付きで保持し、status は ttl ごとに更新する"""
+
+    def __init__(self, consumer_key, base_url=GBFS_BASE_URL, info_ttl=INFO_TTL_SEC):
+        self.consumer_key = consumer_key
+        self.base_url = base_url
+        self.info_ttl = info_ttl
+        self.info = {}      # station_id -> station_information
+        self.status = {}    # station_id -> station_status
+        # (station_id 配列, 座標 PointSet, status 有無のマスク)。読み手はロック無しで参照する
+        self.ports = ([], PointSet([], []), np.zeros(0, dtype=bool))
+        self.info_expires = 0
+        self.status_expires = 0
+        self.info_at = 0    # 取得時刻 (スナップショットとどちらが新しいかの比較用)
+        self.status_at = 0
+        self.status_ttl = DEFAULT_STATUS_TTL_SEC
+        self._snapshot_seen = 0
+        self._lock = threading.Lock()
+
+    def _fetch(self, name):
+        params = {"acl:consumerKey": self.consumer_key}
+        res = http_client.get(f"{self.base_url}/{name}.json", params=params)
+        res.raise_for_status()
+        # 使い回しの値は取得し直せなかったのと同じ扱い (手元の値と取得時刻のまま、少し後に取り直す)
+        if gateway.is_stale(res): raise gateway.StaleResponse(name)
+        return res.json()
+
+    def _load_info(self, now):
+        data = self._fetch("station_information")
+        self._apply_info(data.get("data", {}).get("stations", []), now)
+        snapshots.save(INFO_SNAPSHOT, GBFS_SNAPSHOT_SCHEMA, list(self.info.values()), now)
+
+    def _apply_info(self, stations, fetched_at):
+        info = {s["station_id"]: s for s in stations}
+        ids = list(info)
+        points = PointSet([info[i]["lat"] for i in ids], [info[i]["lon"] for i in ids])
+        # 作り終えてから差し替える
+        self.info = info
+        self.ports = (ids, points, self._status_mask(ids, self.status))
+        self.info_at = fetched_at
+        self.info_expires = fetched_at + self.info_ttl
+
+    @staticmethod
+    def _status_mask(ids, status):
+        return np.fromiter((st_id in status for st_id in ids), dtype=bool, count=len(ids))
+
+    def _load_status(self, now):
+        data = self._fetch("station_status")
+        stations = data.get("data", {}).get("stations", [])
+        self._apply_status(stations, data.get("ttl") or DEFAULT_STATUS_TTL_SEC, now)
+        snapshots.save(STATUS_SNAPSHOT, GBFS_SNAPSHOT_SCHEMA, {"ttl": self.status_ttl, "stations": stations}, now)
+
+    def _apply_status(self, stations, ttl, fetched_at):
+        status = {s["station_id"]: s for s in stations}
+        ids, points, _ = self.ports
+        self.status = status
+        self.ports = (ids, points, self._status_mask(ids, status))
+        self.status_at, self.status_ttl = fetched_at, ttl
+        self.status_expires = fetched_at + max(ttl, 10)
+
+    def load_snapshot(self):
+        """他のワーカーが保存したスナップショットのうち、手元より新しく使える古さのものを取り込む"""
+        seen = max(snapshots.mtime(INFO_SNAPSHOT), snapshots.mtime(STATUS_SNAPSHOT))
+        if seen <= self._snapshot_seen: return False
+        self._snapshot_seen = seen
+        stations, fetched_at = snapshots.load(INFO_SNAPSHOT, GBFS_SNAPSHOT_SCHEMA, self.info_ttl)
+        if stations and fetched_at > self.info_at:
+            self._apply_info(stations, fetched_at)
+        data, fetched_at = snapshots.load(STATUS_SNAPSHOT, GBFS_SNAPSHOT_SCHEMA, STATUS_SNAPSHOT_MAX_STALE_SEC)
+        if data and self.info and fetched_at > self.status_at:
+            self._apply_status(data["stations"], data["ttl"], fetched_at)
+        return True
+
+    def refresh(self):
+        """期限切れのデータだけ取り直す (他のワーカーが取り直したばかりならそれを使う)"""
+        now = time.time()
+        if now < self.info_expires and now < self.status_expires: return
+        # 既にデータがあれば、他スレッドが更新中の間は古いデータで応答する
+        has_data = bool(self.info) and bool(self.status)
+        if not self._lock.acquire(blocking=not has_data): return
+        try:
+            self.load_snapshot()
+            now = time.time()
+            try:
+                if now >= self.info_expires:
+                    self._load_info(now)
+                if now >= self.status_expires:
+                    self._load_status(now)
+            except Exception as e:
+                if not (self.info and self.status): raise
+                print(f"GBFS Refresh Error: {e}")
+                retry_at = now + RETRY_AFTER_SEC
+                if now >= self.info_expires: self.info_expires = retry_at
+                if now >= self.status_expires: self.status_expires = retry_at
+        finally:
+            self._lock.release()
+
+    def port_status(self, station_id):
+        self.refresh()
+        return self.status.get(station_id)
+
+    def nearby(self, lat, lon, radius_km, k=None):
+        """半径内で status のあるポートを近い順に最大 k 件、(info, status, 距離km) で返す"""
+        self.refresh()
+        (ids, points, has_status), info, status = self.ports, self.info, self.status
+        idx, dists = points.within(lat, lon, radius_km, k=k, mask=has_status)
+        results = []
+        for i, dist_km in zip(idx.tolist(), dists.tolist()):
+            s_info, st = info.get(ids[i]), status.get(ids[i])
+            if s_info and st: results.append((s_info, st, dist_km))
+        return results
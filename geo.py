@@ -0,0 +1,72 @@
+"""距離計算と近傍検索 (NumPy でまとめて計算する)"""
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+# 緯度1度あたりの距離 (km)
+KM_PER_DEG = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat, lon, lats, lons):
+    """(lat, lon) から座標配列 (lats, lons) への大円距離 (km)"""
+    lat1 = np.radians(lat)
+    lat2 = np.radians(lats)
+    d_lat = lat2 - lat1
+    d_lon = np.radians(lons) - np.radians(lon)
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """2点間の距離 (km)"""
+    return float(haversine_km(lat1, lon1, lat2, lon2))
+
+
+def top_k(dists, k):
+    """距離の小さい順に k 件のインデックス。全体はソートせず argpartition で絞る"""
+    if k is not None and k < len(dists):
+        idx = np.argpartition(dists, k - 1)[:k]
+    else:
+        idx = np.arange(len(dists))
+    return idx[np.argsort(dists[idx], kind="stable")]
+
+
+class PointSet:
+    """座標配列 + 緯度経度グリッド。半径検索は周辺セルの候補だけを一括で距離計算する"""
+
+    def __init__(self, lats, lons, cell_deg=0.005):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_deg = cell_deg
+        cells = {}
+        rows = np.floor(self.lats / cell_deg).astype(np.int64)
+        cols = np.floor(self.lons / cell_deg).astype(np.int64)
+        for i, key in enumerate(zip(rows.tolist(), cols.tolist())):
+            cells.setdefault(key, []).append(i)
+        self.cells = {key: np.array(idxs, dtype=np.intp) for key, idxs in cells.items()}
+
+    def __len__(self):
+        return len(self.lats)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def candidates(self, lat, lon, radius_km):
+        """radius_km の範囲に掛かるセルの要素インデックス"""
+        lat_span = radius_km / KM_PER_DEG
+        lon_span = radius_km / (KM_PER_DEG * max(math.cos(math.radians(lat)), 0.01))
+        lat_lo, lon_lo = self._cell(lat - lat_span, lon - lon_span)
+        lat_hi, lon_hi = self._cell(lat + lat_span, lon + lon_span)
+        found = [self.cells[(i, j)] for i in range(lat_lo, lat_hi + 1) for j in range(lon_lo, lon_hi + 1) if (i, j) in self.cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.intp)
+
+    def within(self, lat, lon, radius_km, k=None, mask=None):
+        """半径内の要素を近い順に (インデックス配列, 距離km配列) で返す。mask で対象を絞れる"""
+        idx = self.candidates(lat, lon, radius_km)
+        if mask is not None and len(idx):
+            idx = idx[mask[idx]]
+        dists = haversine_km(lat, lon, self.lats[idx], self.lons[idx])
+        inside = dists <= radius_km
+        idx, dists = idx[inside], dists[inside]
+        order = top_k(dists, k)
+        return idx[order], dists[order]
@@ -0,0 +1,239 @@
+"""上流API (ODPT / GBFS / Nominatim) 共通の keep-alive HTTP クライアント"""
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import TimeoutError as Urllib3TimeoutError
+from urllib3.util.retry import Retry
+import gateway
+import metrics
+
+# ホストごとのコネクションプール上限 (1ワーカープロセスあたり)。
+# fanout のスレッド数と揃えておけば並列呼び出しでもプールが溢れない
+DEFAULT_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+HOST_POOL_MAXSIZE = {
+    "https://api.odpt.org": DEFAULT_POOL_MAXSIZE,
+    "https://api-public.odpt.org": DEFAULT_POOL_MAXSIZE,
+    # 利用規約上 1 req/s なので少数で十分
+    "https://nominatim.openstreetmap.org": 2,
+}
+
+# エンドポイント別の (接続, 読み込み) タイムアウト (秒)
+DEFAULT_TIMEOUT = (3.05, 5)
+ENDPOINT_TIMEOUTS = {
+    "odpt:TrainInformation": (2, 2),
+    "odpt:Train": (2, 3),
+    "odpt:Station": (3.05, 5),
+    "odpt:Railway": (3.05, 5),
+    "odpt:StationTimetable": (3.05, 8),
+    "station_information.json": (3.05, 5),
+    "station_status.json": (3.05, 5),
+    "search": (3.05, 5),
+}
+
+# 上流の Retry-After はこの秒数までしか待たない (それより長い指示は待たずに失敗として扱い、
+# gateway のブレーカーと流量制御に任せる。待つ間はプールのスレッドや相乗りの後続も止まるので)
+MAX_RETRY_AFTER_SEC = float(os.getenv("HTTP_MAX_RETRY_AFTER_SEC", "2"))
+
+# 1回のリクエストがこれより遅ければ内訳をログに出す (秒)
+SLOW_REQUEST_SEC = float(os.getenv("HTTP_SLOW_REQUEST_SEC", "1.0"))
+
+# 全上流を別ホストに向ける (replay.py のスタブサーバー用)。例: http://127.0.0.1:8765
+UPSTREAM_BASE_URL = os.getenv("UPSTREAM_BASE_URL", "")
+
+# レスポンスを受け取るたびに hook(url, params, response) を呼ぶ (記録用)
+response_hooks = []
+
+_local = threading.local()
+
+
+def _add_connect_time(started):
+    _local.connect_time = getattr(_local, "connect_time", 0.0) + (time.perf_counter() - started)
+    _local.connects = getattr(_local, "connects", 0) + 1
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _add_connect_time(started)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        # TCP と TLS ハンドシェイクの両方を含む
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _add_connect_time(started)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    """新規接続にかかった時間を計測するアダプタ"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+class _CappedRetry(Retry):
+    """Retry-After を MAX_RETRY_AFTER_SEC で頭打ちにする"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER_SEC)
+
+
+def _retry():
+    return _CappedRetry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def _build_session():
+    session = requests.Session()
+    default = _TimedAdapter(pool_connections=8, pool_maxsize=DEFAULT_POOL_MAXSIZE, max_retries=_retry())
+    session.mount("https://", default)
+    session.mount("http://", default)
+    for prefix, maxsize in HOST_POOL_MAXSIZE.items():
+        session.mount(prefix, _TimedAdapter(pool_connections=1, pool_maxsize=maxsize, max_retries=_retry()))
+    return session
+
+
+session = _build_session()
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def endpoint_name(url):
+    """URL の末尾パスをエンドポイント名とする (例: odpt:TrainInformation)"""
+    return urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def _record(endpoint, connect_time, connects, request_time, outcome):
+    with _stats_lock:
+        st = _stats.setdefault(endpoint, {
+            "requests": 0, "errors": 0, "timeouts": 0, "connects": 0,
+            "connect_time_total": 0.0, "request_time_total": 0.0,
+        })
+        st["requests"] += 1
+        st["connects"] += connects
+        st["connect_time_total"] += connect_time
+        st["request_time_total"] += request_time
+        if outcome != "ok": st["errors"] += 1
+        if outcome == "timeout": st["timeouts"] += 1
+
+
+def _failure_outcome(exc):
+    """リトライを使い切った読み込みタイムアウトは ConnectionError で届くので中身も見る"""
+    if isinstance(exc, requests.Timeout): return "timeout"
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    if isinstance(reason, Urllib3TimeoutError): return "timeout"
+    return "error"
+
+
+def upstream_url(url):
+    """UPSTREAM_BASE_URL があれば https://host/path を {base}/host/path に付け替える"""
+    if not UPSTREAM_BASE_URL: return url
+    parts = urlsplit(url)
+    return f"{UPSTREAM_BASE_URL.rstrip('/')}/{parts.netloc}{parts.path}"
+
+
+def get(url, params=None, headers=None, timeout=None):
+    """共有セッションで GET する。タイムアウト未指定ならエンドポイント別の既定値を使う。
+
+    gateway を通すので、同じ URL + クエリの呼び出しが進行中なら相乗りし、ホストの流量上限を
+    超える分は優先度順に待たせる。待ちきれない・ホストが落ちている時は最後に成功したレスポンスを
+    返し、それも無ければ gateway.RateLimited / CircuitOpen などを投げる。
+    """
+    key = gateway.request_key(url, params)
+    host = urlsplit(url).netloc
+    return gateway.single_flight.do(key, host, lambda: _guarded_get(key, host, url, params, headers, timeout))
+
+
+def _guarded_get(key, host, url, params, headers, timeout):
+    breaker = gateway.breaker(host)
+    if breaker.rejecting():
+        return gateway.fallback(key, host, gateway.CircuitOpen(host))
+    # 順番待ちを先に済ませる (試行の枠を取ってから待ちきれずに戻ると、枠が外れなくなる)
+    bucket = gateway.bucket(host)
+    if bucket and not bucket.acquire(gateway.priority_of(endpoint_name(url))):
+        return gateway.fallback(key, host, gateway.RateLimited(host))
+    if not breaker.allow():
+        return gateway.fallback(key, host, gateway.CircuitOpen(host))
+    try:
+        res = _send(url, params, headers, timeout)
+    except requests.RequestException as e:
+        breaker.failure()
+        return gateway.fallback(key, host, e)
+    except BaseException:
+        breaker.release_probe()
+        raise
+    if gateway.is_failure(res):
+        breaker.failure()
+        last = gateway.stale(key, host)
+        return res if last is None else last
+    breaker.success()
+    if res.status_code < 400: gateway.last_good.put(key, res)
+    return res
+
+
+def _send(url, params, headers, timeout):
+    endpoint = endpoint_name(url)
+    if timeout is None:
+        timeout = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+    _local.connect_time, _local.connects = 0.0, 0
+    started = time.perf_counter()
+    res, outcome = None, "error"
+    try:
+        res = session.get(upstream_url(url), params=params, headers=headers, timeout=timeout)
+        outcome = "ok" if res.status_code < 400 else "http_error"
+        for hook in response_hooks:
+            hook(url, params, res)
+        return res
+    except requests.RequestException as e:
+        outcome = _failure_outcome(e)
+        raise
+    finally:
+        request_time = time.perf_counter() - started
+        connect_time, connects = _local.connect_time, _local.connects
+        _record(endpoint, connect_time, connects, request_time, outcome)
+        retries = res.raw.retries if res is not None and res.raw is not None else None
+        metrics.record_upstream(
+            endpoint, request_time, outcome,
+            size=len(res.content) if res is not None else None,
+            retries=len(retries.history) if retries else 0,
+            connects=connects, connect_time=connect_time)
+        if request_time >= SLOW_REQUEST_SEC:
+            print(f"Slow upstream {endpoint}: total={request_time * 1000:.0f}ms connect={connect_time * 1000:.0f}ms ({connects} new)")
+
+
+def stats():
+    """エンドポイント別の累計 (接続時間とリクエスト時間を分けて集計)。分布は metrics を参照"""
+    with _stats_lock:
+        return {name: dict(st) for name, st in _stats.items()}
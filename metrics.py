@@ -0,0 +1,225 @@
+"""上流呼び出し・ルート処理の計測 (Prometheus テキスト形式の /metrics と Server-Timing ヘッダー)
+
+値はプロセスごとに持つ。gunicorn で複数ワーカーを動かす時は、ワーカーごとに集めるか
+合計値の傾向として見る。
+"""
+import contextlib
+import contextvars
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+
+# レスポンスに Server-Timing ヘッダー (リクエスト内の内訳) を付けるか
+SERVER_TIMING = os.getenv("SERVER_TIMING", "") == "1"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+METRICS = {
+    # 名前: (種類, 説明)
+    "railbridge_http_request_seconds": ("histogram", "Route handler latency"),
+    "railbridge_http_requests_total": ("counter", "Handled requests by route and status"),
+    "railbridge_http_response_bytes": ("histogram", "Response body size (non-streaming)"),
+    "railbridge_upstream_request_seconds": ("histogram", "Upstream call latency including retries"),
+    "railbridge_upstream_requests_total": ("counter", "Upstream calls by outcome (ok, http_error, timeout, error)"),
+    "railbridge_upstream_response_bytes": ("histogram", "Upstream response body size"),
+    "railbridge_upstream_retries_total": ("counter", "Retries performed by the HTTP client"),
+    "railbridge_upstream_connects_total": ("counter", "New upstream connections"),
+    "railbridge_upstream_connect_seconds_total": ("counter", "Time spent in TCP/TLS connect"),
+    "railbridge_gateway_total": ("counter", "Upstream calls answered by the gateway (coalesced, stale, RateLimited, CircuitOpen, ...)"),
+    "railbridge_cache_requests_total": ("counter", "Cache lookups by result (hit, stale, miss, coalesced)"),
+    "railbridge_fanout_missing_total": ("counter", "Fan-out calls replaced by defaults (timeout or error)"),
+    "railbridge_fallbacks_total": ("counter", "Handlers that fell back to a default value after an error"),
+}
+
+_lock = threading.Lock()
+_counters = {}    # (名前, ラベル) -> 値
+_histograms = {}  # (名前, ラベル) -> Histogram
+_gauges = {}      # 名前 -> (説明, 関数)
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None: hist = _histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+
+def gauge(name, description, fn):
+    """/metrics を読むたびに fn() を呼んで値を出す"""
+    _gauges[name] = (description, fn)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs: return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    """丸めずに書く (:g は有効 6 桁なので、1e6 を超えたカウンターが増えなくなる)"""
+    if isinstance(value, int) or float(value).is_integer(): return str(int(value))
+    return repr(float(value))
+
+
+def render():
+    """Prometheus のテキスト形式 (version 0.0.4)"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (h.buckets, list(h.counts), h.sum, h.count) for key, h in _histograms.items()}
+
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (n, labels), value in sorted(counters.items()):
+                if n == name: lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            continue
+        for (n, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            if n != name: continue
+            cumulative = 0
+            for le, c in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(le))])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    for name, (description, fn) in _gauges.items():
+        try:
+            value = fn()
+        except Exception as e:
+            print(f"Metrics Gauge Error ({name}): {e}")
+            continue
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {_format_value(value)}"]
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------------------------------------
+# リクエスト単位の内訳
+# ---------------------------------------------------------
+
+class Trace:
+    """1リクエスト内の区間 (上流呼び出し・処理フェーズ) の所要時間"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []  # (名前, 秒)。fanout のスレッドからも追記される
+
+    def add(self, name, seconds):
+        self.spans.append((name, seconds))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """同じ名前の区間は合計し、回数を desc に入れる"""
+        totals = {}
+        for name, seconds in list(self.spans):
+            total, count = totals.get(name, (0.0, 0))
+            totals[name] = (total + seconds, count + 1)
+        parts = [f'{_token(name)};dur={total * 1000:.1f};desc="x{count}"' for name, (total, count) in totals.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+
+def _token(name):
+    return re.sub(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]", "_", name)
+
+
+def start_trace():
+    trace = Trace()
+    return trace, _trace.set(trace)
+
+
+def end_trace(token):
+    _trace.reset(token)
+
+
+def current_trace():
+    return _trace.get()
+
+
+@contextlib.contextmanager
+def span(name):
+    """with span("plan"): ... の所要時間を現在のリクエストの内訳に加える"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = _trace.get()
+        if trace: trace.add(name, time.perf_counter() - started)
+
+
+# ---------------------------------------------------------
+# 各モジュールからの記録
+# ---------------------------------------------------------
+
+def record_upstream(endpoint, seconds, outcome, size=None, retries=0, connects=0, connect_time=0.0):
+    observe("railbridge_upstream_request_seconds", seconds, endpoint=endpoint)
+    inc("railbridge_upstream_requests_total", endpoint=endpoint, outcome=outcome)
+    if size is not None:
+        observe("railbridge_upstream_response_bytes", size, SIZE_BUCKETS, endpoint=endpoint)
+    if retries: inc("railbridge_upstream_retries_total", retries, endpoint=endpoint)
+    if connects:
+        inc("railbridge_upstream_connects_total", connects, endpoint=endpoint)
+        inc("railbridge_upstream_connect_seconds_total", connect_time, endpoint=endpoint)
+    trace = _trace.get()
+    if trace: trace.add(f"up.{endpoint}", seconds)
+
+
+def record_request(route, method, status, seconds, size=None):
+    observe("railbridge_http_request_seconds", seconds, route=route, method=method)
+    inc("railbridge_http_requests_total", route=route, method=method, status=status)
+    if size is not None:
+        observe("railbridge_http_response_bytes", size, SIZE_BUCKETS, route=route)
+
+
+def gateway_result(host, result):
+    inc("railbridge_gateway_total", host=host, result=result)
+
+
+def cache_result(cache, result):
+    inc("railbridge_cache_requests_total", cache=cache, result=result)
+
+
+def fanout_missing(call, reason):
+    inc("railbridge_fanout_missing_total", call=call, reason=reason)
+
+
+def fallback(source, error):
+    """例外を握りつぶして既定値を返す箇所で呼ぶ (タイムアウトが隠れないように数える)"""
+    inc("railbridge_fallbacks_total", source=source, error=type(error).__name__)
@@ -0,0 +1,119 @@
+"""レスポンス本文の書き出し (orjson)・列形式への変換・圧縮 (brotli / gzip)
+
+orjson・brotli が無ければ Flask 標準の JSON・gzip だけで動く。
+"""
+import gzip
+import os
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# これより小さい本文は圧縮しない (ヘッダーと CPU の方が高くつく)
+COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+# 0 にすると圧縮しない (前段のリバースプロキシで圧縮する場合など)
+COMPRESS_RESPONSES = os.getenv("RESPONSE_COMPRESS", "1") != "0"
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/html", "text/plain", "text/css", "application/javascript")
+
+# リクエストごとに圧縮する時は速さ優先、キャッシュする本文は1回だけなので縮み優先
+DYNAMIC_LEVEL = {"br": 4, "gzip": 5}
+STATIC_LEVEL = {"br": 11, "gzip": 9}
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify / app.json を orjson で書き出す。キーの並び (sort_keys) は標準と同じ、日本語はエスケープしない"""
+
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.options)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def install(app):
+    """orjson があれば app の JSON プロバイダーを差し替える"""
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+
+
+def columns(rows):
+    """[{...}, ...] -> {"キー": [値, ...], ...}。キーは出てきた順、無い値は None"""
+    keys = {}
+    for row in rows:
+        for key in row:
+            keys.setdefault(key, None)
+    return {key: [row.get(key) for row in rows] for key in keys}
+
+
+def wants_columns(args):
+    return args.get('format') == 'columns'
+
+
+def compress(body, encoding, level=None):
+    if encoding == "br": return brotli.compress(body, quality=DYNAMIC_LEVEL["br"] if level is None else level)
+    return gzip.compress(body, compresslevel=DYNAMIC_LEVEL["gzip"] if level is None else level, mtime=0)
+
+
+def negotiate(accept_encoding, size):
+    """Accept-Encoding と本文の大きさから使う圧縮 (無圧縮なら None)"""
+    if not COMPRESS_RESPONSES or size < COMPRESS_MIN_BYTES or not accept_encoding: return None
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip().lower()] = q
+    best = max(ENCODINGS, key=lambda e: offered.get(e, offered.get("*", 0)))
+    return best if offered.get(best, offered.get("*", 0)) > 0 else None
+
+
+class Precompressed:
+    """変わらない本文と、その圧縮済みの版 (初めて要求された時に1回だけ作る)"""
+
+    def __init__(self, body):
+        self.body = body
+        self.variants = {}
+
+    def get(self, encoding):
+        if encoding is None: return self.body
+        data = self.variants.get(encoding)
+        if data is None:
+            data = self.variants[encoding] = compress(self.body, encoding, STATIC_LEVEL[encoding])
+        return data
+
+
+def compress_response(response, accept_encoding):
+    """Flask のレスポンスを圧縮する (after_request 用)。ストリーミング・圧縮済みはそのまま"""
+    if (response.is_streamed or response.direct_passthrough or "Content-Encoding" in response.headers
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    encoding = negotiate(accept_encoding, len(body))
+    if encoding is None: return response
+    response.set_data(compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    if response.get_etag()[0]:
+        tag, weak = response.get_etag()
+        response.set_etag(f"{tag}-{encoding}", weak)
+    return response
@@ -0,0 +1,259 @@
+"""search_place 用のローカル地名インデックス (駅 + 任意の POI 抽出 + Nominatim で引けた結果)
+
+表記ゆれは normalize() で吸収する (NFKC・カタカナ→ひらがな・異体字・末尾の「駅」)。
+前方一致はソート済みキーの二分探索、部分一致・あいまい一致は 2-gram の転置インデックスで引く。
+"""
+import csv
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+import numpy as np
+
+# OSM などから抽出した POI (GeoJSON または name,lat,lon[,kana] の CSV)。複数は os.pathsep 区切り
+PLACE_POI_PATH = os.getenv("PLACE_POI_PATH", "")
+# あいまい一致として採用する 2-gram の Dice 係数の下限
+FUZZY_MIN_SCORE = 0.5
+# search_place がローカルの結果で答えるスコアの下限 (これ未満は Nominatim に聞く)
+LOCAL_MIN_SCORE = 0.6
+# 前方一致で調べる件数の上限
+PREFIX_SCAN = 200
+# これより多くの地名に現れる 2-gram はあいまい一致の候補集めに使わない
+MAX_POSTINGS = 5000
+# Nominatim で引けた結果を覚えておく件数
+LEARNED_MAX = 2000
+
+# 種類ごとの並び順 (同点なら駅を優先)
+KIND_RANK = {"station": 0, "learned": 1, "poi": 2, "bus": 3}
+
+_VARIANTS = {
+    "ヶ": "け", "ヵ": "か", "ゖ": "け", "ゕ": "か",
+    "﨑": "崎", "嵜": "崎", "嶋": "島", "邊": "辺", "邉": "辺", "澤": "沢",
+    "龍": "竜", "髙": "高", "檜": "桧", "德": "徳", "濵": "浜", "濱": "浜",
+}
+_FOLD = str.maketrans({**{chr(c): chr(c - 0x60) for c in range(0x30A1, 0x30F7)}, **_VARIANTS})
+_IGNORED = re.compile(r"[\s・･\-‐‑–—_.,、。()\[\]「」『』/'\"]+")
+
+
+def normalize(text):
+    """比較用のキー。全角半角・カタカナひらがな・一部の異体字・区切り記号・末尾の「駅」を無視する"""
+    text = unicodedata.normalize("NFKC", text or "").lower().translate(_FOLD)
+    text = _IGNORED.sub("", text)
+    if len(text) > 1 and text.endswith("駅"): text = text[:-1]
+    return text
+
+
+def bigrams(key):
+    if len(key) < 2: return {key} if key else set()
+    return {key[i:i + 2] for i in range(len(key) - 1)}
+
+
+class PlaceIndex:
+    """地名キー -> (表示名, 座標, 種類)。add() は後からも呼べる (読み取りはロック無し)"""
+
+    def __init__(self):
+        self.keys = []
+        self.names = []
+        self.lat = array("d")
+        self.lon = array("d")
+        self.kinds = []
+        self.gram_counts = array("H")
+        self.sorted_keys = []   # (キー, 番号) の昇順
+        self.postings = {}      # 2-gram -> array("I", 番号)
+        self._seen = set()      # (キー, 種類)。同じ駅名が路線ごとに出てくるのをまとめる
+        self._loading = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, name, lat, lon, kind, key=None):
+        """key を渡すと読み仮名などの別名として登録する"""
+        key = normalize(key or name)
+        if not key or lat is None or lon is None or math.isnan(lat) or math.isnan(lon): return False
+        with self._lock:
+            if (key, kind) in self._seen: return False
+            self._seen.add((key, kind))
+            n = len(self.keys)
+            grams = bigrams(key)
+            self.names.append(name)
+            self.lat.append(lat)
+            self.lon.append(lon)
+            self.kinds.append(kind)
+            self.gram_counts.append(min(len(grams), 0xFFFF))
+            for gram in grams:
+                self.postings.setdefault(gram, array("I")).append(n)
+            if self._loading: self.sorted_keys.append((key, n))
+            else: insort(self.sorted_keys, (key, n))
+            # 他の配列が揃ってから公開する (search は keys の長さまでしか見ない)
+            self.keys.append(key)
+        return True
+
+    def load(self, entries):
+        """[(表示名, lat, lon, 種類, キー)] をまとめて登録する (並べ替えは最後に1回だけ)"""
+        self._loading = True
+        try:
+            for entry in entries:
+                self.add(*entry)
+        finally:
+            self._loading = False
+            self.sorted_keys.sort()
+
+    def search(self, query, limit=5):
+        """[{name, lat, lon, kind, score}] をスコア順に。完全一致 1.0 > 前方一致 > 部分一致 > あいまい一致"""
+        key = normalize(query)
+        if not key: return []
+        n = len(self.keys)
+        scores = {}
+
+        sorted_keys = self.sorted_keys
+        i = bisect_left(sorted_keys, (key,))
+        for cand, idx in sorted_keys[i:i + PREFIX_SCAN]:
+            if not cand.startswith(key): break
+            if idx >= n: continue
+            scores[idx] = 1.0 if cand == key else 0.8 + 0.15 * len(key) / len(cand)
+
+        grams = bigrams(key)
+        # 前方一致で十分に埋まったら部分一致・あいまい一致は探さない
+        if len(key) >= 2 and len(scores) < limit:
+            postings = [np.array(p, dtype=np.uint32) for p in map(self.postings.get, grams)
+                        if p is not None and len(p) <= MAX_POSTINGS]
+            if postings:
+                idxs, shared = np.unique(np.concatenate(postings), return_counts=True)
+                keep = idxs < n
+                idxs, shared = idxs[keep], shared[keep]
+                dice = 2 * shared / (len(grams) + np.array(self.gram_counts[:n], dtype=np.float64)[idxs])
+                # 部分一致なら全 2-gram を共有しているはず
+                keep = (dice >= FUZZY_MIN_SCORE) | (shared == len(grams))
+                for idx, d in zip(idxs[keep].tolist(), dice[keep].tolist()):
+                    if idx in scores: continue
+                    cand = self.keys[idx]
+                    if key in cand:
+                        # 名前のどれだけを覆うかで点をつける (短い部分一致だけではローカルで答えない)
+                        scores[idx] = 0.4 + 0.35 * len(key) / len(cand)
+                    elif d >= FUZZY_MIN_SCORE:
+                        scores[idx] = 0.75 * d
+
+        best = sorted(scores.items(), key=lambda item: (-item[1], KIND_RANK.get(self.kinds[item[0]], 9), len(self.names[item[0]])))
+        results = []
+        seen_names = set()
+        for idx, score in best:
+            # 別名で当たった同じ地名は1件にまとめる
+            if (self.names[idx], self.kinds[idx]) in seen_names: continue
+            seen_names.add((self.names[idx], self.kinds[idx]))
+            results.append({"name": self.names[idx], "lat": self.lat[idx], "lon": self.lon[idx],
+                            "kind": self.kinds[idx], "score": round(score, 3)})
+            if len(results) >= limit: break
+        return results
+
+
+def _geojson_point(geometry):
+    if not geometry: return None
+    coords = geometry.get("coordinates")
+    if geometry.get("type") == "Point": return coords[1], coords[0]
+    # 面・線は頂点の平均で代表させる
+    while coords and isinstance(coords[0][0], list):
+        coords = coords[0]
+    if not coords: return None
+    return sum(c[1] for c in coords) / len(coords), sum(c[0] for c in coords) / len(coords)
+
+
+def load_pois(path):
+    """[(表示名, lat, lon, [別名...])]。GeoJSON は OSM の name / name:ja / name:ja-Hira / name:ja_kana を読む"""
+    pois = []
+    if path.lower().endswith(".csv"):
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                aliases = [row["kana"]] if row.get("kana") else []
+                pois.append((row["name"], float(row["lat"]), float(row["lon"]), aliases))
+        return pois
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    for feature in data.get("features", []):
+        props = feature.get("properties") or {}
+        name = props.get("name:ja") or props.get("name")
+        point = _geojson_point(feature.get("geometry"))
+        if not name or not point: continue
+        aliases = [props[k] for k in ("name", "name:ja-Hira", "name:ja_kana", "name:en") if props.get(k) and props[k] != name]
+        pois.append((name, point[0], point[1], aliases))
+    return pois
+
+
+class PlaceSearch:
+    """トポロジーが更新されたら作り直すインデックス (駅・POI・バス停) と、Nominatim で引けた結果の小さなインデックス"""
+
+    def __init__(self, topology_store, bus_stop_index=None, poi_path=PLACE_POI_PATH):
+        self.topology_store = topology_store
+        self.bus_stop_index = bus_stop_index
+        self.pois = []
+        for path in filter(None, poi_path.split(os.pathsep)):
+            try:
+                self.pois.extend(load_pois(path))
+            except Exception as e:
+                print(f"Place POI Load Error ({path}): {e}")
+        if self.pois: print(f"Place index: {len(self.pois)} POIs")
+        self.learned = {}   # 正規化した問い合わせ -> (表示名, lat, lon)
+        # 覚えた結果は LEARNED_MAX 件までの別のインデックスに置き、覚えるたびに作り直す
+        self.learned_index = PlaceIndex()
+        self.index = None
+        self.version = None
+        self._lock = threading.Lock()
+
+    def _entries(self, topology):
+        if topology:
+            for i, name in enumerate(topology.names):
+                yield name, topology.lat[i], topology.lon[i], "station", None
+        for name, lat, lon, aliases in self.pois:
+            yield name, lat, lon, "poi", None
+            for alias in aliases:
+                yield name, lat, lon, "poi", alias
+        if self.bus_stop_index:
+            for name, lat, lon, _ in self.bus_stop_index.stops:
+                yield name, lat, lon, "bus", None
+
+    def _learned_entries(self):
+        for query, (name, lat, lon) in list(self.learned.items()):
+            yield name, lat, lon, "learned", None
+            yield name, lat, lon, "learned", query
+
+    def _build(self, topology):
+        index = PlaceIndex()
+        index.load(self._entries(topology))
+        return index
+
+    def current(self):
+        topology = self.topology_store.current
+        version = topology.version if topology else None
+        if self.index is None or version != self.version:
+            with self._lock:
+                if self.index is None or version != self.version:
+                    self.index, self.version = self._build(topology), version
+        return self.index
+
+    def search(self, query, limit=5):
+        results = self.current().search(query, limit) + self.learned_index.search(query, limit)
+        results.sort(key=lambda r: (-r["score"], KIND_RANK.get(r["kind"], 9), len(r["name"])))
+        return results[:limit]
+
+    def best(self, query, min_score=LOCAL_MIN_SCORE):
+        """ローカルで十分に当たった1件。無ければ None"""
+        results = self.search(query, 1)
+        return results[0] if results and results[0]["score"] >= min_score else None
+
+    def remember(self, query, name, lat, lon):
+        """Nominatim で引けた結果を覚えて、次からはローカルで答える"""
+        key = normalize(query)
+        if not key: return
+        with self._lock:
+            self.learned.pop(key, None)
+            while len(self.learned) >= LEARNED_MAX:
+                self.learned.pop(next(iter(self.learned)))
+            self.learned[key] = (name, lat, lon)
+            index = PlaceIndex()
+            index.load(self._learned_entries())
+            self.learned_index = index
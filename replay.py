@@ -0,0 +1,159 @@
+"""上流レスポンスの記録と再生 (オフラインの負荷試験用スタブサーバー)
+
+記録:  UPSTREAM_RECORD=fixtures/upstream.jsonl python app.py
+再生:  python replay.py serve fixtures/upstream.jsonl --port 8765 --latency "lognormal:80:400"
+       UPSTREAM_BASE_URL=http://127.0.0.1:8765 gunicorn app:app
+"""
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# 記録しないクエリパラメータ (API キー)
+SECRET_PARAMS = {"acl:consumerKey"}
+
+
+def fixture_key(host, path, query):
+    """ホスト + パス + キー以外のクエリ (順不同) で1件を特定する"""
+    items = sorted((k, str(v)) for k, v in query.items() if k not in SECRET_PARAMS)
+    return host + path + "?" + "&".join(f"{k}={v}" for k, v in items)
+
+
+class Recorder:
+    """http_client.response_hooks に登録し、受け取ったレスポンスを JSONL に追記する"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, url, params, res):
+        parts = urlsplit(url)
+        query = {k: v for k, v in (params or {}).items() if k not in SECRET_PARAMS}
+        try:
+            body = res.json()
+        except ValueError:
+            return
+        line = json.dumps({"host": parts.netloc, "path": parts.path, "query": query,
+                           "status": res.status_code, "body": body}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class FixtureStore:
+    def __init__(self, fixtures=()):
+        self.responses = {}
+        for fx in fixtures:
+            self.add(fx)
+        self.misses = 0
+
+    def add(self, fx):
+        # 同じキーが複数あれば後から記録したものを使う
+        self.responses[fixture_key(fx["host"], fx["path"], fx.get("query", {}))] = (fx.get("status", 200), fx["body"])
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.loads(line) for line in f if line.strip())
+
+    def lookup(self, host, path, query):
+        found = self.responses.get(fixture_key(host, path, query))
+        if found is None:
+            self.misses += 1
+            # ODPT は該当なしを空配列で返すので、それに合わせる
+            return 200, []
+        return found
+
+
+class LatencyProfile:
+    """上流の応答遅延。"fixed:50" / "uniform:20:200" / "lognormal:中央値:p99" (ms)。
+    "host=spec,host=spec" でホストごとに変えられる (host 無しは既定値)"""
+
+    def __init__(self, spec="fixed:0"):
+        self.default = self._parse("fixed:0")
+        self.by_host = {}
+        for part in filter(None, (p.strip() for p in spec.split(","))):
+            if "=" in part:
+                host, dist = part.split("=", 1)
+                self.by_host[host] = self._parse(dist)
+            else:
+                self.default = self._parse(part)
+
+    @staticmethod
+    def _parse(spec):
+        kind, *args = spec.split(":")
+        args = [float(a) for a in args]
+        if kind == "fixed":
+            return lambda: args[0]
+        if kind == "uniform":
+            return lambda: random.uniform(args[0], args[1])
+        if kind == "lognormal":
+            median, p99 = args
+            sigma = math.log(max(p99, median + 1e-9) / median) / 2.326
+            return lambda: random.lognormvariate(math.log(median), sigma)
+        raise ValueError(f"unknown latency profile: {spec}")
+
+    def sample_ms(self, host):
+        return self.by_host.get(host, self.default)()
+
+
+def make_server(store, latency, host="127.0.0.1", port=0):
+    """/{上流ホスト}/{パス}?{クエリ} に記録済みレスポンスを返すスタブサーバー"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            upstream_host, _, path = parts.path.lstrip("/").partition("/")
+            status, body = store.lookup(upstream_host, "/" + path, dict(parse_qsl(parts.query)))
+            time.sleep(latency.sample_ms(upstream_host) / 1000)
+            data = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def install_recorder_from_env():
+    """UPSTREAM_RECORD が設定されていれば記録を始める"""
+    path = os.getenv("UPSTREAM_RECORD")
+    if not path: return None
+    import http_client
+    recorder = Recorder(path)
+    http_client.response_hooks.append(recorder)
+    return recorder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録済みの上流レスポンスを返すスタブサーバー")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve")
+    serve.add_argument("fixtures")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--latency", default="fixed:0")
+    args = parser.parse_args()
+
+    server = make_server(FixtureStore.load(args.fixtures), LatencyProfile(args.latency), args.host, args.port)
+    print(f"Replaying {args.fixtures} on http://{args.host}:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
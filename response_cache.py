@@ -0,0 +1,237 @@
+"""読み取り専用 API のレスポンスキャッシュ (LRU + 任意の共有ストア、stale-while-revalidate)"""
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import Response, current_app, request
+import metrics
+import payload
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+# gunicorn ワーカー間で共有する sqlite ファイル。空ならプロセス内 LRU のみ
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")
+# 共有ストアの行数の上限 (検索語などキーが利用者の入力で増えるので)
+RESPONSE_CACHE_DB_MAX_ROWS = int(os.getenv("RESPONSE_CACHE_DB_MAX_ROWS", "20000"))
+# 共有ストアに何回書いたら期限切れの行と上限を超えた分を消すか
+RESPONSE_CACHE_DB_PRUNE_EVERY = 200
+# 同じキーの取得待ちをこれ以上は待たない (秒)
+COALESCE_WAIT_SEC = 10
+
+
+class CacheEntry(payload.Precompressed):
+    """本文と ETag。圧縮した版はプロセス内で1回だけ作って使い回す"""
+
+    def __init__(self, body, etag, stored_at):
+        super().__init__(body)
+        self.etag = etag
+        self.stored_at = stored_at
+
+
+class MemoryBackend:
+    """プロセス内 LRU"""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry: self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class SqliteBackend:
+    """ワーカー間で共有するファイルストア。接続はスレッドごとに持つ。
+
+    行には使えなくなる時刻 (ttl + stale_ttl 後) を持たせ、PRUNE_EVERY 回書くごとに期限切れの行と
+    max_rows を超えた古い行を消す。
+    """
+
+    def __init__(self, path, max_rows=RESPONSE_CACHE_DB_MAX_ROWS, prune_every=RESPONSE_CACHE_DB_PRUNE_EVERY):
+        self.path = path
+        self.max_rows = max_rows
+        self.prune_every = prune_every
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, body BLOB, etag TEXT, stored_at REAL)")
+        # expires の無い古いファイルにも列を足す (その行は次の掃除で消える)
+        if "expires" not in {row[1] for row in conn.execute("PRAGMA table_info(response_cache)")}:
+            conn.execute("ALTER TABLE response_cache ADD COLUMN expires REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS response_cache_expires ON response_cache (expires)")
+        conn.execute("CREATE INDEX IF NOT EXISTS response_cache_stored_at ON response_cache (stored_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute("SELECT body, etag, stored_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def set(self, key, entry, lifetime):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO response_cache (key, body, etag, stored_at, expires) VALUES (?, ?, ?, ?, ?)",
+            (key, entry.body, entry.etag, entry.stored_at, entry.stored_at + lifetime))
+        self._writes += 1
+        if self._writes % self.prune_every == 0: self.prune()
+
+    def prune(self, now=None):
+        conn = self._conn()
+        conn.execute("DELETE FROM response_cache WHERE expires IS NULL OR expires < ?", (now or time.time(),))
+        conn.execute("DELETE FROM response_cache WHERE key IN "
+                     "(SELECT key FROM response_cache ORDER BY stored_at DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+
+
+def _default_cacheable(data):
+    # 上流障害時の空配列やエラーは覚えない
+    return bool(data) and not (isinstance(data, dict) and "error" in data)
+
+
+class ResponseCache:
+    def __init__(self, shared_path=RESPONSE_CACHE_DB):
+        self.local = MemoryBackend()
+        self.shared = None
+        if shared_path:
+            try:
+                self.shared = SqliteBackend(shared_path)
+            except Exception as e:
+                print(f"Response Cache DB Error: {e}")
+        self._inflight = {}   # key -> threading.Event (同じキーの取得を1本にまとめる)
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared:
+            try:
+                entry = self.shared.get(key)
+            except Exception as e:
+                print(f"Response Cache DB Error: {e}")
+            if entry: self.local.set(key, entry)
+        return entry
+
+    def store(self, key, body, lifetime):
+        """lifetime = このエントリを返してよい秒数 (ttl + stale_ttl)"""
+        entry = CacheEntry(body, hashlib.sha1(body).hexdigest()[:16], time.time())
+        self.local.set(key, entry)
+        if self.shared:
+            try:
+                self.shared.set(key, entry, lifetime)
+            except Exception as e:
+                print(f"Response Cache DB Error: {e}")
+        return entry
+
+    def _claim(self, key):
+        """取得役になれたら (True, event)、既に誰かが取得中なら (False, event)"""
+        with self._lock:
+            event = self._inflight.get(key)
+            if event: return False, event
+            event = self._inflight[key] = threading.Event()
+            return True, event
+
+    def _release(self, key, event):
+        with self._lock:
+            self._inflight.pop(key, None)
+        event.set()
+
+    def fill(self, key, compute, cacheable, lifetime):
+        """上流から取り直してキャッシュする。compute は (body, status) を返す"""
+        body, status = compute()
+        if status == 200 and cacheable(json.loads(body)):
+            return self.store(key, body, lifetime), body, status
+        return None, body, status
+
+    def revalidate_async(self, key, compute, cacheable, lifetime):
+        leader, event = self._claim(key)
+        if not leader: return
+
+        def run():
+            try:
+                self.fill(key, compute, cacheable, lifetime)
+            except Exception as e:
+                print(f"Response Cache Refresh Error ({key}): {e}")
+            finally:
+                self._release(key, event)
+        threading.Thread(target=run, name="cache-revalidate", daemon=True).start()
+
+    def cached(self, name, ttl, stale_ttl=0, vary=None, cacheable=_default_cacheable):
+        """Flask のビューに付けるデコレータ。キーはエンドポイント名 + クエリ (+ vary())"""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                key = name + "?" + "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+                if vary: key += "#" + vary()
+                app = current_app._get_current_object()
+                path = request.full_path
+
+                def compute():
+                    # 裏で取り直す時はリクエストの外なので、同じ URL のコンテキストを作って呼ぶ
+                    with app.test_request_context(path):
+                        res = app.make_response(view(*args, **kwargs))
+                        return res.get_data(), res.status_code
+
+                entry = self.lookup(key)
+                age = time.time() - entry.stored_at if entry else None
+                result = "hit"
+                if entry and age >= ttl:
+                    if age < ttl + stale_ttl:
+                        result = "stale"
+                        self.revalidate_async(key, compute, cacheable, ttl + stale_ttl)
+                    else:
+                        entry = None
+
+                if entry is None:
+                    result = "miss"
+                    leader, event = self._claim(key)
+                    if not leader:
+                        event.wait(COALESCE_WAIT_SEC)
+                        entry = self.lookup(key)
+                        if entry and time.time() - entry.stored_at >= ttl + stale_ttl: entry = None
+                        if entry: result = "coalesced"
+                    metrics.cache_result(name, result)
+                    if entry is None:
+                        try:
+                            entry, body, status = self.fill(key, compute, cacheable, ttl + stale_ttl)
+                        finally:
+                            if leader: self._release(key, event)
+                        if entry is None:
+                            return Response(body, status=status, mimetype="application/json")
+                    age = time.time() - entry.stored_at
+                else:
+                    metrics.cache_result(name, result)
+
+                return self.respond(entry, max(int(ttl - age), 0), stale_ttl)
+            return wrapper
+        return decorator
+
+    def respond(self, entry, max_age, stale_ttl):
+        """ETag / Cache-Control を付けて返す。If-None-Match が一致すれば 304。
+        Accept-Encoding に応じて圧縮済みの本文を返す (ETag は圧縮ごとに別)"""
+        encoding = payload.negotiate(request.headers.get("Accept-Encoding"), len(entry.body))
+        etag = entry.etag if encoding is None else f"{entry.etag}-{encoding}"
+        if request.if_none_match.contains(etag):
+            res = Response(status=304)
+        else:
+            res = Response(entry.get(encoding), mimetype="application/json")
+            if encoding: res.headers["Content-Encoding"] = encoding
+        res.set_etag(etag)
+        res.vary.add("Accept-Encoding")
+        res.headers["Cache-Control"] = f"public, max-age={max_age}, stale-while-revalidate={stale_ttl}"
+        return res
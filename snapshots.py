@@ -0,0 +1,102 @@
+"""ワーカー間で共有するディスク上のスナップショット
+
+新しいワーカー (再起動・スケールアウト) が上流に問い合わせる前から温まった状態で応答できるように、
+運行情報・GBFS・時刻表インデックスを data/snapshots/<名前>.json に書いておく。
+
+  {"schema": 形式の版, "saved_at": 保存時刻, "data": ...}
+
+読み手は schema が一致し、saved_at が呼び出し側の許す古さ以内のものだけを使う。書き込みは
+一時ファイル + os.replace なので、他のワーカーが書きかけを読むことはない。
+gunicorn --preload なら読み込みは fork 前の1回で済み、ワーカーはそのページを共有する。
+"""
+import json
+import os
+import threading
+import time
+from background import BackgroundJob
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "snapshots"))
+# まとめて書き出すデータ (時刻表など) を保存する間隔 (秒)。0 なら保存しない
+SNAPSHOT_SAVE_SEC = float(os.getenv("SNAPSHOT_SAVE_SEC", "60"))
+
+
+def _path(name):
+    return os.path.join(SNAPSHOT_DIR, f"{name}.json")
+
+
+def _dumps(obj):
+    if orjson is not None: return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _loads(raw):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def mtime(name):
+    """最後に保存された時刻 (無ければ 0)。中身を読まずに他のワーカーの保存を検知する"""
+    try:
+        return os.path.getmtime(_path(name))
+    except OSError:
+        return 0
+
+
+def load(name, schema, max_age=None):
+    """(data, saved_at)。無い・形式の版が違う・max_age 秒より古い場合は (None, None)"""
+    try:
+        with open(_path(name), "rb") as f:
+            snapshot = _loads(f.read())
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        print(f"Snapshot Load Error ({name}): {e}")
+        return None, None
+    if not isinstance(snapshot, dict) or snapshot.get("schema") != schema: return None, None
+    saved_at = snapshot.get("saved_at") or 0
+    if max_age is not None and time.time() - saved_at > max_age: return None, None
+    return snapshot.get("data"), saved_at
+
+
+def save(name, schema, data, saved_at=None):
+    """失敗しても例外は出さない (スナップショットは無くても動く)"""
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        path = _path(name)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_dumps({"schema": schema, "saved_at": saved_at or time.time(), "data": data}))
+        os.replace(tmp, path)
+        return True
+    except Exception as e:
+        print(f"Snapshot Save Error ({name}): {e}")
+        return False
+
+
+class PeriodicSaver(BackgroundJob):
+    """登録した保存関数をワーカープロセスごとのスレッドで SNAPSHOT_SAVE_SEC ごとに呼ぶ"""
+
+    thread_name = "snapshot-saver"
+
+    def __init__(self, interval=SNAPSHOT_SAVE_SEC):
+        self.interval = interval
+        self.savers = []
+
+    def register(self, fn):
+        self.savers.append(fn)
+
+    def enabled(self):
+        return self.interval > 0
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            for fn in self.savers:
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"Snapshot Save Error: {e}")
@@ -0,0 +1,154 @@
+"""運行情報・列車位置を事業者単位でまとめて取得し、路線ごとに保持するステータスボード"""
+import math
+import os
+import random
+import time
+from background import BackgroundJob
+import gateway
+import http_client
+import snapshots
+
+TRAIN_INFORMATION_URL = "https://api.odpt.org/api/v4/odpt:TrainInformation"
+TRAIN_URL = "https://api.odpt.org/api/v4/odpt:Train"
+
+# ポーリング間隔 (秒)。0 以下ならポーラーを起動せず、従来どおり都度取得する
+STATUS_POLL_INTERVAL_SEC = float(os.getenv("STATUS_POLL_INTERVAL_SEC", "30"))
+# ワーカー間で共有するスナップショットの名前と形式の版
+STATUS_SNAPSHOT = "status_board"
+STATUS_SNAPSHOT_SCHEMA = 1
+
+
+def train_status_text(infos):
+    """odpt:TrainInformation の配列から運行情報テキストを取り出す"""
+    if infos:
+        return infos[0].get("odpt:trainInformationText", {}).get("ja", "平常運転")
+    return "平常運転"
+
+
+def realtime_summary(trains):
+    """odpt:Train の配列からリアルタイム混雑度(遅延度)を算出"""
+    if not trains:
+        return {"level": 0, "msg": "稼働なし", "train_count": 0, "max_delay": 0}
+
+    train_count = len(trains)
+    delays = [t.get("odpt:delay", 0) for t in trains]
+    max_delay_min = math.ceil(max(delays) / 60) if delays else 0
+
+    if max_delay_min >= 10:
+        return {"level": 3, "msg": f"🔴 激混み (最大{max_delay_min}分遅れ)", "train_count": train_count, "max_delay": max_delay_min}
+    elif max_delay_min >= 3:
+        return {"level": 2, "msg": f"🟡 混雑 (最大{max_delay_min}分遅れ)", "train_count": train_count, "max_delay": max_delay_min}
+    else:
+        return {"level": 1, "msg": "🟢 スムーズ", "train_count": train_count, "max_delay": 0}
+
+
+def operator_of(railway_id):
+    """odpt.Railway:JR-East.Yamanote -> odpt.Operator:JR-East"""
+    return "odpt.Operator:" + railway_id.split(":", 1)[1].split(".", 1)[0]
+
+
+class StatusBoard(BackgroundJob):
+    """路線ID -> (値, 取得時刻) を保持する。読み出しは dict 参照のみ"""
+
+    thread_name = "status-board"
+
+    def __init__(self, consumer_key, railway_ids, interval=STATUS_POLL_INTERVAL_SEC):
+        self.consumer_key = consumer_key
+        self.interval = interval
+        # この時間を過ぎた値は使わない (ポーリングが数回失敗した場合など)
+        self.max_age = max(interval * 3, 60)
+        self.operators = {}
+        for railway_id in railway_ids:
+            self.operators.setdefault(operator_of(railway_id), []).append(railway_id)
+        self.status = {}    # railway_id -> (運行情報テキスト, 取得時刻)
+        self.realtime = {}  # railway_id -> (混雑度 dict, 取得時刻)
+
+    def enabled(self):
+        """ポーリング間隔が 0 以下なら起動せず、都度取得に任せる"""
+        return self.interval > 0
+
+    def _run(self):
+        # 同時に起動したワーカーが揃ってポーリングしないように少しずらす
+        time.sleep(random.uniform(0, min(self.interval, 5)))
+        while True:
+            started = time.monotonic()
+            # 他のワーカーが間隔内にポーリングしていればその結果を使い、上流には問い合わせない
+            self.load_snapshot()
+            if time.time() - self.oldest() >= self.interval:
+                self.poll_once()
+                self.save_snapshot()
+            time.sleep(max(self.interval - (time.monotonic() - started), 1))
+
+    def oldest(self):
+        """全路線の値のうち最も古い取得時刻 (未取得の路線があれば 0)"""
+        times = [table.get(railway_id, (None, 0))[1] for table in (self.status, self.realtime)
+                 for railway_ids in self.operators.values() for railway_id in railway_ids]
+        return min(times, default=0)
+
+    def load_snapshot(self):
+        """スナップショットのうち、手元より新しく max_age 以内の値を取り込む"""
+        data, _ = snapshots.load(STATUS_SNAPSHOT, STATUS_SNAPSHOT_SCHEMA, self.max_age)
+        if not data: return False
+        now = time.time()
+        for table, name in ((self.status, "status"), (self.realtime, "realtime")):
+            for railway_id, (value, fetched_at) in data.get(name, {}).items():
+                if now - fetched_at <= self.max_age and fetched_at > table.get(railway_id, (None, 0))[1]:
+                    table[railway_id] = (value, fetched_at)
+        return True
+
+    def save_snapshot(self):
+        snapshots.save(STATUS_SNAPSHOT, STATUS_SNAPSHOT_SCHEMA, {
+            "status": {railway_id: list(entry) for railway_id, entry in list(self.status.items())},
+            "realtime": {railway_id: list(entry) for railway_id, entry in list(self.realtime.items())},
+        })
+
+    def _fetch(self, url, operator):
+        params = {"acl:consumerKey": self.consumer_key, "odpt:operator": operator}
+        res = http_client.get(url, params=params)
+        res.raise_for_status()
+        # 使い回しの値で取得時刻を進めると、上流が止まっている間も古い運行情報を最新として出してしまう
+        if gateway.is_stale(res): raise gateway.StaleResponse(url)
+        return res.json()
+
+    def poll_once(self):
+        """事業者ごとに TrainInformation と Train を1回ずつ取得して全路線を更新"""
+        for operator, railway_ids in self.operators.items():
+            try:
+                infos = self._fetch(TRAIN_INFORMATION_URL, operator)
+                now = time.time()
+                by_railway = {}
+                for info in infos:
+                    by_railway.setdefault(info.get("odpt:railway"), []).append(info)
+                for railway_id in railway_ids:
+                    self.status[railway_id] = (train_status_text(by_railway.get(railway_id)), now)
+            except Exception as e:
+                print(f"StatusBoard TrainInformation Error ({operator}): {e}")
+
+            try:
+                trains = self._fetch(TRAIN_URL, operator)
+                now = time.time()
+                by_railway = {}
+                for train in trains:
+                    by_railway.setdefault(train.get("odpt:railway"), []).append(train)
+                for railway_id in railway_ids:
+                    self.realtime[railway_id] = (realtime_summary(by_railway.get(railway_id)), now)
+            except Exception as e:
+                print(f"StatusBoard Train Error ({operator}): {e}")
+
+    def _fresh(self, table, railway_id):
+        entry = table.get(railway_id)
+        if entry and time.time() - entry[1] <= self.max_age:
+            return entry[0]
+        return None
+
+    def get_status(self, railway_id):
+        return self._fresh(self.status, railway_id)
+
+    def get_realtime(self, railway_id):
+        return self._fresh(self.realtime, railway_id)
+
+    def put_status(self, railway_id, text):
+        self.status[railway_id] = (text, time.time())
+
+    def put_realtime(self, railway_id, info):
+        self.realtime[railway_id] = (info, time.time())
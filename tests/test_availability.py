@@ -0,0 +1,35 @@
+"""時間帯ごとの平均台数の補間 (15 分の時間帯の真ん中を代表値とする)"""
+import numpy as np
+import pytest
+import availability
+from availability import BUCKETS, MIN_SAMPLES
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = availability.AvailabilityStore(None, str(tmp_path))
+    store._count = np.full((1, BUCKETS), MIN_SAMPLES, dtype=np.uint32)
+    # 時間帯 b の平均が b になるようにする
+    store._sum = (np.arange(BUCKETS, dtype=np.float32) * MIN_SAMPLES)[None, :]
+    return store
+
+
+def test_slot_midpoint_is_slot_mean(store):
+    assert store.profile_mean(0, 10.5) == pytest.approx(10)
+
+
+def test_slot_boundary_is_average_of_neighbours(store):
+    assert store.profile_mean(0, 11.0) == pytest.approx(10.5)
+    assert store.profile_mean(0, 10.75) == pytest.approx(10.25)
+
+
+def test_week_boundary_wraps(store):
+    # 月曜 0:00 は日曜最後の時間帯と月曜最初の時間帯の間
+    assert store.profile_mean(0, 0.0) == pytest.approx((BUCKETS - 1) / 2)
+    assert store.profile_mean(0, BUCKETS - 0.5) == pytest.approx(BUCKETS - 1)
+
+
+def test_too_few_samples(store):
+    store._count[0, 20] = MIN_SAMPLES - 1
+    assert store.profile_mean(0, 20.5) is None
+    assert store.profile_mean(0, 21.0) is None
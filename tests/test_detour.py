@@ -0,0 +1,81 @@
+"""迂回経路の A* が Dijkstra と同じ最短時間を返すか (小さな合成グラフ)"""
+import heapq
+import math
+import numpy as np
+import pytest
+import detour
+from geo import PointSet
+from topology import Topology
+
+# 東西の路線 A と南北の路線 B が中央の駅で交わり、A の両端から歩ける所に並行する路線 C がある
+STATIONS = [
+    ("A1", "西", 35.680, 139.700), ("A2", "中央", 35.680, 139.720), ("A3", "東", 35.680, 139.740),
+    ("B1", "北", 35.700, 139.720), ("B2", "中央", 35.680, 139.7205), ("B3", "南", 35.660, 139.720),
+    ("C1", "西南", 35.6785, 139.700), ("C2", "東南", 35.6785, 139.740),
+]
+RAILWAYS = {"A": [0, 1, 2], "B": [3, 4, 5], "C": [6, 7]}
+POINTS = [(35.680, 139.700), (35.680, 139.740), (35.700, 139.720), (35.660, 139.720), (35.678, 139.705)]
+
+
+@pytest.fixture(scope="module")
+def graph():
+    ports = (["p1", "p2"], PointSet([35.681, 35.681], [139.701, 139.712]), np.zeros(2, dtype=bool))
+    info = {"p1": {"name": "ポート1"}, "p2": {"name": "ポート2"}}
+    return detour.TransferGraph(Topology(STATIONS, RAILWAYS), ports, info, None)
+
+
+def dijkstra(graph, weights, origin, dest):
+    """見積もり無しの基準実装"""
+    goal = len(graph)
+    dist = [math.inf] * (goal + 1)
+    heap = []
+    for n, m in graph._access(origin):
+        if m < dist[n]:
+            dist[n] = m
+            heapq.heappush(heap, (m, n))
+    targets = dict(graph._access(dest))
+    while heap:
+        g, n = heapq.heappop(heap)
+        if g > dist[n]: continue
+        if n == goal: return g
+        if n in targets and g + targets[n] < dist[goal]:
+            dist[goal] = g + targets[n]
+            heapq.heappush(heap, (dist[goal], goal))
+        for e in range(graph.indptr[n], graph.indptr[n + 1]):
+            nd = g + weights[e]
+            if nd < dist[graph.dst_list[e]]:
+                dist[graph.dst_list[e]] = nd
+                heapq.heappush(heap, (nd, graph.dst_list[e]))
+    return None
+
+
+STATUS = {"p1": {"num_bikes_available": 3, "num_docks_available": 3},
+          "p2": {"num_bikes_available": 0, "num_docks_available": 5}}
+
+
+@pytest.mark.parametrize("penalties", [{}, {"A": 15.0}, {"A": None}, {"B": None, "C": 30.0}])
+def test_astar_matches_dijkstra(graph, penalties):
+    weights = graph.weights(penalties, STATUS, {detour.WALK, detour.RAIL, detour.BIKE})
+    for origin in POINTS:
+        for dest in POINTS:
+            if origin == dest: continue
+            found = graph.search(weights, origin, dest, max_minutes=math.inf)
+            expected = dijkstra(graph, weights, origin, dest)
+            if expected is None:
+                assert found is None
+            else:
+                assert found[0] == pytest.approx(expected)
+
+
+def test_closed_line_is_avoided(graph):
+    weights = graph.weights({"A": None}, STATUS, {detour.WALK, detour.RAIL})
+    found = graph.search(weights, POINTS[0], POINTS[1], max_minutes=math.inf)
+    legs = graph.legs(found, weights, POINTS[0], "出発地", "目的地", {})
+    lines = [leg["line"] for leg in legs if leg["mode"] == "rail"]
+    assert lines == ["C"]
+
+
+def test_port_without_bikes_cannot_be_rented(graph):
+    weights = graph.weights({}, STATUS, {detour.WALK, detour.RAIL, detour.BIKE})
+    board = [e for e in range(len(weights)) if graph.modes[e] == detour.BOARD and graph.refs[graph.src_list[e]] == "p2"]
+    assert board and all(weights[e] == math.inf for e in board)
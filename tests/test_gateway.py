@@ -0,0 +1,111 @@
+"""gateway のサーキットブレーカー・相乗り・使い回しの印 (上流には繋がない)"""
+import asyncio
+import time
+import httpx
+import pytest
+import requests
+import async_http
+import gateway
+import http_client
+
+HOST = "api.example.test"
+URL = f"https://{HOST}/api/v4/odpt:Station"
+
+
+@pytest.fixture(autouse=True)
+def isolated_gateway(monkeypatch):
+    monkeypatch.setattr(gateway, "_breakers", {})
+    monkeypatch.setattr(gateway, "last_good", gateway.LastGood())
+    monkeypatch.setattr(gateway, "single_flight", gateway.SingleFlight())
+    monkeypatch.setattr(gateway, "_buckets", {})
+
+
+def open_breaker():
+    """連続失敗で open にし、cooldown を経過させた状態のブレーカー"""
+    cb = gateway.breaker(HOST)
+    for _ in range(cb.failures):
+        cb.failure()
+    assert not cb.allow()
+    cb.opened_at = time.monotonic() - cb.cooldown - 1
+    return cb
+
+
+def ok_response(body=b"[]"):
+    res = requests.Response()
+    res.status_code, res._content = 200, body
+    return res
+
+
+class RefusingBucket:
+    def acquire(self, priority):
+        return False
+
+    async def acquire_async(self, priority):
+        return False
+
+
+def test_rate_limited_probe_does_not_hold_the_breaker(monkeypatch):
+    cb = open_breaker()
+    monkeypatch.setitem(gateway._buckets, HOST, RefusingBucket())
+    with pytest.raises(gateway.RateLimited):
+        http_client.get(URL)
+    assert not cb.probing
+    assert cb.allow()
+
+
+def test_unexpected_error_releases_probe(monkeypatch):
+    cb = open_breaker()
+
+    def boom(*args):
+        raise ValueError("boom")
+    monkeypatch.setattr(http_client, "_send", boom)
+    with pytest.raises(ValueError):
+        http_client.get(URL)
+    assert not cb.probing
+    monkeypatch.setattr(http_client, "_send", lambda *args: ok_response())
+    assert http_client.get(URL).status_code == 200
+    assert cb.opened_at is None
+
+
+def test_cancelled_async_probe_releases_breaker(monkeypatch):
+    cb = open_breaker()
+
+    async def hang(*args):
+        await asyncio.sleep(10)
+    monkeypatch.setattr(async_http, "_send", hang)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(async_http._guarded_get("k", HOST, URL, None, None, None), 0.01)
+    asyncio.run(run())
+    assert not cb.probing
+    assert cb.allow()
+
+
+def test_cancelled_leader_does_not_cancel_followers(monkeypatch):
+    async def slow(*args):
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, content=b"[1]")
+    monkeypatch.setattr(async_http, "_send", slow)
+
+    async def run():
+        leader = asyncio.create_task(async_http.get(URL))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(async_http.get(URL))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+    assert asyncio.run(run()).json() == [1]
+
+
+def test_fallback_marks_last_good_response(monkeypatch):
+    monkeypatch.setattr(http_client, "_send", lambda *args: ok_response(b"[1]"))
+    fresh = http_client.get(URL)
+    assert not gateway.is_stale(fresh)
+
+    def down(*args):
+        raise requests.ConnectionError("down")
+    monkeypatch.setattr(http_client, "_send", down)
+    stale = http_client.get(URL)
+    assert gateway.is_stale(stale) and stale.json() == [1]
+    assert not gateway.is_stale(fresh)
@@ -0,0 +1,59 @@
+"""レスポンスキャッシュ: ETag による 304 と、期限切れ後の stale-while-revalidate"""
+import json
+import pytest
+from flask import Flask, jsonify
+import response_cache
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: clock[0])
+    cache = response_cache.ResponseCache(shared_path="")
+    revalidations = []
+    monkeypatch.setattr(cache, "revalidate_async",
+                        lambda *args: revalidations.append(args))
+    app = Flask(__name__)
+    calls = []
+
+    @app.route("/items")
+    @cache.cached("items", ttl=60, stale_ttl=600)
+    def items():
+        calls.append(1)
+        return jsonify({"version": len(calls)})
+
+    return app.test_client(), cache, clock, calls, revalidations
+
+
+def test_if_none_match_returns_304(setup):
+    client, _, _, calls, _ = setup
+    first = client.get("/items")
+    assert first.status_code == 200 and first.get_etag()[0]
+    second = client.get("/items", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 304
+    assert calls == [1]
+
+
+def test_stale_hit_serves_old_body_and_revalidates(setup):
+    client, cache, clock, calls, revalidations = setup
+    client.get("/items")
+    clock[0] += 120  # ttl 切れ、stale_ttl 内
+    stale = client.get("/items")
+    assert json.loads(stale.data) == {"version": 1}
+    assert stale.headers["Cache-Control"].startswith("public, max-age=0")
+    assert len(revalidations) == 1 and calls == [1]
+
+    # 裏の取り直しを実行すると、次からは新しい本文と別の ETag
+    key, compute, cacheable, lifetime = revalidations[0]
+    cache.fill(key, compute, cacheable, lifetime)
+    fresh = client.get("/items", headers={"If-None-Match": stale.headers["ETag"]})
+    assert fresh.status_code == 200 and json.loads(fresh.data) == {"version": 2}
+
+
+def test_expired_beyond_stale_ttl_is_a_miss(setup):
+    client, _, clock, calls, revalidations = setup
+    client.get("/items")
+    clock[0] += 60 + 600 + 1
+    res = client.get("/items")
+    assert json.loads(res.data) == {"version": 2}
+    assert revalidations == [] and calls == [1, 1]
@@ -0,0 +1,33 @@
+"""時刻表インデックスの前後検索 (運行日の区切りをまたぐ深夜帯)"""
+import timetable
+
+
+def timetable_response(*times):
+    return [{"odpt:railway": "odpt.Railway:Test.Line", "odpt:calendar": "odpt.Calendar:Weekday",
+             "odpt:stationTimetableObject": [
+                 {"odpt:departureTime": t, "odpt:destinationStation": ["odpt.Station:Test.Line.End"],
+                  "odpt:trainType": "odpt.TrainType:Test.Local"} for t in times]}]
+
+
+def cache_with(monkeypatch, *times):
+    cache = timetable.TimetableCache("key")
+    monkeypatch.setattr(cache, "_fetch", lambda station_id, line_id: timetable_response(*times))
+    return cache
+
+
+def test_window_after_midnight_includes_previous_evening(monkeypatch):
+    cache = cache_with(monkeypatch, "05:00", "23:30", "23:40", "23:55", "00:05", "00:30", "00:45")
+    times = [d["time"] for d in cache.departures("st", "odpt.Railway:Test.Line", "Weekday", "00:10", 30)]
+    assert times == ["23:40", "23:55", "00:05", "00:30"]
+
+
+def test_window_before_midnight_includes_late_night(monkeypatch):
+    cache = cache_with(monkeypatch, "23:30", "23:50", "00:15", "00:45")
+    times = [d["time"] for d in cache.departures("st", "odpt.Railway:Test.Line", "Weekday", "23:55", 20)]
+    assert times == ["23:50", "00:15"]
+
+
+def test_early_morning_is_not_wrapped(monkeypatch):
+    cache = cache_with(monkeypatch, "00:40", "04:50", "05:00", "05:20")
+    times = [d["time"] for d in cache.departures("st", "odpt.Railway:Test.Line", "Weekday", "05:05", 10)]
+    assert times == ["05:00"]
@@ -0,0 +1,209 @@
+"""駅時刻表の事前パース済みインデックス (発車分の昇順配列 + 二分探索)"""
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import http_client
+import metrics
+import snapshots
+
+STATION_TIMETABLE_URL = "https://api.odpt.org/api/v4/odpt:StationTimetable"
+
+# 前後何分の発車を返すか (リクエストの window で上書き可)
+TIMETABLE_WINDOW_MIN = int(os.getenv("TIMETABLE_WINDOW_MIN", "30"))
+TIMETABLE_MAX_WINDOW_MIN = 180
+# 運行日の区切り (分)。これより前の発車は前日の続き (24:xx) として扱う。0 なら折り返さない
+TIMETABLE_DAY_START_MIN = int(os.getenv("TIMETABLE_DAY_START_MIN", "180"))
+TIMETABLE_TTL_SEC = float(os.getenv("TIMETABLE_TTL_SEC", str(6 * 60 * 60)))
+# 時刻表が見つからなかった駅は短めに覚えておく
+TIMETABLE_MISS_TTL_SEC = 300
+TIMETABLE_CACHE_SIZE = int(os.getenv("TIMETABLE_CACHE_SIZE", "2048"))
+
+CALENDARS = ("Weekday", "SaturdayHoliday")
+# ワーカー間で共有するスナップショット (見つかった時刻表だけを保存する)
+TIMETABLE_SNAPSHOT = "timetables"
+TIMETABLE_SNAPSHOT_SCHEMA = 1
+
+
+def to_mins(t_str):
+    h, m = map(int, t_str.split(':'))
+    return h * 60 + m
+
+
+def service_mins(t_str, day_start=TIMETABLE_DAY_START_MIN):
+    """運行日基準の分 (深夜帯は 1440 以降に寄せる)"""
+    mins = to_mins(t_str)
+    return mins + 1440 if mins < day_start else mins
+
+
+def calendar_key(user_cal):
+    return "Weekday" if user_cal == "Weekday" else "SaturdayHoliday"
+
+
+class DepartureIndex:
+    """1駅・1路線・1カレンダー分の発車時刻。mins は昇順"""
+
+    __slots__ = ("mins", "times", "dests", "types")
+
+    def __init__(self, departures):
+        departures.sort(key=lambda d: d[0])
+        self.mins = array("H", (d[0] for d in departures))
+        self.times = [d[1] for d in departures]
+        self.dests = [d[2] for d in departures]
+        self.types = [d[3] for d in departures]
+
+    def window(self, target, width):
+        lo = bisect_left(self.mins, max(target - width, 0))
+        hi = bisect_right(self.mins, target + width)
+        return [{"time": self.times[i], "dest": self.dests[i], "type": self.types[i]} for i in range(lo, hi)]
+
+    def rows(self):
+        """スナップショット用の [(発車分, 時刻, 行き先, 種別)]"""
+        return list(zip(self.mins, self.times, self.dests, self.types))
+
+
+def alias_station_id(station_id):
+    """odpt.Station:JR-East.Yamanote.Shinjuku -> odpt.Station:JR-East.Shinjuku"""
+    parts = station_id.split(':')
+    if len(parts) == 2:
+        body_parts = parts[1].split('.')
+        if len(body_parts) >= 3:
+            return f"{parts[0]}:{body_parts[0]}.{body_parts[-1]}"
+    return None
+
+
+def build_indexes(res, line_id, day_start=TIMETABLE_DAY_START_MIN):
+    """odpt:StationTimetable の配列からカレンダー別の DepartureIndex を作る"""
+    indexes = {}
+    for user_cal in CALENDARS:
+        seen = set()
+        departures = []
+        for tt in res:
+            data_line = tt.get("odpt:railway", "")
+            if line_id and data_line and data_line != line_id and "JR-East" not in line_id:
+                continue
+
+            cal_id = tt.get("odpt:calendar", "")
+            is_match = False
+            if user_cal == "Weekday":
+                if "Weekday" in cal_id: is_match = True
+            else:
+                if "Saturday" in cal_id or "Holiday" in cal_id: is_match = True
+
+            if not is_match and len(res) <= 3: is_match = True
+            if not is_match: continue
+
+            for train in tt.get("odpt:stationTimetableObject", []):
+                dep = train.get("odpt:departureTime")
+                if not dep: continue
+                dest = train.get("odpt:destinationStation", [])
+                d_name = dest[0].split('.')[-1] if dest else "Unknown"
+                k = f"{dep}-{d_name}"
+                if k in seen: continue
+                seen.add(k)
+                t_type = train.get("odpt:trainType", "").split('.')[-1].replace('JR-East.', '')
+                departures.append((service_mins(dep, day_start), dep, d_name, t_type))
+        indexes[user_cal] = DepartureIndex(departures)
+    return indexes
+
+
+class TimetableCache:
+    """(駅, 路線) -> カレンダー別インデックス の LRU キャッシュ。駅IDの読み替えも1度だけ行う"""
+
+    def __init__(self, consumer_key, maxsize=TIMETABLE_CACHE_SIZE, ttl=TIMETABLE_TTL_SEC):
+        self.consumer_key = consumer_key
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (station_id, line_id) -> (indexes or None, expires)
+        self._dirty = False  # 最後にスナップショットを保存してから取得したものがあるか
+        self._lock = threading.Lock()
+
+    def _query(self, station_id, railway_id=None):
+        params = {"acl:consumerKey": self.consumer_key, "odpt:station": station_id}
+        if railway_id: params["odpt:railway"] = railway_id
+        return http_client.get(STATION_TIMETABLE_URL, params=params).json()
+
+    def _fetch(self, station_id, line_id):
+        """駅ID そのまま -> 路線名を除いた別名 -> 路線指定なし の順に探す"""
+        res = self._query(station_id, line_id)
+        if not res:
+            alt_id = alias_station_id(station_id)
+            if alt_id:
+                station_id = alt_id
+                res = self._query(station_id, line_id)
+        if not res:
+            res = self._query(station_id)
+        return res
+
+    def get(self, station_id, line_id):
+        key = (station_id, line_id)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                metrics.cache_result("timetable_index", "hit")
+                return entry[0]
+        metrics.cache_result("timetable_index", "miss")
+
+        res = self._fetch(station_id, line_id)
+        indexes = build_indexes(res, line_id) if res else None
+        ttl = self.ttl if indexes else TIMETABLE_MISS_TTL_SEC
+        self._put(key, indexes, now + ttl)
+        if indexes: self._dirty = True
+        return indexes
+
+    def _put(self, key, indexes, expires):
+        with self._lock:
+            self._entries[key] = (indexes, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def load_snapshot(self):
+        """期限内のインデックスを空きがある分だけ読み込む。
+
+        手元に同じキーがあればそちらを使い、読み込んだものは LRU の古い側に置く
+        (他のワーカーの分で、このワーカーが使っている時刻表を追い出さない)。
+        """
+        data, _ = snapshots.load(TIMETABLE_SNAPSHOT, TIMETABLE_SNAPSHOT_SCHEMA)
+        return self._adopt(data or [])
+
+    def _adopt(self, rows):
+        now = time.time()
+        loaded = 0
+        for station_id, line_id, expires, calendars in rows:
+            key = (station_id, line_id)
+            if expires <= now or key in self._entries: continue
+            indexes = {cal: DepartureIndex(rows) for cal, rows in calendars.items()}
+            with self._lock:
+                if len(self._entries) >= self.maxsize: break
+                if key in self._entries: continue
+                self._entries[key] = (indexes, expires)
+                self._entries.move_to_end(key, last=False)
+            loaded += 1
+        return loaded
+
+    def save_snapshot(self):
+        """新しく取得したものがあれば、他のワーカーが保存した分とまとめて書き出す (最近使った順に maxsize 件まで)"""
+        if not self._dirty: return False
+        self._dirty = False
+        now = time.time()
+        with self._lock:
+            entries = [(key, entry) for key, entry in reversed(self._entries.items()) if entry[0]]
+        data = [[station_id, line_id, expires, {cal: index.rows() for cal, index in indexes.items()}]
+                for (station_id, line_id), (indexes, expires) in entries if expires > now]
+        own = {(row[0], row[1]) for row in data}
+        saved, _ = snapshots.load(TIMETABLE_SNAPSHOT, TIMETABLE_SNAPSHOT_SCHEMA)
+        data += [row for row in saved or [] if (row[0], row[1]) not in own and row[2] > now]
+        self._adopt(saved or [])
+        return snapshots.save(TIMETABLE_SNAPSHOT, TIMETABLE_SNAPSHOT_SCHEMA, data[:self.maxsize])
+
+    def departures(self, station_id, line_id, user_cal, target_time_str, width=TIMETABLE_WINDOW_MIN):
+        """target_time_str の前後 width 分の発車 (時刻順)"""
+        indexes = self.get(station_id, line_id)
+        if not indexes: return []
+        width = min(max(width, 0), TIMETABLE_MAX_WINDOW_MIN)
+        return indexes[calendar_key(user_cal)].window(service_mins(target_time_str), width)
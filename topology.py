@@ -0,0 +1,187 @@
+"""路線・駅トポロジー (駅一覧と座標) をローカルに保持するストア"""
+import hashlib
+import json
+import math
+import os
+import time
+from array import array
+from background import BackgroundJob
+import http_client
+import snapshots
+from status_board import operator_of
+
+RAILWAY_URL = "https://api.odpt.org/api/v4/odpt:Railway"
+STATION_URL = "https://api.odpt.org/api/v4/odpt:Station"
+
+# 他のスナップショットと同じ data/snapshots/ に置く (実行時に書くファイルなのでリポジトリには入れない)
+TOPOLOGY_SNAPSHOT_PATH = os.getenv("TOPOLOGY_SNAPSHOT_PATH", os.path.join(snapshots.SNAPSHOT_DIR, "topology.json"))
+# 駅データはほとんど変わらないので1日1回確認する
+TOPOLOGY_REFRESH_SEC = float(os.getenv("TOPOLOGY_REFRESH_SEC", str(24 * 60 * 60)))
+
+
+class Topology:
+    """配列で持つ駅テーブル。構築後は読み取り専用"""
+
+    def __init__(self, stations, railways, built_at=None):
+        # stations: [(id, name, lat, lon)], railways: {railway_id: [駅インデックス(順序どおり)]}
+        self.ids = [s[0] for s in stations]
+        self.names = [s[1] for s in stations]
+        self.lat = array("d", (math.nan if s[2] is None else s[2] for s in stations))
+        self.lon = array("d", (math.nan if s[3] is None else s[3] for s in stations))
+        self.index = {st_id: i for i, st_id in enumerate(self.ids)}
+        self.railways = {rid: array("I", idxs) for rid, idxs in railways.items()}
+        self.built_at = built_at or time.time()
+        self.version = self._digest()
+
+    def _digest(self):
+        h = hashlib.sha1()
+        h.update(json.dumps(self.ids, ensure_ascii=False).encode())
+        h.update(self.lat.tobytes())
+        h.update(self.lon.tobytes())
+        for rid in sorted(self.railways):
+            h.update(rid.encode())
+            h.update(self.railways[rid].tobytes())
+        return h.hexdigest()[:12]
+
+    def _coord(self, values, i):
+        v = values[i]
+        return None if math.isnan(v) else v
+
+    def station(self, i):
+        return {"id": self.ids[i], "name": self.names[i], "lat": self._coord(self.lat, i), "lon": self._coord(self.lon, i)}
+
+    def stations_for(self, railway_id):
+        """路線の駅一覧 (駅順)。未収録の路線なら None"""
+        idxs = self.railways.get(railway_id)
+        if idxs is None: return None
+        return [self.station(i) for i in idxs]
+
+    def geo(self, station_id):
+        i = self.index.get(station_id)
+        if i is None or math.isnan(self.lat[i]) or math.isnan(self.lon[i]): return None
+        return {"lat": self.lat[i], "lon": self.lon[i]}
+
+    def to_json(self):
+        return {
+            "version": self.version,
+            "built_at": self.built_at,
+            "stations": [[self.ids[i], self.names[i], self._coord(self.lat, i), self._coord(self.lon, i)] for i in range(len(self.ids))],
+            "railways": {rid: list(idxs) for rid, idxs in self.railways.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls([tuple(s) for s in data["stations"]], data["railways"], data.get("built_at"))
+
+
+def build_railway_order(railway, station_res):
+    """odpt:Railway の駅順に並べ、駅順に無い駅を後ろに付ける"""
+    station_map = {}
+    for s in station_res:
+        s_id = s["owl:sameAs"]
+        station_map[s_id] = (s_id, s["odpt:stationTitle"]["ja"], s.get("geo:lat"), s.get("geo:long"))
+
+    ordered = []
+    for item in (railway or {}).get("odpt:stationOrder", []):
+        st_id = item["odpt:station"]
+        if st_id in station_map:
+            ordered.append(station_map[st_id])
+    used_ids = set(s[0] for s in ordered)
+    ordered.extend(s for s_id, s in station_map.items() if s_id not in used_ids)
+    return ordered
+
+
+class TopologyStore(BackgroundJob):
+    """スナップショットから読み込み、バックグラウンドで定期的に作り直す"""
+
+    thread_name = "topology-refresh"
+
+    def __init__(self, consumer_key, railway_ids, path=TOPOLOGY_SNAPSHOT_PATH, refresh_sec=TOPOLOGY_REFRESH_SEC):
+        self.consumer_key = consumer_key
+        self.railway_ids = list(railway_ids)
+        self.path = path
+        self.refresh_sec = refresh_sec
+        self.current = None
+
+    def load_snapshot(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.current = Topology.from_json(json.load(f))
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Topology Snapshot Error: {e}")
+            return False
+
+    def save_snapshot(self, topology):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(topology.to_json(), f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def _fetch(self, url, operator):
+        params = {"acl:consumerKey": self.consumer_key, "odpt:operator": operator}
+        res = http_client.get(url, params=params)
+        res.raise_for_status()
+        return res.json()
+
+    def build(self):
+        """事業者ごとに odpt:Railway / odpt:Station を1回ずつ取得して組み立てる"""
+        operators = {}
+        for railway_id in self.railway_ids:
+            operators.setdefault(operator_of(railway_id), []).append(railway_id)
+
+        stations, index, railways = [], {}, {}
+        for operator, railway_ids in operators.items():
+            railway_res = {r["owl:sameAs"]: r for r in self._fetch(RAILWAY_URL, operator)}
+            station_res = {}
+            for s in self._fetch(STATION_URL, operator):
+                station_res.setdefault(s.get("odpt:railway"), []).append(s)
+            for railway_id in railway_ids:
+                if railway_id not in station_res: continue
+                idxs = []
+                for st in build_railway_order(railway_res.get(railway_id), station_res[railway_id]):
+                    if st[0] not in index:
+                        index[st[0]] = len(stations)
+                        stations.append(st)
+                    idxs.append(index[st[0]])
+                railways[railway_id] = idxs
+        return Topology(stations, railways)
+
+    def refresh(self):
+        """作り直して内容が変わっていれば差し替え、スナップショットを更新する"""
+        topology = self.build()
+        if not topology.railways: raise ValueError("no railways in topology")
+        if self.current and self.current.version == topology.version:
+            self.current.built_at = topology.built_at
+            return False
+        self.current = topology
+        try:
+            self.save_snapshot(topology)
+        except Exception as e:
+            print(f"Topology Snapshot Save Error: {e}")
+        return True
+
+    def _run(self):
+        while True:
+            current = self.current
+            age = time.time() - current.built_at if current else math.inf
+            if age >= self.refresh_sec:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Topology Refresh Error: {e}")
+                    time.sleep(60)
+                    continue
+                age = 0
+            time.sleep(max(self.refresh_sec - age, 60))
+
+    def stations_for(self, railway_id):
+        current = self.current
+        return current.stations_for(railway_id) if current else None
+
+    def geo(self, station_id):
+        current = self.current
+        return current.geo(station_id) if current else None